@@ -0,0 +1,73 @@
+"""Notebook execution time with a new kernel per run vs. the fork server
+
+    python benchmarks/execute_forkserver.py [--runs 10] [--setup-seconds 2]
+
+The benchmark notebook starts with a setup cell tagged "setup" which
+imports libraries and sleeps to stand in for loading reference data,
+followed by a short parameterised cell. The kernel engine starts a kernel
+and runs the setup on every run, the forkserver engine runs the setup
+once in a template process and forks a kernel for every run.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import nbformat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hydra_notebook.core import NotebookBuilder, NotebookExecutor  # noqa: E402
+from hydra_notebook.forkserver import close_servers  # noqa: E402
+
+
+def build_notebook(root, setup_seconds):
+    b = NotebookBuilder().notebook().code(
+        'import json, decimal, email.parser, xml.dom.minidom',
+        'import time',
+        'time.sleep(%r)' % setup_seconds,
+        'reference = {str(i): i for i in range(10 ** 5)}',
+    )
+    b.cells[-1].metadata['tags'] = ['setup']
+    b.code('result = sum(reference.values())', 'print(result)')
+    with open(os.path.join(root, 'bench.ipynb'), 'wt') as f:
+        nbformat.write(b.build(), f)
+
+
+def execute(root, runs, engine):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        with NotebookExecutor('bench', path=root, engine=engine) as e:
+            e()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--setup-seconds', type=float, default=2.0)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        build_notebook(root, args.setup_seconds)
+        kernel = execute(root, args.runs, 'kernel')
+        forked = execute(root, args.runs, 'forkserver')
+    finally:
+        close_servers()
+        shutil.rmtree(root)
+
+    print('%d runs, setup cell of %.1f s' % (args.runs, args.setup_seconds))
+    print('kernel engine:     %8.2f s total, %6.0f ms per run' % (sum(kernel), sum(kernel) / args.runs * 1000))
+    print('forkserver engine: %8.2f s total, %6.0f ms per run (first run %.0f ms, later runs %.0f ms)' % (
+        sum(forked), sum(forked) / args.runs * 1000, forked[0] * 1000,
+        sum(forked[1:]) / max(len(forked) - 1, 1) * 1000))
+    print('speedup:           %8.1fx' % (sum(kernel) / sum(forked)))
+
+
+if __name__ == '__main__':
+    main()
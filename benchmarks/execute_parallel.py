@@ -0,0 +1,88 @@
+"""Execution time of a notebook with a wide fan-out, by engine
+
+    python benchmarks/execute_parallel.py [--width 16] [--cell-seconds 0.25] [--workers 4 8 16] [--kernel]
+
+The notebook built with NotebookBuilder has a setup cell, ``--width``
+independent cells loading a part each (sleeping ``--cell-seconds``,
+standing in for a query or a remote call) and a cell combining the parts.
+It is executed in notebook order by the inprocess engine, optionally by a
+kernel, and by the parallel engine with every number of ``--workers``.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import django
+import nbformat
+from django.conf import settings
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_ROOT)
+
+
+def build_notebook(width, cell_seconds):
+    from hydra_notebook.core import NotebookBuilder
+    b = NotebookBuilder().notebook().markdown('# Fan-out')
+    b.code('import time', '', 'def load(part):', '    time.sleep(%r)' % cell_seconds, '    return list(range(part))')
+    for part in range(width):
+        b.code('part_%d = load(%d)' % (part, part))
+    b.code('total = sum(%s)' % ' + '.join('part_%d' % part for part in range(width)), 'total')
+    return b.build()
+
+
+def execute(directory, engine, workers=None):
+    from hydra_notebook.core import NotebookExecutor
+    settings.NOTEBOOKS_PARALLEL_WORKERS = workers
+    start = time.perf_counter()
+    with NotebookExecutor('fanout', path=directory, engine=engine) as e:
+        e()
+    return time.perf_counter() - start, e.nb.cells[-1].outputs[0].data['text/plain']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=16)
+    parser.add_argument('--cell-seconds', type=float, default=0.25)
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--kernel', action='store_true', help='also execute the notebook with a kernel')
+    args = parser.parse_args()
+
+    settings.configure(INSTALLED_APPS=['hydra_notebook'], USE_TZ=True)
+    django.setup()
+    from hydra_notebook.dag import cell_graph, critical_path
+
+    directory = tempfile.mkdtemp()
+    try:
+        nb = build_notebook(args.width, args.cell_seconds)
+        path = os.path.join(directory, 'fanout.ipynb')
+        with open(path, 'wt') as f:
+            nbformat.write(nb, f)
+        graph = cell_graph(nb)
+        print('%d code cells, %d on the critical path, %d sleeping %.2f s' % (
+            len(graph), critical_path(graph), args.width, args.cell_seconds))
+
+        runs = [('inprocess', 'inprocess', None)]
+        if args.kernel:
+            runs.insert(0, ('kernel', 'kernel', None))
+        runs.extend(('parallel, %d workers' % workers, 'parallel', workers)
+                    for workers in args.workers)
+        results = []
+        for label, engine, workers in runs:
+            # the engines write the outputs back, every run starts from the same notebook
+            with open(path, 'wt') as f:
+                nbformat.write(nb, f)
+            elapsed, total = execute(directory, engine, workers)
+            results.append((label, elapsed, total))
+    finally:
+        shutil.rmtree(directory)
+
+    baseline = next(elapsed for label, elapsed, total in results if label == 'inprocess')
+    for label, elapsed, total in results:
+        print('%-22s %6.2f s, %.1fx the speed of inprocess, total %s' % (label, elapsed, baseline / elapsed, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Cold vs. warm import time of notebooks with the bytecode cache
+
+    python benchmarks/import_cache.py [--notebooks 20] [--cells 50] [--repeat 5]
+
+Cold imports parse, transform and compile every cell, warm imports load
+the compiled cells from the __pycache__ directory beside the notebooks.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import nbformat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hydra_notebook.cache import NotebookCodeCache, clear_root  # noqa: E402
+from hydra_notebook.core import NotebookBuilder, NotebookLoader  # noqa: E402
+
+
+def build_notebooks(root, notebooks, cells):
+    for n in range(notebooks):
+        b = NotebookBuilder().notebook().markdown('# Benchmark notebook %d' % n)
+        for c in range(cells):
+            b.code(
+                'def function_%d(x, y=%d):' % (c, c),
+                '    """sample function"""',
+                '    values = [i * y for i in range(x)]',
+                '    return sum(v for v in values if v % 3)',
+                '',
+                'class Class%d(object):' % c,
+                '    def method(self):',
+                '        return function_%d(10)' % c,
+                '',
+                'value_%d = Class%d().method()' % (c, c),
+            )
+        with open(os.path.join(root, 'bench_%d.ipynb' % n), 'wt') as f:
+            nbformat.write(b.build(), f)
+
+
+def import_all(root, notebooks, cache):
+    loader = NotebookLoader(path=[root], cache=cache)
+    start = time.perf_counter()
+    for n in range(notebooks):
+        name = 'bench_%d' % n
+        loader.load_module(name)
+        del sys.modules[name]
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notebooks', type=int, default=20)
+    parser.add_argument('--cells', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        build_notebooks(root, args.notebooks, args.cells)
+        cache = NotebookCodeCache(enabled=True, write=True)
+        cold, warm = [], []
+        for _ in range(args.repeat):
+            clear_root(root)
+            cold.append(import_all(root, args.notebooks, cache))
+            warm.append(import_all(root, args.notebooks, cache))
+    finally:
+        shutil.rmtree(root)
+
+    print('%d notebooks x %d cells, best of %d' % (args.notebooks, args.cells, args.repeat))
+    print('cold import: %8.2f ms' % (min(cold) * 1000))
+    print('warm import: %8.2f ms' % (min(warm) * 1000))
+    print('speedup:     %8.1fx' % (min(cold) / min(warm)))
+
+
+if __name__ == '__main__':
+    main()
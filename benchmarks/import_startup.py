@@ -0,0 +1,58 @@
+"""Startup time and peak RSS of importing hydra_notebook plus one notebook
+
+    python benchmarks/import_startup.py [--notebook notebooks.demo_notebook] [--repeat 5]
+
+Every run is a fresh interpreter, the bytecode cache of the notebook is
+warmed up first so only the import path itself is measured.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = '''
+import hydra_notebook
+import {notebook}
+'''
+
+
+def run(notebook):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', SCRIPT.format(notebook=notebook)], cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def peak_rss(notebook):
+    # RUSAGE_CHILDREN reports the largest child, so every measurement runs in its own process
+    code = 'import resource, subprocess, sys; subprocess.run([sys.executable, "-c", %r], stdout=subprocess.DEVNULL); ' \
+           'print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)' % SCRIPT.format(notebook=notebook)
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, stdout=subprocess.PIPE)
+    return int(output.stdout.split()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notebook', default='notebooks.demo_notebook')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    env_write = os.environ.pop('PYTHONDONTWRITEBYTECODE', None)
+    try:
+        run(args.notebook)
+        times = [run(args.notebook) for _ in range(args.repeat)]
+        rss = min(peak_rss(args.notebook) for _ in range(args.repeat))
+    finally:
+        if env_write is not None:
+            os.environ['PYTHONDONTWRITEBYTECODE'] = env_write
+
+    print('import hydra_notebook + %s, best of %d' % (args.notebook, args.repeat))
+    print('wall time: %8.1f ms' % (min(times) * 1000))
+    print('peak RSS:  %8.1f MB' % (rss / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Throughput of the database job queue with 1, 2, 4 ... worker processes
+
+    python benchmarks/notebook_workers.py [--jobs 16] [--workers 1 2 4] [--cell-seconds 0.5]
+
+Every job executes a notebook with one cell sleeping ``--cell-seconds``
+(standing in for a query or a remote call) with the in-process engine.
+The worker processes share a SQLite database file, like workers on
+several hosts share a database server, and run ``notebook_worker --burst``.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import django
+import nbformat
+from django.conf import settings
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_ROOT)
+
+
+def configure(directory):
+    settings.configure(
+        INSTALLED_APPS=['hydra_notebook'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(directory, 'jobs.sqlite3'),
+                               'OPTIONS': {'timeout': 30}}},
+        USE_TZ=True,
+        NOTEBOOKS_ROOT=os.path.join(directory, 'notebooks'),
+        NOTEBOOKS_JOBS_DIR=os.path.join(directory, 'jobs'),
+        NOTEBOOKS_EXECUTION_ENGINE='inprocess',
+    )
+    django.setup()
+
+
+def run_workers(directory, workers):
+    start = time.perf_counter()
+    processes = [subprocess.Popen([sys.executable, __file__, '--worker', directory], stdout=subprocess.DEVNULL)
+                 for _ in range(workers)]
+    for process in processes:
+        process.wait()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=16)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--cell-seconds', type=float, default=0.5)
+    parser.add_argument('--worker', metavar='DIRECTORY', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    from django.core.management import call_command
+    if args.worker:
+        configure(args.worker)
+        call_command('notebook_worker', '--burst', '-c', '1')
+        return
+
+    directory = tempfile.mkdtemp()
+    try:
+        configure(directory)
+        call_command('migrate', verbosity=0)
+        from hydra_notebook.core import NotebookBuilder
+        from hydra_notebook.dbjobs import DatabaseJobQueue
+        from hydra_notebook.models import NotebookJob
+        os.makedirs(settings.NOTEBOOKS_ROOT)
+        nb = NotebookBuilder().notebook().code('import time', 'time.sleep(%r)' % args.cell_seconds).build()
+        with open(os.path.join(settings.NOTEBOOKS_ROOT, 'bench.ipynb'), 'wt') as f:
+            nbformat.write(nb, f)
+
+        queue = DatabaseJobQueue()
+        results = []
+        for workers in args.workers:
+            NotebookJob.objects.all().delete()
+            for _ in range(args.jobs):
+                queue.submit('bench')
+            elapsed = run_workers(directory, workers)
+            finished = NotebookJob.objects.filter(status=NotebookJob.FINISHED).count()
+            results.append((workers, elapsed, finished))
+    finally:
+        shutil.rmtree(directory)
+
+    print('%d jobs, one cell sleeping %.1f s' % (args.jobs, args.cell_seconds))
+    for workers, elapsed, finished in results:
+        print('%2d workers: %6.2f s, %5.1f jobs/s, %d finished, %.1fx the throughput of one worker' % (
+            workers, elapsed, finished / elapsed, finished, results[0][1] / elapsed))
+
+
+if __name__ == '__main__':
+    main()
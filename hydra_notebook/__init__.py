@@ -1,8 +1,19 @@
 import sys
 
-from hydra_notebook.core import NotebookFinder
-from hydra_notebook.core import NotebookExecutor
+from hydra_notebook.importer import NotebookFinder, NotebookPackageFinder
+from hydra_notebook.importer import import_notebook
+from hydra_notebook.importer import import_many
 
-sys.meta_path.append(NotebookFinder())
+finder = NotebookFinder()
+sys.meta_path.append(finder)
+package_finder = NotebookPackageFinder.install(finder)
 
 default_app_config = 'hydra_notebook.apps.HydraNotebookConfig'
+
+
+def __getattr__(name):
+    # the executor pulls in nbconvert, it is imported on first use only
+    if name == 'NotebookExecutor':
+        from hydra_notebook.core import NotebookExecutor
+        return NotebookExecutor
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -1,3 +1,10 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import NotebookJob
+
+
+@admin.register(NotebookJob)
+class NotebookJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'notebook', 'status', 'worker', 'attempts', 'cells_done', 'created', 'finished')
+    list_filter = ('status',)
+    search_fields = ('notebook', 'worker')
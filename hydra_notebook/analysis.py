@@ -0,0 +1,74 @@
+import dis
+import importlib.util
+import types
+
+_TOP_LEVEL_STORE = ('STORE_NAME', 'STORE_GLOBAL', 'DELETE_NAME', 'DELETE_GLOBAL')
+_NESTED_STORE = ('STORE_GLOBAL', 'DELETE_GLOBAL')
+_LOAD = ('LOAD_NAME', 'LOAD_GLOBAL')
+
+
+def _nested(code):
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield const
+            yield from _nested(const)
+
+
+def _names(code, top_level, nested):
+    names = set()
+    for instruction in dis.get_instructions(code):
+        if instruction.opname in top_level:
+            names.add(instruction.argval)
+    for inner in _nested(code):
+        for instruction in dis.get_instructions(inner):
+            if instruction.opname in nested:
+                names.add(instruction.argval)
+    return names
+
+
+def stored_names(code):
+    """names a compiled cell binds (or deletes) in the module namespace"""
+    return _names(code, _TOP_LEVEL_STORE, _NESTED_STORE)
+
+
+def loaded_names(code):
+    """names a compiled cell reads from the module namespace or the builtins
+
+    Class bodies read their own attributes by name as well, so the result is
+    a superset of the names the cell really needs from earlier cells.
+    """
+    return _names(code, _LOAD, _LOAD)
+
+
+def has_star_import(code):
+    """True if the cell runs "from ... import *", it may bind any name"""
+    for instruction in dis.get_instructions(code):
+        # python 3.12 replaced IMPORT_STAR with an intrinsic call
+        if instruction.opname == 'IMPORT_STAR' or instruction.argrepr == 'INTRINSIC_IMPORT_STAR':
+            return True
+    return False
+
+
+def imported_modules(code, package=None):
+    """absolute names of the modules a compiled cell imports at module level
+
+    "from a import b" yields both "a" and "a.b", b may be a submodule.
+    """
+    modules = set()
+    consts = [None, None]
+    for instruction in dis.get_instructions(code):
+        if instruction.opname == 'LOAD_CONST':
+            consts = [consts[1], instruction.argval]
+        elif instruction.opname == 'IMPORT_NAME':
+            level, fromlist = consts
+            name = instruction.argval
+            if level:
+                if not package:
+                    continue
+                name = importlib.util.resolve_name('.' * level + name, package)
+            if name:
+                modules.add(name)
+            for item in fromlist or ():
+                if item != '*':
+                    modules.add('%s.%s' % (name, item) if name else item)
+    return modules
@@ -1,6 +1,7 @@
 import logging
 
 from django.apps import AppConfig
+from django.conf import settings
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -10,4 +11,8 @@ class HydraNotebookConfig(AppConfig):
 
     def ready(self):
         logger.info('Initialize notebooks ...')
+        if getattr(settings, 'NOTEBOOKS_AUTORELOAD', False):
+            from .reload import NotebookWatcher
+            logger.info('Watching notebooks under %s for changes ...', settings.NOTEBOOKS_ROOT)
+            NotebookWatcher().start()
 
@@ -0,0 +1,178 @@
+import concurrent.futures
+import fnmatch
+import logging
+import os
+import threading
+import time
+
+from .cache import _notebooks
+from .conf import get_setting
+from .core import NotebookExecutor
+from .exceptions import NotebookNotFindException
+
+logger = logging.getLogger(__name__)
+
+GLOB_CHARS = '*?['
+
+
+def _name(root, nb_path):
+    return os.path.splitext(os.path.relpath(nb_path, root))[0].replace(os.sep, '/')
+
+
+def find_notebooks(patterns=None, root=None):
+    """names of the notebooks under root selected by names, glob patterns or directories
+
+    Names are relative to root, without the .ipynb extension and with / separators.
+    Every notebook under root is selected if no pattern is given.
+    """
+    root = get_setting('NOTEBOOKS_ROOT') if root is None else root
+    names = []
+    for pattern in patterns or ['.']:
+        pattern = pattern[:-len('.ipynb')] if pattern.endswith('.ipynb') else pattern
+        path = os.path.join(root, pattern)
+        if os.path.isdir(path):
+            found = sorted(_name(root, nb_path) for nb_path in _notebooks(path))
+        elif any(c in pattern for c in GLOB_CHARS):
+            found = sorted(fnmatch.filter((_name(root, nb_path) for nb_path in _notebooks(root)), pattern))
+        elif os.path.isfile(path + '.ipynb'):
+            found = [_name(root, path + '.ipynb')]
+        else:
+            raise NotebookNotFindException('No notebook %r under %s' % (pattern, root))
+        names.extend(name for name in found if name not in names)
+    return names
+
+
+class NotebookRun(object):
+    """Result of executing one notebook of a batch"""
+
+    def __init__(self, name, output_path=None):
+        self.name = name
+        self.output_path = output_path
+        self.duration = None
+        self.exception = None
+        self.timed_out = False
+        self.parameters = None
+        # the memoisation key, and whether the executed notebook came from the result store
+        self.key = None
+        self.cached = False
+        self.notebook = None
+
+    @property
+    def ok(self):
+        return self.exception is None
+
+    @property
+    def error(self):
+        if self.timed_out:
+            return 'Timed out'
+        if self.exception is None:
+            return None
+        # CellExecutionError carries the error of the failed cell
+        return '%s: %s' % (getattr(self.exception, 'ename', type(self.exception).__name__),
+                           getattr(self.exception, 'evalue', self.exception))
+
+    def __repr__(self):
+        return 'NotebookRun(%r, duration=%r, error=%r)' % (self.name, self.duration, self.error)
+
+
+def execute_notebook(name, root=None, output_dir=None, kernel_name='python3', timeout=None, cell_timeout=600,
+                     pool=False, cell_cache=False, engine='kernel', on_cell=None, limits=None, parameters=None,
+                     memoize=False, output_name=None, cells=None, tags=None, target=None, checkpoint=False,
+                     resume=False, output_policy=None):
+    """execute one notebook and write it with its outputs, return a NotebookRun
+
+    The notebook is written in place, or below ``output_dir`` as
+    ``output_name`` (default the name), also if a cell failed. Notebooks
+    executed with ``parameters`` are written below ``output_dir`` only. The
+    kernel is killed, or the in-process cells are interrupted, when the
+    notebook runs longer than ``timeout`` seconds.
+    With ``memoize`` an executed notebook is taken from the result store if
+    the notebook, the kernel and the parameters are unchanged. ``cells``,
+    ``tags`` and ``target`` execute a part of the notebook, see
+    selection.select_cells. ``checkpoint`` and ``resume`` save checkpoints
+    of the run and resume the last one, see checkpoint.CheckpointStore.
+    Outputs spilled by the ``output_policy`` go next to the written notebook.
+    """
+    if memoize and (cells is not None or tags or target is not None):
+        raise ValueError('Partial executions are not memoised')
+    root = get_setting('NOTEBOOKS_ROOT') if root is None else root
+    directory, fullname = os.path.split(os.path.join(root, name))
+    output_path = spill_dir = None
+    if output_dir is not None:
+        output_path = os.path.join(output_dir, (name if output_name is None else output_name) + '.ipynb')
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        spill_dir = output_path[:-len('.ipynb')] + '.outputs'
+    run = NotebookRun(name, output_path)
+    run.parameters = parameters
+    executor = NotebookExecutor(fullname, path=directory, kernel_name=kernel_name, timeout=cell_timeout, pool=pool,
+                                cell_cache=cell_cache, engine=engine, on_cell=on_cell, limits=limits,
+                                parameters=parameters, cells=cells, tags=tags, target=target, checkpoint=checkpoint,
+                                resume=resume, output_policy=output_policy, spill_dir=spill_dir)
+
+    def expire():
+        run.timed_out = True
+        executor.kill()
+
+    timer = threading.Timer(timeout, expire) if timeout else None
+    start = time.perf_counter()
+    try:
+        executor.read()
+        if memoize:
+            from .parameters import result_key, result_store
+            run.key = result_key(executor.nb, parameters, kernel_name)
+            cached = result_store.get(run.key)
+            if cached is not None:
+                executor.nb, run.cached = cached, True
+        try:
+            if not run.cached:
+                if timer is not None:
+                    timer.start()
+                executor()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            run.notebook = executor.nb
+            if parameters is None or output_path is not None:
+                executor.write(output_path)
+        if memoize and not run.cached:
+            result_store.put(run.key, executor.nb)
+    except Exception as e:
+        run.exception = e
+        logger.warning('Executing notebook %s failed: %s', name, run.error)
+    run.duration = time.perf_counter() - start
+    return run
+
+
+def execute_batch(names, root=None, max_workers=None, **options):
+    """execute notebooks concurrently, return their NotebookRun results in the order of names
+
+    Every notebook runs in its own kernel process, at most ``max_workers``
+    (default NOTEBOOKS_BATCH_WORKERS or the number of CPUs) at the same time.
+    The other options are passed to execute_notebook().
+    """
+    if max_workers is None:
+        max_workers = get_setting('NOTEBOOKS_BATCH_WORKERS') or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='notebook-batch') as pool:
+        futures = [pool.submit(execute_notebook, name, root=root, **options) for name in names]
+        return [future.result() for future in futures]
+
+
+def execute_parameterized(name, parameter_sets, root=None, max_workers=None, output_dir=None, **options):
+    """execute notebooks once for every parameter set concurrently, return the NotebookRun results in order
+
+    ``name`` is a notebook name or a list of them, every (notebook, parameter
+    set) run shares the ``max_workers`` threads and the results are in the
+    order of the names, then of the parameter sets. The executed notebooks are
+    written below ``output_dir`` as ``<name>-<index>``, they are memoised
+    unless ``memoize=False`` is passed. The other options are passed to
+    execute_notebook().
+    """
+    options.setdefault('memoize', True)
+    names = [name] if isinstance(name, str) else list(name)
+    if max_workers is None:
+        max_workers = get_setting('NOTEBOOKS_BATCH_WORKERS') or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='notebook-batch') as pool:
+        futures = [pool.submit(execute_notebook, name, root=root, output_dir=output_dir, parameters=parameters,
+                               output_name='%s-%d' % (name, index), **options)
+                   for name in names for index, parameters in enumerate(parameter_sets)]
+        return [future.result() for future in futures]
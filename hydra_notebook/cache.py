@@ -0,0 +1,247 @@
+import hashlib
+import importlib.util
+import io
+import logging
+import marshal
+import os
+import sys
+import threading
+
+from .analysis import loaded_names
+from .conf import get_setting
+from .selection import CellPolicy
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIRNAME = '__pycache__'
+CACHE_SUFFIX = '.nbc'
+CACHE_TAG = sys.implementation.cache_tag
+
+# the python bytecode magic is part of the header, a cache written by another
+# interpreter is never loaded even if somebody copies it around with the notebook
+MAGIC = b'HNB\x02' + importlib.util.MAGIC_NUMBER
+
+TIMESTAMP = 'timestamp'
+CHECKED_HASH = 'checked-hash'
+
+
+def source_hash(source):
+    """hash of a cell source or a whole notebook file"""
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    return hashlib.sha1(source).hexdigest()
+
+
+def cache_path(nb_path, variant=None):
+    """return the cache file of a notebook
+
+    This turns "foo/bar.ipynb" into "foo/__pycache__/bar.<tag>.nbc",
+    cells selected by a non-default policy go to "bar.<tag>.<variant>.nbc".
+    """
+    head, tail = os.path.split(nb_path)
+    name = os.path.splitext(tail)[0]
+    tag = CACHE_TAG if variant is None else '%s.%s' % (CACHE_TAG, variant)
+    return os.path.join(head, CACHE_DIRNAME, '%s.%s%s' % (name, tag, CACHE_SUFFIX))
+
+
+class CompiledCell(object):
+    """Compiled code of a single notebook cell
+
+    ``needs_shell`` is True if the cell calls get_ipython(), e.g. because
+    IPython transformed its magics and shell escapes.
+    """
+
+    def __init__(self, index, source_hash, code, needs_shell=False):
+        self.index = index
+        self.source_hash = source_hash
+        self.code = code
+        self.needs_shell = needs_shell
+
+    def dump(self):
+        return self.index, self.source_hash, self.code, self.needs_shell
+
+    @classmethod
+    def load(cls, data):
+        return cls(*data)
+
+
+def ipython_version():
+    import IPython
+    return IPython.__version__
+
+
+def transform_cell(source):
+    """turn IPython syntax (magics, shell escapes, ...) into python"""
+    from IPython.core.inputtransformer2 import TransformerManager
+    return TransformerManager().transform_cell(source)
+
+
+def compile_cells(nb, filename, transform=None, policy=None):
+    """compile the code cells of a notebook node selected by the policy
+
+    Pure python cells are compiled directly, only the cells which are not
+    valid python go through the IPython input transformer.
+    """
+    transform = transform_cell if transform is None else transform
+    policy = CellPolicy.create(policy)
+    cells = []
+    for index, cell in enumerate(nb.cells):
+        if cell.cell_type != 'code' or not policy.selects(cell):
+            continue
+        # a pseudo filename, tracebacks must not show lines of the notebook json
+        cell_filename = '<%s cell %d>' % (filename, index)
+        try:
+            code = compile(cell.source, cell_filename, 'exec')
+        except SyntaxError:
+            # transform the input to executable Python
+            code = compile(transform(cell.source), cell_filename, 'exec')
+        needs_shell = 'get_ipython' in loaded_names(code)
+        cells.append(CompiledCell(index, source_hash(cell.source), code, needs_shell))
+    return cells
+
+
+class NotebookCodeCache(object):
+    """On-disk cache of the compiled cells of notebooks
+
+    Works like the __pycache__ directories of python modules, the cache
+    file is stored beside the notebook and it is validated against the
+    modification time and size (or the content hash) of the notebook.
+    """
+
+    def __init__(self, enabled=None, invalidation_mode=None, write=None):
+        self.enabled = get_setting('NOTEBOOKS_BYTECODE_CACHE', True) if enabled is None else enabled
+        # like the import system, honour PYTHONDONTWRITEBYTECODE but still read existing caches
+        self.write = not sys.dont_write_bytecode if write is None else write
+        self.invalidation_mode = get_setting('NOTEBOOKS_BYTECODE_CACHE_INVALIDATION', TIMESTAMP) \
+            if invalidation_mode is None else invalidation_mode
+        self.hits = 0
+        self.misses = 0
+
+    def _validator(self, nb_path, st=None):
+        if self.invalidation_mode == CHECKED_HASH:
+            with io.open(nb_path, 'rb') as f:
+                return source_hash(f.read())
+        st = os.stat(nb_path) if st is None else st
+        return st.st_mtime_ns, st.st_size
+
+    def load(self, nb_path, policy=None):
+        """return the cached cells of a notebook or None if the cache is missing or stale"""
+        if not self.enabled:
+            return None
+        policy = CellPolicy.create(policy)
+        try:
+            with io.open(cache_path(nb_path, policy.variant), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if not data.startswith(MAGIC):
+            return None
+        try:
+            header, cells = marshal.loads(data[len(MAGIC):])
+        except (EOFError, ValueError, TypeError):
+            logger.warning('Corrupted notebook cache of %s', nb_path)
+            return None
+        if header[:3] != (self.invalidation_mode, self._validator(nb_path), policy.key):
+            return None
+        # cells transformed by IPython are recompiled when IPython is upgraded
+        if header[3] is not None and header[3] != ipython_version():
+            return None
+        return [CompiledCell.load(cell) for cell in cells]
+
+    def store(self, nb_path, cells, st=None, policy=None):
+        """write the compiled cells of a notebook to its cache file"""
+        if not self.enabled or not self.write:
+            return None
+        policy = CellPolicy.create(policy)
+        path = cache_path(nb_path, policy.variant)
+        header = (self.invalidation_mode, self._validator(nb_path, st), policy.key,
+                  ipython_version() if any(cell.needs_shell for cell in cells) else None)
+        data = MAGIC + marshal.dumps((header, [cell.dump() for cell in cells]))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file and rename it, concurrent workers never see a partial cache
+            tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+            with io.open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('Could not write notebook cache %s: %s', path, e)
+            return None
+        return path
+
+    def get(self, nb_path, transform=None, policy=None):
+        """return the compiled cells of a notebook selected by the policy, compile them on cache miss"""
+        policy = CellPolicy.create(policy)
+        cells = self.load(nb_path, policy)
+        if cells is not None:
+            self.hits += 1
+            return cells
+        self.misses += 1
+        # stat before reading, a notebook changed meanwhile is recompiled next time
+        st = os.stat(nb_path)
+        from nbformat import read
+        with io.open(nb_path, 'r', encoding='utf-8') as f:
+            nb = read(f, 4)
+        cells = compile_cells(nb, nb_path, transform, policy)
+        self.store(nb_path, cells, st, policy)
+        return cells
+
+    def invalidate(self, nb_path):
+        """remove the cache files of a notebook"""
+        return remove_cache(nb_path)
+
+
+def remove_cache(nb_path):
+    """remove the cache files of a notebook (for every policy), return False if there was none"""
+    prefix = os.path.basename(cache_path(nb_path))[:-len(CACHE_SUFFIX)]
+    cache_dir = os.path.join(os.path.dirname(nb_path), CACHE_DIRNAME)
+    try:
+        filenames = [f for f in os.listdir(cache_dir) if f.startswith(prefix) and f.endswith(CACHE_SUFFIX)]
+    except FileNotFoundError:
+        return False
+    for filename in filenames:
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except FileNotFoundError:
+            pass
+    return bool(filenames)
+
+
+def _notebooks(root, recursive=True):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != CACHE_DIRNAME and not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.endswith('.ipynb'):
+                yield os.path.join(dirpath, filename)
+        if not recursive:
+            break
+
+
+def compile_root(root=None, force=False, quiet=0, recursive=True, cache=None, policy=None):
+    """byte-compile all notebooks under a directory tree, like compileall.compile_dir
+
+    Returns True if every notebook was compiled successfully.
+    """
+    root = get_setting('NOTEBOOKS_ROOT') if root is None else root
+    cache = NotebookCodeCache(enabled=True, write=True) if cache is None else cache
+    policy = CellPolicy.create(policy)
+    success = True
+    for nb_path in _notebooks(root, recursive):
+        if not force and cache.load(nb_path, policy) is not None:
+            continue
+        if not quiet:
+            print('Compiling %r...' % nb_path)
+        try:
+            cache.invalidate(nb_path)
+            cache.get(nb_path, policy=policy)
+        except Exception as e:
+            success = False
+            if quiet < 2:
+                print('*** Error compiling %r: %s' % (nb_path, e))
+    return success
+
+
+def clear_root(root=None, recursive=True):
+    """remove the cache files of all notebooks under a directory tree"""
+    root = get_setting('NOTEBOOKS_ROOT') if root is None else root
+    return sum(1 for nb_path in _notebooks(root, recursive) if remove_cache(nb_path))
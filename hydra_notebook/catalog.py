@@ -0,0 +1,373 @@
+"""In-memory catalog of the notebooks of a directory
+
+The catalog reads every notebook once and keeps its size, modification
+time, kernel, language, cell counts and content hash. Lookups by name
+are dictionary lookups, lookups by prefix bisect the sorted names.
+
+A watcher thread keeps the catalog up to date: with inotify on Linux the
+changed notebooks are read again as the kernel reports them, elsewhere
+the directory is polled every NOTEBOOKS_CATALOG_INTERVAL seconds and only
+the notebooks whose size or modification time changed are read again.
+Without a watcher, lookups rescan the directory when its modification
+time changed (notebooks added, removed or replaced).
+
+``page`` returns the entries of a listing page by page: filtered by name
+prefix, kernel, language and modification time and sorted by one of
+ORDERINGS, the next page starts after the opaque cursor of the last entry
+of the previous one.
+"""
+import base64
+import bisect
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import itertools
+import json
+import logging
+import os
+import select
+import struct
+import threading
+
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+EXTENSION = '.ipynb'
+
+ORDERINGS = ('name', 'mtime', 'size', 'cells')
+
+
+def encode_cursor(ordering, key):
+    return base64.urlsafe_b64encode(json.dumps([ordering, key]).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def sort_key(entry, field):
+    if field == 'name':
+        return (entry.name,)
+    # notebooks which could not be read have no cell counts
+    value = getattr(entry, field)
+    return (-1 if value is None else value, entry.name)
+
+
+def decode_cursor(ordering, cursor):
+    """the sort key of the last entry of the previous page"""
+    try:
+        cursor_ordering, key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        valid = isinstance(key, list) and isinstance(key[-1], str) and (
+            len(key) == 1 if ordering.lstrip('-') == 'name' else len(key) == 2 and isinstance(key[0], int))
+    except (ValueError, TypeError, IndexError):
+        valid = False
+    if not valid:
+        raise ValueError('Invalid cursor %r' % cursor)
+    if cursor_ordering != ordering:
+        raise ValueError('The cursor belongs to a listing ordered by %s' % cursor_ordering)
+    return tuple(key)
+
+
+class CatalogEntry(object):
+    """What the catalog knows about one notebook"""
+
+    fields = ('name', 'filename', 'size', 'mtime', 'kernel', 'language', 'cells', 'code_cells', 'markdown_cells',
+              'hash')
+
+    def __init__(self, filename, size, mtime, kernel=None, language=None, cells=None, code_cells=None,
+                 markdown_cells=None, hash=None):
+        self.name = filename[:-len(EXTENSION)]
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.kernel = kernel
+        self.language = language
+        self.cells = cells
+        self.code_cells = code_cells
+        self.markdown_cells = markdown_cells
+        self.hash = hash
+
+    @classmethod
+    def read(cls, path, stat):
+        """the entry of a notebook file, the counts are None if it is not a valid notebook"""
+        with open(path, 'rb') as f:
+            content = f.read()
+        entry = cls(os.path.basename(path), stat.st_size, stat.st_mtime_ns, hash=hashlib.sha256(content).hexdigest())
+        try:
+            nb = json.loads(content)
+            metadata = nb.get('metadata', {})
+            kernelspec, language_info = metadata.get('kernelspec') or {}, metadata.get('language_info') or {}
+            cell_types = [cell.get('cell_type') for cell in nb['cells']]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.warning('%s is not a valid notebook', path)
+            return entry
+        entry.kernel = kernelspec.get('name')
+        entry.language = language_info.get('name') or kernelspec.get('language')
+        entry.cells = len(cell_types)
+        entry.code_cells = cell_types.count('code')
+        entry.markdown_cells = cell_types.count('markdown')
+        return entry
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def __repr__(self):
+        return 'CatalogEntry(%r)' % self.filename
+
+
+class NotebookCatalog(object):
+    """Index of the notebooks directly in ``root``"""
+
+    def __init__(self, root, interval=None):
+        self.root = root
+        self.interval = get_setting('NOTEBOOKS_CATALOG_INTERVAL', 2.0) if interval is None else interval
+        self._entries = {}
+        self._names = []
+        # the sort keys of the entries by the fields of ORDERINGS but name
+        self._orders = {}
+        self._mtime = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def watching(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _current(self):
+        if self.watching:
+            return
+        try:
+            mtime = os.stat(self.root).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self.refresh()
+
+    def refresh(self):
+        """rescan the directory, read the new and the changed notebooks"""
+        with self._lock:
+            try:
+                self._mtime = os.stat(self.root).st_mtime_ns
+                with os.scandir(self.root) as it:
+                    found = {entry.name: entry for entry in it if entry.name.endswith(EXTENSION)}
+            except OSError:
+                self._mtime, found = None, {}
+            for filename in set(self._entries) - set(found):
+                self._remove(filename)
+            for filename, dir_entry in found.items():
+                try:
+                    stat = dir_entry.stat()
+                except OSError:
+                    continue
+                entry = self._entries.get(filename)
+                if entry is None or (entry.size, entry.mtime) != (stat.st_size, stat.st_mtime_ns):
+                    self._read(filename, stat)
+
+    def update(self, filename):
+        """read a notebook again, or remove it from the catalog if it is gone"""
+        if not filename.endswith(EXTENSION):
+            return
+        with self._lock:
+            try:
+                stat = os.stat(os.path.join(self.root, filename))
+            except OSError:
+                self._remove(filename)
+                return
+            self._read(filename, stat)
+
+    def _read(self, filename, stat):
+        try:
+            entry = CatalogEntry.read(os.path.join(self.root, filename), stat)
+        except OSError:
+            self._remove(filename)
+            return
+        if filename not in self._entries:
+            bisect.insort(self._names, entry.name)
+        self._entries[filename] = entry
+        self._orders.clear()
+
+    def _remove(self, filename):
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            del self._names[bisect.bisect_left(self._names, entry.name)]
+            self._orders.clear()
+
+    def get(self, name):
+        """the entry of a notebook by name or file name, None if there is none"""
+        self._current()
+        return self._entries.get(name if name.endswith(EXTENSION) else name + EXTENSION)
+
+    def prefix(self, prefix):
+        """the entries of the notebooks whose name starts with prefix, sorted by name"""
+        self._current()
+        with self._lock:
+            start = bisect.bisect_left(self._names, prefix)
+            stop = bisect.bisect_left(self._names, prefix + '\U0010ffff', lo=start)
+            return [self._entries[name + EXTENSION] for name in self._names[start:stop]]
+
+    def all(self):
+        """every entry, sorted by name"""
+        return self.prefix('')
+
+    def page(self, prefix='', extension=None, kernel=None, language=None, modified_after=None, modified_before=None,
+             ordering='name', cursor=None, limit=100):
+        """a page of the matching entries and the cursor of the next page, None after the last page
+
+        ``modified_after`` and ``modified_before`` are timestamps in seconds,
+        ``ordering`` a name of ORDERINGS, prefixed with - for a descending order.
+        """
+        field, descending = ordering.lstrip('-'), ordering.startswith('-')
+        if field not in ORDERINGS:
+            raise ValueError('ordering must be one of %s, optionally prefixed with -' % ', '.join(ORDERINGS))
+        after = None if cursor is None else decode_cursor(ordering, cursor)
+        if extension is not None and extension.lstrip('.').lower() != EXTENSION[1:]:
+            # the catalog holds notebooks only
+            return [], None
+        after_ns = None if modified_after is None else int(modified_after * 1e9)
+        before_ns = None if modified_before is None else int(modified_before * 1e9)
+
+        def matches(entry):
+            return (entry.name.startswith(prefix) and (kernel is None or entry.kernel == kernel)
+                    and (language is None or entry.language == language)
+                    and (after_ns is None or entry.mtime > after_ns) and (before_ns is None or entry.mtime < before_ns))
+
+        self._current()
+        with self._lock:
+            # the sorted keys, only the entries from the cursor to the end of the page are looked at
+            if field == 'name':
+                keys = self._names
+                start = bisect.bisect_left(keys, prefix)
+                stop = bisect.bisect_left(keys, prefix + '\U0010ffff', lo=start)
+                after = after and after[0]
+            else:
+                keys = self._order(field)
+                start, stop = 0, len(keys)
+            if after is not None:
+                if descending:
+                    stop = max(start, bisect.bisect_left(keys, after, start, stop))
+                else:
+                    start = bisect.bisect_right(keys, after, start, stop)
+            positions = reversed(range(start, stop)) if descending else range(start, stop)
+            found = (self._entries[(keys[i] if field == 'name' else keys[i][1]) + EXTENSION] for i in positions)
+            entries = list(itertools.islice(filter(matches, found), limit + 1))
+        if len(entries) <= limit:
+            return entries, None
+        entries = entries[:limit]
+        return entries, encode_cursor(ordering, list(sort_key(entries[-1], field)))
+
+    def _order(self, field):
+        """the sort keys of the entries by field, sorted again after a change"""
+        keys = self._orders.get(field)
+        if keys is None:
+            keys = self._orders[field] = sorted(sort_key(entry, field) for entry in self._entries.values())
+        return keys
+
+    def __len__(self):
+        self._current()
+        return len(self._entries)
+
+    def start(self):
+        """keep the catalog up to date in a background thread"""
+        with self._lock:
+            if self._thread is None:
+                self.refresh()
+                self._stop.clear()
+                self._thread = threading.Thread(target=self.run, name='notebook-catalog', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        watch = Inotify.create(self.root)
+        if watch is None:
+            while not self._stop.wait(self.interval):
+                self.refresh()
+            return
+        with watch:
+            # changes between the first scan and the watch
+            self.refresh()
+            while not self._stop.is_set():
+                try:
+                    events = watch.read(timeout=self.interval)
+                except OSError as e:
+                    logger.warning('Watching %s failed, polling it: %s', self.root, e)
+                    break
+                if events is None:
+                    self.refresh()
+                    continue
+                for filename in events:
+                    self.update(filename)
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+
+class Inotify(object):
+    """inotify watch of the files of a directory, through libc"""
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    @classmethod
+    def create(cls, directory):
+        """a watch of the directory, None if inotify is not available"""
+        name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+            inotify_init1, inotify_add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError):
+            return None
+        fd = inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+        if fd < 0:
+            return None
+        # a new file is read once it was written and closed
+        mask = cls.IN_CLOSE_WRITE | cls.IN_MOVED_FROM | cls.IN_MOVED_TO | cls.IN_DELETE | cls.IN_DELETE_SELF
+        if inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            logger.warning('Cannot watch %s: %s', directory, os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return None
+        return cls(fd)
+
+    def read(self, timeout=None):
+        """names of the changed files, [] after the timeout, None if every file may have changed"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        names, offset = [], 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            if mask & (self.IN_Q_OVERFLOW | self.IN_DELETE_SELF):
+                return None
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.append(os.fsdecode(name))
+        return list(dict.fromkeys(names))
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
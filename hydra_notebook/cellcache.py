@@ -0,0 +1,264 @@
+import collections
+import json
+import logging
+import os
+import threading
+
+import nbformat
+from nbconvert.preprocessors import ExecutePreprocessor
+
+from .analysis import loaded_names, stored_names, has_star_import
+from .cache import source_hash, transform_cell
+from .conf import cache_directory, get_setting
+
+logger = logging.getLogger(__name__)
+
+
+def cell_keys(nb, kernel_name):
+    """cache keys of the code cells by notebook index
+
+    The key of a cell hashes its source, the sources of every code cell
+    before it and the kernel name, so a changed cell changes the keys of
+    all the cells after it.
+    """
+    key = source_hash(kernel_name)
+    keys = {}
+    for index, cell in enumerate(nb.cells):
+        if cell.cell_type == 'code':
+            key = source_hash(key + source_hash(cell.source))
+            keys[index] = key
+    return keys
+
+
+def _compile(source):
+    try:
+        return compile(source, '<cell>', 'exec')
+    except SyntaxError:
+        pass
+    try:
+        return compile(transform_cell(source), '<cell>', 'exec')
+    except SyntaxError:
+        return None
+
+
+def rebuild_cells(nb, cached, run):
+    """the cached cells which run again to rebuild the kernel state needed by the cells in ``run``
+
+    A cached cell is skipped only if it binds names and none of them is read
+    by a later cell that runs. Cells binding no names may have side effects,
+    star imports and magics may bind or read any name, they always run.
+    """
+    needed, anything = set(), False
+    for index in run:
+        code = _compile(nb.cells[index].source)
+        if code is None:
+            anything = True
+        else:
+            needed.update(loaded_names(code))
+            anything = anything or 'get_ipython' in needed
+    rebuild = set()
+    for index in reversed(cached):
+        code = _compile(nb.cells[index].source)
+        if code is None:
+            rebuild.add(index)
+            anything = True
+            continue
+        stored, loaded = stored_names(code), loaded_names(code)
+        if anything or not stored or stored & needed or has_star_import(code) or 'get_ipython' in loaded:
+            rebuild.add(index)
+            needed.update(loaded)
+            anything = anything or 'get_ipython' in loaded
+    return rebuild
+
+
+class CellOutputStore(object):
+    """On-disk store of the outputs of executed cells
+
+    Entries are json files named by the cell key. The least recently used
+    entries are removed when the store grows over ``max_size`` bytes.
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        self._directory = directory
+        self._max_size = max_size
+        self._size = None
+        self._lock = threading.RLock()
+        self.counters = collections.Counter()
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            return get_setting('NOTEBOOKS_CELL_CACHE_DIR') or cache_directory('cells')
+        return self._directory
+
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            return get_setting('NOTEBOOKS_CELL_CACHE_SIZE', 256 * 1024 ** 2)
+        return self._max_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def _entries(self):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.json'):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    @property
+    def size(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for mtime, size, path in self._entries())
+            return self._size
+
+    def get(self, key):
+        """the cached outputs and execution count of a cell, None on a miss"""
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+            # the modification time orders the entries for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            self.counters['misses'] += 1
+            return None
+        self.counters['hits'] += 1
+        return nbformat.from_dict(entry)
+
+    def put(self, key, outputs, execution_count=None):
+        self._write(key, dict(outputs=outputs, execution_count=execution_count))
+
+    def _write(self, key, entry):
+        path = self._path(key)
+        data = json.dumps(entry).encode('utf-8')
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('Could not write cell output cache %s: %s', path, e)
+            return
+        self.counters['stores'] += 1
+        with self._lock:
+            if self.size + len(data) > self.max_size:
+                self.evict()
+            else:
+                self._size += len(data)
+
+    def evict(self):
+        """remove the least recently used entries until the store fits into max_size"""
+        with self._lock:
+            entries = sorted(self._entries())
+            size = sum(entry[1] for entry in entries)
+            for mtime, entry_size, path in entries:
+                if size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= entry_size
+                self.counters['evictions'] += 1
+            self._size = size
+
+    def clear(self):
+        with self._lock:
+            for mtime, size, path in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
+
+    def statistics(self):
+        stats = dict(self.counters)
+        requests = self.counters['hits'] + self.counters['misses']
+        stats.update(size=self.size, hit_rate=self.counters['hits'] / requests if requests else None)
+        return stats
+
+
+class CachingExecutePreprocessor(ExecutePreprocessor):
+    """ExecutePreprocessor which reuses the cached outputs of the unchanged cells
+
+    The outputs of the longest unchanged prefix of code cells come from the
+    store, the cells from the first changed cell onward run and are stored.
+    The prefix cells whose names are needed by the cells that run are
+    executed again silently to rebuild the kernel state, no kernel is
+    started if every cell is cached. Cells with errors are not stored.
+    """
+
+    def __init__(self, store=None, **kwargs):
+        super().__init__(**kwargs)
+        self.store = default_store if store is None else store
+        # the outputs.OutputCapture of NotebookExecutor, the restored outputs are bounded like the others and
+        # the outputs are finished before they are stored
+        self.capture = None
+        self.cached = {}
+        self.rebuilt = set()
+        self.keys = {}
+
+    def plan(self, nb):
+        self.keys = cell_keys(nb, self.kernel_name)
+        self.cached = {}
+        for index, key in self.keys.items():
+            entry = self.store.get(key)
+            if entry is None:
+                break
+            self.cached[index] = entry
+        run = [index for index in self.keys if index not in self.cached]
+        self.rebuilt = rebuild_cells(nb, list(self.cached), run) if run else set()
+
+    def preprocess(self, nb, resources=None, km=None):
+        self.plan(nb)
+        if len(self.cached) == len(self.keys):
+            # no kernel, the cells still go through the preprocess_cell hooks which report them
+            self.nb, self.resources = nb, {} if resources is None else resources
+            for index in self.keys:
+                self.preprocess_cell(nb.cells[index], self.resources, index)
+            return nb, self.resources
+        return super().preprocess(nb, resources, km=km)
+
+    def _restore(self, cell, entry, index):
+        cell.execution_count = entry.execution_count
+        if self.capture is None:
+            cell.outputs = entry.outputs
+            return
+        # the outputs of a rebuilt cell are replaced
+        self.capture.cleared(index)
+        cell.outputs = []
+        for output in entry.outputs:
+            self.capture.add(cell.outputs, output, index)
+
+    def preprocess_cell(self, cell, resources, index):
+        entry = self.cached.get(index)
+        if entry is None:
+            try:
+                cell, resources = super().preprocess_cell(cell, resources, index)
+            finally:
+                bounded = self.capture is not None and self.capture.finish(cell, index)
+            # the cut outputs are not stored, a run without the limits gets them whole
+            if index in self.keys and not bounded and not any(output.output_type == 'error'
+                                                                for output in cell.outputs):
+                self.store.put(self.keys[index], cell.outputs, cell.execution_count)
+            return cell, resources
+        if index in self.rebuilt:
+            self._check_assign_resources(resources)
+            self.execute_cell(cell, index, store_history=False)
+        self._restore(cell, entry, index)
+        if self.capture is not None:
+            self.capture.finish(cell, index)
+        return cell, self.resources
+
+
+default_store = CellOutputStore()
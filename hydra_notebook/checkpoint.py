@@ -0,0 +1,311 @@
+"""Checkpoints of long notebook executions
+
+With checkpoints, the namespace of the kernel and the partially executed
+notebook are saved after the code cells, at most every ``interval``
+seconds. A run with ``resume`` restores the last checkpoint whose cells
+are unchanged and executes the cells after it, so a failure in cell 40
+does not run cells 1 to 39 again.
+
+The kernel pickles its namespace itself with the first of the
+``serializers`` (modules with dumps() and loads(), cloudpickle and dill
+also pickle the functions and classes defined in the notebook) which
+manages, or value by value if none manages the whole namespace. Values no
+serializer can pickle (open files, connections ...) and the ``skip`` names
+are left out, the cells after the checkpoint must not need them.
+"""
+import datetime
+import inspect
+import json
+import logging
+import os
+import shutil
+import time
+
+import nbformat
+
+from .cache import source_hash
+from .cellcache import cell_keys
+from .conf import cache_directory, get_setting
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE_FILENAME = 'namespace.pkl'
+NOTEBOOK_FILENAME = 'notebook.ipynb'
+METADATA_FILENAME = 'checkpoint.json'
+
+# names of the IPython namespace and the history, the names starting with _ are skipped too
+SKIP = ('In', 'Out', 'get_ipython', 'exit', 'quit')
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def save_namespace(namespace, path, serializers, skip):
+    """pickle the namespace to path, runs in the kernel with the standard library only"""
+    import importlib, json, os, pickle, types
+    values, modules = {}, {}
+    for name, value in list(namespace.items()):
+        if name.startswith('_') or name in skip:
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+        else:
+            values[name] = value
+
+    def dumps(value):
+        for serializer in serializers:
+            try:
+                return serializer, importlib.import_module(serializer).dumps(value)
+            except Exception:
+                pass
+        return None
+
+    parts, skipped = [], []
+    whole = dumps(values)
+    if whole is not None:
+        parts.append(whole)
+    else:
+        # the objects shared by several names are copied
+        for name, value in values.items():
+            part = dumps({name: value})
+            if part is None:
+                skipped.append(name)
+            else:
+                parts.append(part)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(dict(parts=parts, modules=modules), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+    with open(path + '.json', 'w') as f:
+        json.dump(dict(skipped=sorted(skipped), serializers=sorted({serializer for serializer, _ in parts})), f)
+
+
+def load_namespace(namespace, path):
+    """restore the namespace pickled by save_namespace, runs in the kernel"""
+    import importlib, pickle
+    with open(path, 'rb') as f:
+        saved = pickle.load(f)
+    for name, module in saved['modules'].items():
+        namespace[name] = importlib.import_module(module)
+    for serializer, data in saved['parts']:
+        namespace.update(importlib.import_module(serializer).loads(data))
+
+
+def kernel_code(function, *args):
+    """code running a function of this module in the kernel, without binding names in the notebook namespace"""
+    source = '%s\n%s(globals()[%r], %s)\n' % (inspect.getsource(function), function.__name__, '__namespace__',
+                                               ', '.join(repr(arg) for arg in args))
+    return 'exec(%r, {%r: globals()})' % (source, '__namespace__')
+
+
+class Checkpoint(object):
+    """A saved state of a notebook run, after the code cell ``index``"""
+
+    def __init__(self, path, metadata):
+        self.path = path
+        self.index = metadata['index']
+        self.key = metadata['key']
+        self.created = metadata['created']
+        self.skipped = metadata.get('skipped', [])
+
+    @property
+    def namespace_path(self):
+        return os.path.join(self.path, NAMESPACE_FILENAME)
+
+    def notebook(self):
+        return nbformat.read(os.path.join(self.path, NOTEBOOK_FILENAME), 4)
+
+    def __repr__(self):
+        return 'Checkpoint(%r, index=%r)' % (self.path, self.index)
+
+
+class CheckpointStore(object):
+    """Checkpoints in a local directory, a sub directory per notebook
+
+    Keeps the last ``keep`` checkpoints of a notebook, none older than
+    ``max_age`` seconds.
+    """
+
+    def __init__(self, directory=None, keep=None, max_age=None, interval=None, serializers=None, skip=None):
+        self._directory = directory
+        self._keep = keep
+        self._max_age = max_age
+        self._interval = interval
+        self._serializers = serializers
+        self._skip = skip
+
+    @property
+    def directory(self):
+        # read late, the settings may not be configured when the module is imported
+        if self._directory is None:
+            return get_setting('NOTEBOOKS_CHECKPOINT_DIR') or cache_directory('checkpoints')
+        return self._directory
+
+    @property
+    def keep(self):
+        return get_setting('NOTEBOOKS_CHECKPOINT_KEEP', 3) if self._keep is None else self._keep
+
+    @property
+    def max_age(self):
+        return get_setting('NOTEBOOKS_CHECKPOINT_MAX_AGE', 7 * 24 * 3600) if self._max_age is None else self._max_age
+
+    @property
+    def interval(self):
+        """seconds between two checkpoints of a run, 0 for a checkpoint after every code cell"""
+        return get_setting('NOTEBOOKS_CHECKPOINT_INTERVAL', 0) if self._interval is None else self._interval
+
+    @property
+    def serializers(self):
+        if self._serializers is None:
+            return list(get_setting('NOTEBOOKS_CHECKPOINT_SERIALIZERS', ['cloudpickle', 'dill', 'pickle']))
+        return list(self._serializers)
+
+    @property
+    def skip(self):
+        return sorted(set(SKIP) | set(get_setting('NOTEBOOKS_CHECKPOINT_SKIP', []) if self._skip is None
+                                      else self._skip))
+
+    def notebook_directory(self, notebook_path):
+        notebook_path = os.path.abspath(notebook_path)
+        name = os.path.splitext(os.path.basename(notebook_path))[0]
+        return os.path.join(self.directory, '%s-%s' % (name, source_hash(notebook_path)[:16]))
+
+    def checkpoints(self, notebook_path):
+        """the checkpoints of a notebook, the newest first"""
+        directory = self.notebook_directory(notebook_path)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        checkpoints = []
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                with open(os.path.join(path, METADATA_FILENAME), encoding='utf-8') as f:
+                    checkpoints.append(Checkpoint(path, json.load(f)))
+            except (OSError, ValueError, KeyError):
+                # being written or removed
+                continue
+        checkpoints.sort(key=lambda checkpoint: checkpoint.created, reverse=True)
+        return checkpoints
+
+    def latest(self, notebook_path, nb, kernel_name):
+        """the newest checkpoint of the notebook whose cells up to the checkpoint are unchanged"""
+        keys = cell_keys(nb, kernel_name)
+        for checkpoint in self.checkpoints(notebook_path):
+            if keys.get(checkpoint.index) == checkpoint.key:
+                return checkpoint
+        return None
+
+    def save(self, notebook_path, nb, index, key, write_namespace):
+        """save a checkpoint after the code cell ``index``, write_namespace(path) pickles the namespace"""
+        directory = self.notebook_directory(notebook_path)
+        created = datetime.datetime.now(datetime.timezone.utc)
+        path = os.path.join(directory, '%05d-%d' % (index, time.time_ns()))
+        os.makedirs(path)
+        try:
+            namespace_path = os.path.join(path, NAMESPACE_FILENAME)
+            write_namespace(namespace_path)
+            with open(namespace_path + '.json', encoding='utf-8') as f:
+                skipped = json.load(f)['skipped']
+            with open(os.path.join(path, NOTEBOOK_FILENAME), 'wt') as f:
+                nbformat.write(nb, f)
+            metadata = dict(index=index, key=key, created=created.isoformat(), skipped=skipped)
+            # the metadata is written last, checkpoints without it are ignored
+            with open(os.path.join(path, METADATA_FILENAME), 'w', encoding='utf-8') as f:
+                json.dump(metadata, f)
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        if skipped:
+            logger.info('Checkpoint of %s after cell %d left out %s', notebook_path, index, ', '.join(skipped))
+        self.evict(notebook_path)
+        return Checkpoint(path, metadata)
+
+    def evict(self, notebook_path):
+        """remove the checkpoints beyond the retention limits"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for position, checkpoint in enumerate(self.checkpoints(notebook_path)):
+            age = (now - datetime.datetime.fromisoformat(checkpoint.created)).total_seconds()
+            if position >= self.keep or (self.max_age and age > self.max_age):
+                shutil.rmtree(checkpoint.path, ignore_errors=True)
+
+    def clear(self, notebook_path=None):
+        """remove the checkpoints of a notebook, or of every notebook"""
+        path = self.directory if notebook_path is None else self.notebook_directory(notebook_path)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class Checkpointer(object):
+    """Saves the checkpoints of the run of an ExecutePreprocessor and resumes it
+
+    Wraps the preprocess_cell of the preprocessor like the options of
+    NotebookExecutor. The cells up to a resumed checkpoint get the outputs
+    saved with it, the namespace is restored before the next cell runs.
+    """
+
+    def __init__(self, store, notebook_path, nb, kernel_name, resume=False):
+        self.store = store
+        self.notebook_path = notebook_path
+        self.nb = nb
+        self.keys = cell_keys(nb, kernel_name)
+        self.resumed = store.latest(notebook_path, nb, kernel_name) if resume else None
+        self.restored = False
+        self.saved = time.monotonic()
+
+    def wrap(self, ep):
+        preprocess_cell = ep.preprocess_cell
+
+        def checkpointed(cell, resources, index):
+            if self.resumed is not None and index <= self.resumed.index:
+                return cell, resources
+            if self.resumed is not None and not self.restored:
+                self.run(ep, load_namespace, self.resumed.namespace_path)
+                self.restored = True
+            result = preprocess_cell(cell, resources, index)
+            if index in self.keys and time.monotonic() - self.saved >= self.store.interval:
+                self.save(ep, index)
+            return result
+
+        ep.preprocess_cell = checkpointed
+
+    def resume(self):
+        """copy the outputs of the cells up to the resumed checkpoint, return its index or None"""
+        if self.resumed is None:
+            return None
+        saved = self.resumed.notebook()
+        for index in range(self.resumed.index + 1):
+            self.nb.cells[index] = saved.cells[index]
+        logger.info('Resuming %s after cell %d from %s', self.notebook_path, self.resumed.index, self.resumed.path)
+        if self.resumed.skipped:
+            logger.warning('The checkpoint of %s lacks %s', self.notebook_path, ', '.join(self.resumed.skipped))
+        return self.resumed.index
+
+    def save(self, ep, index):
+        try:
+            self.store.save(self.notebook_path, self.nb, index, self.keys[index],
+                            lambda path: self.run(ep, save_namespace, path, self.store.serializers,
+                                                  self.store.skip))
+        except Exception as e:
+            # the run goes on without the checkpoint
+            logger.warning('Could not checkpoint %s after cell %d: %s', self.notebook_path, index, e)
+        self.saved = time.monotonic()
+
+    def run(self, ep, function, *args):
+        """run a function of this module with the namespace of the kernel, or of the in-process shell"""
+        shell = getattr(ep, 'shell', None)
+        if shell is not None:
+            return function(shell.user_ns, *args)
+        msg_id = ep.kc.execute(kernel_code(function, *args), silent=True, store_history=False)
+        reply = ep.wait_for_reply(msg_id)
+        content = reply['content'] if reply else {}
+        if content.get('status') != 'ok':
+            raise CheckpointError('%s failed in the kernel: %s: %s' % (
+                function.__name__, content.get('ename', 'no reply'), content.get('evalue', '')))
+
+    def finish(self):
+        """remove the checkpoints of a run which executed every cell"""
+        self.store.clear(self.notebook_path)
+
+
+default_store = CheckpointStore()
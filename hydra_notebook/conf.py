@@ -0,0 +1,20 @@
+import os
+
+from django.conf import settings
+
+
+def get_setting(name, default=None):
+    """read an optional hydra-notebook setting
+
+    Notebooks can be imported without a configured Django project,
+    in that case every setting falls back to its default.
+    """
+    if not settings.configured:
+        return default
+    return getattr(settings, name, default)
+
+
+def cache_directory(*parts):
+    """a directory below the user cache directory of hydra-notebook"""
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(root, 'hydra_notebook', *parts)
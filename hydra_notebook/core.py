@@ -1,98 +1,21 @@
-import io, os, sys, types
+import asyncio, io, logging, os, queue, threading, time
 
 import nbformat
-from IPython import get_ipython
 from django.conf import settings
 from nbconvert import ScriptExporter
 from nbconvert.preprocessors import ExecutePreprocessor
 from nbformat import read, NotebookNode
-from IPython.core.interactiveshell import InteractiveShell
 from nbformat import v4 as nbf
 from . import exceptions
+from .catalog import NotebookCatalog
+from .tree import NotebookTree
+from .conf import get_setting
+from .importer import find_notebook, import_notebook, import_many, NotebookLoader, NotebookFinder
+from .limits import KernelLimits, kernel_pid
+from .outputs import OutputCapture, OutputPolicy
+from .selection import select_cells
 
-
-def find_notebook(fullname, path=None):
-    """find a notebook, given its fully qualified name and an optional path
-
-    This turns "foo.bar" into "foo/bar.ipynb"
-    and tries turning "Foo_Bar" into "Foo Bar" if Foo_Bar
-    does not exist.
-    """
-    name = fullname.rsplit('.', 1)[-1]
-    if not path:
-        path = ['']
-    for d in path:
-        nb_path = os.path.join(d, name + ".ipynb")
-        if os.path.isfile(nb_path):
-            return nb_path
-        # let import Notebook_Name find "Notebook Name.ipynb"
-        nb_path = nb_path.replace("_", " ")
-        if os.path.isfile(nb_path):
-            return nb_path
-
-
-class NotebookLoader(object):
-    """Module Loader for Jupyter Notebooks"""
-
-    def __init__(self, path=None):
-        self.shell = InteractiveShell.instance()
-        self.path = path
-
-    def load_module(self, fullname):
-        """import a notebook as a module"""
-        path = find_notebook(fullname, self.path)
-
-        print("importing Jupyter notebook from %s" % path)
-
-        # load the notebook object
-        with io.open(path, 'r', encoding='utf-8') as f:
-            nb = read(f, 4)
-
-        # create the module and add it to sys.modules
-        # if name in sys.modules:
-        #    return sys.modules[name]
-        mod = types.ModuleType(fullname)
-        mod.__file__ = path
-        mod.__loader__ = self
-        mod.__dict__['get_ipython'] = get_ipython
-        sys.modules[fullname] = mod
-
-        # extra work to ensure that magics that would affect the user_ns
-        # actually affect the notebook module's ns
-        save_user_ns = self.shell.user_ns
-        self.shell.user_ns = mod.__dict__
-
-        try:
-            for cell in nb.cells:
-                if cell.cell_type == 'code':
-                    # transform the input to executable Python
-                    code = self.shell.input_transformer_manager.transform_cell(cell.source)
-                    # run the code in themodule
-                    exec(code, mod.__dict__)
-        finally:
-            self.shell.user_ns = save_user_ns
-        return mod
-
-
-class NotebookFinder(object):
-    """Module finder that locates Jupyter Notebooks"""
-
-    def __init__(self):
-        self.loaders = {}
-
-    def find_module(self, fullname, path=None):
-        nb_path = find_notebook(fullname, path)
-        if not nb_path:
-            return
-
-        key = path
-        if path:
-            # lists aren't hashable
-            key = os.path.sep.join(path)
-
-        if key not in self.loaders:
-            self.loaders[key] = NotebookLoader(path)
-        return self.loaders[key]
+logger = logging.getLogger(__name__)
 
 
 class NotebookFileHandler(object):
@@ -123,9 +46,18 @@ class NotebookFileHandler(object):
     def notebook(self, notebook: NotebookNode):
         self.nb = notebook
 
-    def write(self):
-        with open(self.notebook_path, 'wt') as f:
-            nbformat.write(self.nb, f)
+    def write(self, path=None):
+        path = self.notebook_path if path is None else path
+        # readers never see a partially written notebook
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, 'wt') as f:
+                nbformat.write(self.nb, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
 
     def read(self) -> NotebookNode:
         print("reading Jupyter notebook from %s" % self.notebook_path)
@@ -138,14 +70,308 @@ class NotebookFileHandler(object):
 class NotebookExecutor(NotebookFileHandler):
     """Executor that execute notebooks"""
 
-    def __init__(self, fullname, path=None, extension="ipynb", kernel_name='python3', timeout=600):
+    engines = ('kernel', 'forkserver', 'inprocess', 'parallel')
+
+    def __init__(self, fullname, path=None, extension="ipynb", kernel_name='python3', timeout=600, pool=False,
+                 cell_cache=False, engine='kernel', on_cell=None, limits=None, parameters=None, cells=None, tags=None,
+                 target=None, checkpoint=False, resume=False, output_policy=None, spill_dir=None):
         super().__init__(fullname=fullname, path=path, extension=extension)
         self.kernel_name = kernel_name
         self.timeout = timeout
+        # True for the shared kernel pool, or a KernelPool
+        self.pool = pool
+        # True for the default cell output store, or a CellOutputStore
+        self.cell_cache = cell_cache
+        if engine not in self.engines:
+            raise ValueError('Unknown notebook execution engine %r' % engine)
+        if engine != 'kernel' and (pool or cell_cache):
+            raise ValueError('The kernel pool and the cell cache work only with the kernel engine')
+        if cell_cache and (cells is not None or tags or target is not None):
+            raise ValueError('The cell cache works only when every cell is executed')
+        if (checkpoint or resume) and (engine == 'parallel' or cell_cache or cells is not None or tags
+                                       or target is not None):
+            raise ValueError('Checkpoints work only when every cell is executed in order')
+        self.engine = engine
+        # called with the index, the cell and the duration whenever a cell finished, also if it failed
+        self.on_cell = on_cell
+        # a KernelLimits for the kernel process, None for the NOTEBOOKS_KERNEL_* settings
+        self.limits = limits
+        self.applied_limits = None
+        # assigned in a cell after the cell tagged parameters, see hydra_notebook.parameters
+        self.parameters = parameters
+        # a partial execution, see selection.select_cells, the other cells keep their outputs
+        self.cells = cells
+        self.tags = tags
+        self.target = target
+        # True for the default checkpoint store, or a CheckpointStore, resume implies checkpoints
+        self.checkpoint = checkpoint
+        self.resume = resume
+        # an OutputPolicy bounding the outputs kept in memory, None for the NOTEBOOKS_OUTPUT_* settings
+        self.output_policy = output_policy
+        # the side files of the spilled outputs, by default <name>.outputs next to the notebook
+        self.spill_dir = spill_dir
+        self.preprocessor = None
+
+    def create_preprocessor(self):
+        if self.engine == 'forkserver':
+            from .forkserver import ForkServerExecutePreprocessor
+            return ForkServerExecutePreprocessor(timeout=self.timeout, kernel_name=self.kernel_name)
+        if self.engine == 'inprocess':
+            from .inprocess import InProcessExecutePreprocessor
+            return InProcessExecutePreprocessor(timeout=self.timeout, kernel_name=self.kernel_name)
+        if self.engine == 'parallel':
+            from .parallel import ParallelExecutePreprocessor
+            return ParallelExecutePreprocessor(timeout=self.timeout, kernel_name=self.kernel_name)
+        if not self.cell_cache:
+            return ExecutePreprocessor(timeout=self.timeout, kernel_name=self.kernel_name)
+        from .cellcache import CachingExecutePreprocessor
+        store = None if self.cell_cache is True else self.cell_cache
+        return CachingExecutePreprocessor(store=store, timeout=self.timeout, kernel_name=self.kernel_name)
+
+    def _observe(self, ep):
+        preprocess_cell, on_cell = ep.preprocess_cell, self.on_cell
+
+        def observed(cell, resources, index):
+            start = time.perf_counter()
+            try:
+                return preprocess_cell(cell, resources, index)
+            finally:
+                if cell.cell_type == 'code':
+                    on_cell(index, cell, time.perf_counter() - start)
+
+        # wraps the cell hook of every engine, the cached and setup cells report too
+        ep.preprocess_cell = observed
+
+    def _limit(self, ep, limits):
+        on_notebook_start = ep.on_notebook_start
+
+        def limit(**kwargs):
+            pid = kernel_pid(ep.km)
+            if pid is not None:
+                self.applied_limits = limits.apply(pid)
+            if on_notebook_start is not None:
+                return on_notebook_start(**kwargs)
+
+        # nbclient calls the hook once the kernel is up, before the first cell
+        ep.on_notebook_start = limit
+
+    def prepare(self):
+        """inject the parameters, return the indexes of the code cells to execute, None for every cell"""
+        if self.parameters is None:
+            return select_cells(self.nb, self.cells, self.tags, self.target)
+        from .parameters import inject_parameters, remove_parameters
+        # the indexes of the selection are those of the notebook without the parameters
+        remove_parameters(self.nb)
+        selected = select_cells(self.nb, self.cells, self.tags, self.target)
+        injected = inject_parameters(self.nb, self.parameters)
+        if selected is not None:
+            position = next(index for index, cell in enumerate(self.nb.cells) if cell is injected)
+            selected = sorted([index + (index >= position) for index in selected] + [position])
+        return selected
+
+    def _capture(self, ep, policy):
+        spill_dir = self.spill_dir or os.path.join(self.path, '%s.outputs' % self.fullname)
+        capture = OutputCapture(policy, spill_dir, notebook_dir=os.path.dirname(spill_dir))
+        if capture.spills:
+            capture.clean()
+        preprocess_cell = ep.preprocess_cell
+
+        def captured(cell, resources, index):
+            try:
+                return preprocess_cell(cell, resources, index)
+            finally:
+                capture.finish(cell, index)
+
+        from .cellcache import CachingExecutePreprocessor
+        if isinstance(ep, CachingExecutePreprocessor):
+            # it bounds the restored outputs and finishes the outputs before storing them
+            ep.capture = capture
+        else:
+            ep.preprocess_cell = captured
+        if hasattr(ep, 'output_capture'):
+            # the in-process shell records the outputs itself
+            ep.output_capture = capture
+            return
+        output, clear_output = ep.output, ep.clear_output
+
+        def bounded_output(outs, msg, display_id, cell_index):
+            if ep.clear_before_next_output:
+                capture.cleared(cell_index)
+            out = output(outs, msg, display_id, cell_index)
+            if out is not None and outs and outs[-1] is out:
+                outs.pop()
+                capture.add(outs, out, cell_index)
+            return out
+
+        def bounded_clear_output(outs, msg, cell_index):
+            clear_output(outs, msg, cell_index)
+            if not outs:
+                capture.cleared(cell_index)
+
+        # nbclient appends every output message to the cell
+        ep.output, ep.clear_output = bounded_output, bounded_clear_output
+
+    def _checkpointer(self, ep):
+        from .checkpoint import Checkpointer, default_store
+        store = default_store if isinstance(self.checkpoint, bool) else self.checkpoint
+        checkpointer = Checkpointer(store, self.notebook_path, self.nb, self.kernel_name, resume=self.resume)
+        checkpointer.resume()
+        # innermost, the resumed cells report to on_cell with their saved outputs
+        checkpointer.wrap(ep)
+        return checkpointer
+
+    @staticmethod
+    def _select(ep, selected):
+        preprocess_cell, selected = ep.preprocess_cell, frozenset(selected)
+
+        def partial(cell, resources, index):
+            if index not in selected:
+                return cell, resources
+            return preprocess_cell(cell, resources, index)
+
+        ep.preprocess_cell = partial
 
     def __call__(self, *args, **kwargs):
-        ep = ExecutePreprocessor(timeout=self.timeout, kernel_name=self.kernel_name)
-        ep.preprocess(self.nb, {'metadata': {'path': '%s/' % self.path}})
+        selected = self.prepare()
+        ep = self.preprocessor = self.create_preprocessor()
+        policy = OutputPolicy.from_settings() if self.output_policy is None else self.output_policy
+        if policy:
+            self._capture(ep, policy)
+        checkpointer = self._checkpointer(ep) if self.checkpoint or self.resume else None
+        if self.on_cell is not None:
+            self._observe(ep)
+        if selected is not None:
+            self._select(ep, selected)
+        limits = KernelLimits.from_settings() if self.limits is None else self.limits
+        if limits and self.engine not in ('inprocess', 'parallel'):
+            # the kernels of the pool outlive the run, they are limited by rlimits only
+            self._limit(ep, KernelLimits(limits.cpu_time, limits.memory) if self.pool else limits)
+        resources = {'metadata': {'path': '%s/' % self.path}}
+        try:
+            if not self.pool:
+                ep.preprocess(self.nb, resources)
+            else:
+                self._preprocess_pooled(ep, resources)
+            if checkpointer is not None:
+                checkpointer.finish()
+        finally:
+            if self.applied_limits is not None:
+                self.applied_limits.close()
+                self.applied_limits = None
+
+    def _preprocess_pooled(self, ep, resources):
+        from .kernels import pool as default_pool
+        pool = default_pool if self.pool is True else self.pool
+        with pool.kernel(self.kernel_name, cwd=self.path) as km:
+            try:
+                ep.preprocess(self.nb, resources, km=km)
+            finally:
+                # the client of a kernel passed in is left open by nbclient
+                if ep.kc is not None:
+                    ep.kc.stop_channels()
+                if self.applied_limits is not None:
+                    self.applied_limits.restore()
+
+    def stream(self, finished=None, stop_timeout=10):
+        """execute the notebook in a thread and yield an event as soon as each code cell finished
+
+        Yields a ``start`` event, a ``cell`` event with the outputs, execution
+        count and timing of every code cell, and a final ``done`` event. The
+        execution is killed if the consumer stops iterating early.
+        ``finished`` is called once the notebook is no longer changed: when
+        the iteration stops, or by the thread when the killed execution did
+        not stop within ``stop_timeout`` seconds.
+        """
+        events = queue.Queue()
+        on_cell = self.on_cell
+        lock = threading.Lock()
+        state = dict(stopped=False, handed=False)
+
+        def cell_finished(index, cell, duration):
+            if on_cell is not None:
+                on_cell(index, cell, duration)
+            events.put(dict(event='cell', index=index, execution_count=cell.get('execution_count'),
+                            outputs=cell.get('outputs', []), execution=cell.metadata.get('execution', {}),
+                            duration=duration,
+                            status='error' if any(o.output_type == 'error' for o in cell.get('outputs', []))
+                            else 'ok'))
+
+        def run():
+            start = time.perf_counter()
+            done = dict(event='done', status='ok', error=None)
+            try:
+                self()
+            except Exception as e:
+                done.update(status='error', error='%s: %s' % (getattr(e, 'ename', type(e).__name__),
+                                                              getattr(e, 'evalue', e)))
+            finally:
+                done['duration'] = time.perf_counter() - start
+                events.put(done)
+                with lock:
+                    state['stopped'] = True
+                    handed = state['handed']
+                if handed:
+                    try:
+                        finished()
+                    except Exception:
+                        logger.exception('Finishing the stream of notebook %s failed', self.fullname)
+
+        self.on_cell = cell_finished
+        thread = threading.Thread(target=run, name='notebook-stream-%s' % self.fullname, daemon=True)
+        try:
+            selected = self.prepare()
+            yield dict(event='start', notebook=self.fullname,
+                       cells=sum(1 for cell in self.nb.cells if cell.cell_type == 'code') if selected is None
+                       else len(selected))
+            thread.start()
+            while True:
+                event = events.get()
+                yield event
+                if event['event'] == 'done':
+                    break
+        finally:
+            self.on_cell = on_cell
+            if thread.is_alive():
+                self.kill()
+                thread.join(stop_timeout)
+            if finished is not None:
+                with lock:
+                    # a thread not started does not change the notebook
+                    stopped = state['stopped'] or thread.ident is None
+                    state['handed'] = not stopped
+                if stopped:
+                    finished()
+                else:
+                    logger.warning('Notebook %s did not stop within %ss, it is finished by its thread',
+                                   self.fullname, stop_timeout)
+
+    async def astream(self):
+        """async iterator over the events of stream()"""
+        loop = asyncio.get_running_loop()
+        events = self.stream()
+        try:
+            while True:
+                event = await loop.run_in_executor(None, next, events, None)
+                if event is None:
+                    break
+                yield event
+        finally:
+            events.close()
+
+    def kill(self):
+        """kill the kernel of a running execution, the execution fails with a DeadKernelError
+
+        In-process executions are interrupted, they fail with a CellInterrupted.
+        """
+        km = getattr(self.preprocessor, 'km', None)
+        process = getattr(getattr(km, 'provisioner', None), 'process', None)
+        if process is not None:
+            process.kill()
+        elif getattr(km, 'pid', None) is not None:
+            # forked kernels are not children of this process
+            km.shutdown_kernel(now=True)
+        elif hasattr(self.preprocessor, 'interrupt'):
+            self.preprocessor.interrupt()
 
 
 class NotebookBuilder():
@@ -187,7 +413,12 @@ class NotebookFileManager():
 
     @classmethod
     def create(cls, root=None):
-        cls._instance = cls(settings.NOTEBOOKS_ROOT if root is None else root)
+        root = settings.NOTEBOOKS_ROOT if root is None else root
+        # the manager of the same root is shared, with its catalog
+        if cls._instance is None or cls._instance.root != root:
+            if cls._instance is not None:
+                cls._instance._catalog.stop()
+            cls._instance = cls(root)
         return cls._instance
 
     @classmethod
@@ -196,29 +427,39 @@ class NotebookFileManager():
 
     def __init__(self, root) -> None:
         self.root = root
+        self._catalog = NotebookCatalog(root)
+        # the notebooks of the sub directories, the catalog has the top level only
+        self.tree = NotebookTree(root)
 
     @property
-    def _files(self):
-        return os.listdir(self.root)
+    def catalog(self):
+        # the watcher starts with the first lookup, processes which never list notebooks run no thread
+        if get_setting('NOTEBOOKS_CATALOG_WATCH', True) and not self._catalog.watching:
+            self._catalog.start()
+        return self._catalog
 
     def all(self):
-        notebooks = [NotebookFileModel(filename=file) for file in self._files]
-        return notebooks
+        return [NotebookFileModel(filename=entry.filename, entry=entry) for entry in self.catalog.all()]
 
     def get(self, name) -> 'NotebookFileModel':
         if name is None:
             raise Exception('Notebook name is required.')
-        try:
-            matched = [f for f in self._files if f.startswith(name)]
-            return NotebookFileModel(filename=matched[0])
-        except BaseException as e:
-            raise exceptions.NotebookNotFindException(name, e)
+        entry = self.catalog.get(name)
+        if entry is None:
+            # the first notebook whose name starts with name
+            matched = self.catalog.prefix(name)
+            if not matched:
+                raise exceptions.NotebookNotFindException(name)
+            entry = matched[0]
+        return NotebookFileModel(filename=entry.filename, entry=entry)
 
 class NotebookFileModel:
 
-    def __init__(self, filename=None, name=None, extension=None):
+    def __init__(self, filename=None, name=None, extension=None, entry=None):
         self.name = os.path.splitext(filename)[0] if name is None else name
         self.extension = os.path.splitext(filename)[1] if extension is None else extension
+        # the catalog.CatalogEntry of the notebook, for the listings
+        self.entry = entry
         self._notebook = None
         self._script = None
 
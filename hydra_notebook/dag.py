@@ -0,0 +1,153 @@
+"""Dependency graph of the code cells of a notebook
+
+A cell depends on the earlier cells binding the names it reads, on the
+earlier cells reading or binding the names it binds (the notebook order
+decides which value a name ends up with) and on the earlier cells
+mutating an object it uses. A name counts as mutated by assignments to
+its items or attributes, ``del`` of them, calls of the usual in-place
+methods (``append``, ``update``, ...) and calls with ``inplace=True``.
+Other in-place changes are not detected, tag such cells ``sequential``.
+Cells with magics, star imports, syntax errors and sequential cells run
+after all earlier cells and before all later ones.
+"""
+import ast
+
+from .analysis import _nested, has_star_import, loaded_names, stored_names
+from .cache import transform_cell
+from .selection import cell_tags
+
+SEQUENTIAL_TAG = 'sequential'
+
+MUTATING_METHODS = frozenset([
+    'append', 'extend', 'insert', 'pop', 'popitem', 'remove', 'clear', 'update', 'add', 'discard', 'setdefault',
+    'sort', 'reverse', 'fill', 'resize', 'put', 'itemset', 'drop_duplicates', 'fillna', 'set_index', 'reset_index',
+])
+
+
+def _base_name(node):
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred)):
+        node = node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def _targets(node):
+    if isinstance(node, (ast.Tuple, ast.List)):
+        for element in node.elts:
+            yield from _targets(element)
+    else:
+        yield node
+
+
+def _changes_in_place(call):
+    if not isinstance(call.func, ast.Attribute):
+        return False
+    return call.func.attr in MUTATING_METHODS or any(
+        keyword.arg == 'inplace' and isinstance(keyword.value, ast.Constant) and keyword.value.value is True
+        for keyword in call.keywords)
+
+
+def mutated_names(tree):
+    """names of objects a cell may change in place"""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if _changes_in_place(node):
+                names.add(_base_name(node.func.value))
+            continue
+        if isinstance(node, (ast.Assign, ast.Delete)):
+            targets = node.targets
+        elif isinstance(node, (ast.AugAssign, ast.AnnAssign)):
+            targets = [node.target]
+        else:
+            continue
+        for target in targets:
+            for element in _targets(target):
+                if isinstance(element, (ast.Attribute, ast.Subscript)):
+                    names.add(_base_name(element))
+    names.discard(None)
+    return names
+
+
+def deferred_names(code):
+    """names read by the functions and classes a compiled cell defines, when they are called"""
+    names = set()
+    for inner in _nested(code):
+        names.update(loaded_names(inner))
+    return names
+
+
+class CellNode(object):
+    """The names a code cell binds, reads and mutates
+
+    ``deferred`` are the names read by the functions and classes the cell
+    defines, they are read when they are called.
+    """
+
+    def __init__(self, index, source, tags=()):
+        self.index = index
+        self.sequential = SEQUENTIAL_TAG in tags
+        self.stored, self.loaded, self.mutated, self.deferred = set(), set(), set(), set()
+        try:
+            tree = ast.parse(transform_cell(source))
+            code = compile(tree, '<cell>', 'exec')
+        except SyntaxError:
+            self.sequential = True
+            return
+        self.stored = stored_names(code)
+        self.loaded = loaded_names(code)
+        self.mutated = mutated_names(tree) & self.loaded
+        self.deferred = deferred_names(code)
+        if 'get_ipython' in self.loaded or has_star_import(code):
+            self.sequential = True
+
+
+def cell_graph(nb, nodes=None):
+    """the indexes of the earlier code cells every code cell depends on, by cell index
+
+    ``nodes`` collects the CellNode of every code cell by cell index.
+    """
+    graph, writers, readers = {}, {}, {}
+    nodes = {} if nodes is None else nodes
+    barrier = None
+    for index, cell in enumerate(nb.cells):
+        if cell.cell_type != 'code':
+            continue
+        node = nodes[index] = CellNode(index, cell.source, cell_tags(cell))
+        if node.sequential:
+            dependencies = set(graph)
+        else:
+            dependencies = set() if barrier is None else {barrier}
+            # the names read by the functions the cell calls are read too
+            loaded, pending = set(), list(node.loaded)
+            while pending:
+                name = pending.pop()
+                if name not in loaded:
+                    loaded.add(name)
+                    if name in writers:
+                        dependencies.add(writers[name])
+                        pending.extend(nodes[writers[name]].deferred)
+            for name in node.stored | node.mutated:
+                if name in writers:
+                    dependencies.add(writers[name])
+                dependencies.update(readers.get(name, ()))
+            node.loaded = loaded
+        if node.sequential:
+            # every later cell runs after this one, which runs after every earlier one
+            barrier, writers, readers = index, {}, {}
+        else:
+            # a mutation is a write of the name for the later cells
+            for name in node.loaded - node.stored - node.mutated:
+                readers.setdefault(name, set()).add(index)
+            for name in node.stored | node.mutated:
+                writers[name] = index
+                readers[name] = set()
+        graph[index] = dependencies
+    return graph
+
+
+def critical_path(graph):
+    """the number of cells on the longest chain of dependencies"""
+    depth = {}
+    for index in sorted(graph):
+        depth[index] = 1 + max((depth[dependency] for dependency in graph[index]), default=0)
+    return max(depth.values(), default=0)
@@ -0,0 +1,205 @@
+"""Notebook execution queue in the database
+
+Workers on any number of machines sharing NOTEBOOKS_ROOT and the database
+claim jobs with a conditional UPDATE, which only one of them can win, and
+own a running job as long as they extend its lease with heartbeats. The
+jobs of a worker that died are queued again when the lease expired, until
+a job used up its attempts. The queue has the interface of
+hydra_notebook.jobs.JobQueue, the jobs are dicts, so JobWorker runs it.
+"""
+import datetime
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+
+from django.db import connection, connections
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .conf import cache_directory, get_setting
+from .jobs import clean_streams, retention_cutoff
+from .scheduler import PRIORITIES, RunHistory, Scheduler
+from .models import NotebookJob
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def as_dict(job):
+    return dict(id=str(job.pk), notebook=job.notebook, options=job.options, priority=job.priority,
+                tenant=job.tenant, status=job.status,
+                created=_isoformat(job.created), started=_isoformat(job.started), finished=_isoformat(job.finished),
+                worker=job.worker or None, heartbeat=_isoformat(job.heartbeat), attempts=job.attempts,
+                progress=dict(cells=job.cells, done=job.cells_done), error=job.error or None)
+
+
+class DatabaseJobQueue(object):
+    """Queue of notebook execution jobs in the NotebookJob table
+
+    ``lease`` is the number of seconds a running job stays owned by its
+    worker without a heartbeat, heartbeats are sent every third of it.
+    """
+
+    def __init__(self, directory=None, lease=None, max_attempts=None, worker=None):
+        self._directory = directory
+        self.lease = get_setting('NOTEBOOKS_JOB_LEASE', 60) if lease is None else lease
+        self.max_attempts = get_setting('NOTEBOOKS_JOB_MAX_ATTEMPTS', 3) if max_attempts is None else max_attempts
+        self.worker = worker_name() if worker is None else worker
+        self.heartbeat_interval = self.lease / 3.0
+        self.submitted = threading.Condition()
+        self._recovered = None
+        self._histories = {}
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            return get_setting('NOTEBOOKS_JOBS_DIR') or cache_directory('jobs')
+        return self._directory
+
+    @property
+    def history(self):
+        """past run durations of the notebooks, shared by the workers through NOTEBOOKS_JOBS_DIR"""
+        path = os.path.join(self.directory, 'history.json')
+        if path not in self._histories:
+            self._histories[path] = RunHistory(path)
+        return self._histories[path]
+
+    @property
+    def scheduler(self):
+        return Scheduler(self.history)
+
+    def result_dir(self, job_id):
+        return os.path.join(self.directory, 'results', job_id)
+
+    def result_path(self, job):
+        return os.path.join(self.result_dir(job['id']), job['notebook'] + '.ipynb')
+
+    def _expires(self):
+        return timezone.now() + datetime.timedelta(seconds=self.lease)
+
+    def submit(self, notebook, priority='default', tenant=None, **options):
+        """queue an execution of a notebook under NOTEBOOKS_ROOT, return the job"""
+        if priority not in PRIORITIES:
+            raise ValueError('Unknown job priority %r' % priority)
+        job = NotebookJob.objects.create(notebook=notebook, options=options, priority=priority, tenant=tenant,
+                                         max_attempts=self.max_attempts)
+        with self.submitted:
+            self.submitted.notify_all()
+        return as_dict(job)
+
+    def get(self, job_id):
+        """the job record, None for an unknown job"""
+        try:
+            return as_dict(NotebookJob.objects.get(pk=int(job_id)))
+        except (ValueError, NotebookJob.DoesNotExist):
+            return None
+
+    def jobs(self, state):
+        statuses = [NotebookJob.FINISHED, NotebookJob.FAILED] if state == 'done' else [state]
+        return [str(pk) for pk in NotebookJob.objects.filter(status__in=statuses).values_list('pk', flat=True)]
+
+    def recent(self, limit=1000):
+        """the last finished jobs"""
+        done = NotebookJob.objects.filter(status__in=[NotebookJob.FINISHED, NotebookJob.FAILED])
+        return [as_dict(job) for job in reversed(done.order_by('-finished')[:limit])]
+
+    def claim(self):
+        """mark the first queued job of the scheduler as running by this worker and return it
+
+        The scheduler sees the oldest NOTEBOOKS_SCHEDULER_WINDOW queued jobs,
+        None is returned if the queue is empty.
+        """
+        if self._recovered is None or time.monotonic() - self._recovered > self.heartbeat_interval:
+            self.recover()
+        window = get_setting('NOTEBOOKS_SCHEDULER_WINDOW', 1000)
+        while True:
+            queued = [as_dict(job) for job in NotebookJob.objects.filter(status=NotebookJob.QUEUED)[:window]]
+            if not queued:
+                return None
+            running = [dict(tenant=tenant) for tenant in
+                       NotebookJob.objects.filter(status=NotebookJob.RUNNING).values_list('tenant', flat=True)]
+            for job in self.scheduler.order(queued, running):
+                pk = int(job['id'])
+                now = timezone.now()
+                claimed = NotebookJob.objects.filter(pk=pk, status=NotebookJob.QUEUED).update(
+                    status=NotebookJob.RUNNING, worker=self.worker, started=now, heartbeat=now,
+                    lease_expires=self._expires(), attempts=F('attempts') + 1, cells=None, cells_done=0)
+                if claimed:
+                    return as_dict(NotebookJob.objects.get(pk=pk))
+            # other workers were faster for all of them
+
+    def _owned(self, job):
+        return NotebookJob.objects.filter(pk=int(job['id']), status=NotebookJob.RUNNING, worker=self.worker)
+
+    def heartbeat(self, job):
+        """extend the lease of a running job, False if the worker lost it"""
+        now = timezone.now()
+        return bool(self._owned(job).update(heartbeat=now, lease_expires=self._expires()))
+
+    def update(self, job):
+        now = timezone.now()
+        return bool(self._owned(job).update(heartbeat=now, lease_expires=self._expires(),
+                                            cells=job['progress']['cells'], cells_done=job['progress']['done']))
+
+    def finish(self, job, error=None):
+        job.update(status=NotebookJob.FAILED if error else NotebookJob.FINISHED, error=error)
+        now = timezone.now()
+        if not self._owned(job).update(status=job['status'], finished=now, lease_expires=None, error=error or '',
+                                       cells_done=job['progress']['done']):
+            logger.warning('Notebook job %s was taken over by another worker, its result is dropped', job['id'])
+        job['finished'] = now.isoformat()
+        return job
+
+    def recover(self):
+        """queue the running jobs with expired leases again, fail those without attempts left"""
+        self._recovered = time.monotonic()
+        expired = NotebookJob.objects.filter(status=NotebookJob.RUNNING, lease_expires__lt=timezone.now())
+        expired.filter(attempts__gte=F('max_attempts')).update(
+            status=NotebookJob.FAILED, finished=timezone.now(), lease_expires=None,
+            error='WorkerLost: the worker of the last attempt stopped sending heartbeats')
+        ids = list(expired.values_list('pk', flat=True))
+        # the lease condition again, a late heartbeat keeps the job
+        NotebookJob.objects.filter(pk__in=ids, status=NotebookJob.RUNNING, lease_expires__lt=timezone.now()).update(
+            status=NotebookJob.QUEUED, worker='', started=None, heartbeat=None, lease_expires=None)
+        return [str(pk) for pk in ids]
+
+    def statistics(self):
+        counts = dict(NotebookJob.objects.order_by().values_list('status').annotate(count=Count('pk')))
+        return dict(queued=counts.get(NotebookJob.QUEUED, 0), running=counts.get(NotebookJob.RUNNING, 0),
+                    done=counts.get(NotebookJob.FINISHED, 0) + counts.get(NotebookJob.FAILED, 0))
+
+    def close_old_connections(self):
+        """close the connections of the current thread which outlived CONN_MAX_AGE or broke, like a request does"""
+        for conn in connections.all():
+            # a transaction of the caller, e.g. run_once() in an atomic block, keeps its connection
+            if not conn.in_atomic_block:
+                conn.close_if_unusable_or_obsolete()
+
+    def close_connection(self):
+        connection.close()
+
+    def clean(self, max_age=None, keep=None):
+        """remove the finished jobs older than max_age seconds or beyond the last ``keep``, with their notebooks"""
+        cutoff = retention_cutoff(max_age)
+        done = NotebookJob.objects.filter(status__in=[NotebookJob.FINISHED, NotebookJob.FAILED])
+        ids = set()
+        if keep is not None:
+            ids.update(done.order_by('-finished').values_list('pk', flat=True)[keep:])
+        if cutoff is not None:
+            ids.update(done.filter(finished__lt=datetime.datetime.fromtimestamp(cutoff, datetime.timezone.utc))
+                       .values_list('pk', flat=True))
+            clean_streams(self.directory, cutoff)
+        NotebookJob.objects.filter(pk__in=ids).delete()
+        for pk in ids:
+            shutil.rmtree(self.result_dir(str(pk)), ignore_errors=True)
+        return len(ids)
@@ -1,4 +1,11 @@
 #python
 
 class NotebookNotFindException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class NotebookImportCycleError(ImportError):
+    """notebooks imported together depend on each other in a cycle"""
+
+    def __init__(self, cycle):
+        super().__init__('Notebook import cycle: %s' % ' -> '.join(cycle))
+        self.cycle = cycle
@@ -0,0 +1,262 @@
+"""Fork server for notebook execution
+
+A template process runs the setup cells of a notebook once, in an
+InteractiveShell (magics, shell escapes and displays work like in a
+kernel), and imports ipykernel. Every execution forks the template and
+starts a kernel in the child on the namespace of the setup cells, the
+child shares the memory of the template copy-on-write. Linux only, the
+kernels run the python of this process: other kernel names are executed
+without a template.
+
+The template is started as ``python -m hydra_notebook.forkserver`` and
+talks json lines over its stdin and stdout.
+"""
+import atexit
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+import nbformat
+from jupyter_client.manager import KernelManager
+from nbconvert.preprocessors import ExecutePreprocessor
+
+from .cache import source_hash
+from .selection import cell_tags
+
+logger = logging.getLogger(__name__)
+
+SETUP_TAG = 'setup'
+# the kernel forked from a template, which runs sys.executable
+KERNEL_NAME = 'python3'
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ForkServerError(RuntimeError):
+    """the template process failed to run the setup cells or to fork"""
+
+
+def setup_cells(nb, tag=SETUP_TAG):
+    """notebook indexes of the leading code cells tagged as setup"""
+    indexes = []
+    for index, cell in enumerate(nb.cells):
+        if cell.cell_type != 'code':
+            continue
+        if tag not in cell_tags(cell):
+            break
+        indexes.append(index)
+    return indexes
+
+
+class ForkedKernelManager(KernelManager):
+    """KernelManager of a kernel forked by a template process
+
+    The kernel is not a child of this process, it is signalled by its pid.
+    """
+
+    def __init__(self, pid=None, **kwargs):
+        super().__init__(**kwargs)
+        self.pid = pid
+
+    @property
+    def has_kernel(self):
+        return self.pid is not None
+
+    def is_alive(self):
+        if self.pid is None:
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def signal_kernel(self, signum):
+        if self.is_alive():
+            os.kill(self.pid, signum)
+
+    def interrupt_kernel(self):
+        self.signal_kernel(signal.SIGINT)
+
+    def shutdown_kernel(self, now=False, restart=False):
+        self.signal_kernel(signal.SIGKILL)
+        self.pid = None
+        self.cleanup_resources(restart=restart)
+
+
+class ForkServer(object):
+    """Template process which ran the setup cells, forks a kernel per execution"""
+
+    def __init__(self, sources, cwd=None):
+        self.sources = list(sources)
+        self.cwd = cwd
+        self._lock = threading.Lock()
+        self.outputs = None
+        self.forks = 0
+        # the template runs in the notebook directory, hydra_notebook must stay importable
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [PACKAGE_ROOT, env.get('PYTHONPATH')]))
+        self.process = subprocess.Popen([sys.executable, '-m', 'hydra_notebook.forkserver'], cwd=cwd, env=env,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        reply = self._request(dict(cells=self.sources))
+        if reply['status'] != 'ok':
+            self.close()
+            raise ForkServerError('Setup cell %d failed: %s: %s' % (reply['index'], reply['ename'], reply['evalue']))
+        # the nbformat outputs of every setup cell
+        self.outputs = reply['outputs']
+
+    def _request(self, message):
+        with self._lock:
+            if self.process.poll() is not None:
+                raise ForkServerError('The fork server exited with %s' % self.process.returncode)
+            self.process.stdin.write(json.dumps(message) + '\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        if not line:
+            raise ForkServerError('The fork server exited with %s' % self.process.wait())
+        return json.loads(line)
+
+    def fork(self, kernel_name=KERNEL_NAME):
+        """fork a kernel from the template, return its started ForkedKernelManager"""
+        km = ForkedKernelManager(kernel_name=kernel_name)
+        km.write_connection_file()
+        reply = self._request(dict(fork=km.connection_file))
+        km.pid = reply['pid']
+        self.forks += 1
+        return km
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stdout.close()
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def get_server(sources, cwd=None):
+    """the shared fork server of a setup prefix, started on first use"""
+    key = (source_hash('\0'.join(sources)), os.path.abspath(cwd or os.getcwd()))
+    with _servers_lock:
+        server = _servers.get(key)
+        if server is None or server.process.poll() is not None:
+            server = _servers[key] = ForkServer(sources, cwd=cwd)
+        return server
+
+
+def close_servers():
+    with _servers_lock:
+        for server in _servers.values():
+            server.close()
+        _servers.clear()
+
+
+atexit.register(close_servers)
+
+
+class ForkServerExecutePreprocessor(ExecutePreprocessor):
+    """ExecutePreprocessor which runs the cells after the setup prefix in a forked kernel
+
+    The setup cells are not executed again, their outputs are those they
+    produced in the template process. Notebooks of other kernels than
+    KERNEL_NAME run in a kernel of their own.
+    """
+
+    def __init__(self, setup_tag=SETUP_TAG, **kwargs):
+        super().__init__(**kwargs)
+        self.setup_tag = setup_tag
+        self.setup = []
+        self.server = None
+
+    def preprocess(self, nb, resources=None, km=None):
+        self.setup = setup_cells(nb, self.setup_tag)
+        if self.setup and self.kernel_name != KERNEL_NAME:
+            logger.info('Kernel %s is not forked from a template, the setup cells run in the kernel', self.kernel_name)
+        if not self.setup or km is not None or self.kernel_name != KERNEL_NAME:
+            self.setup = []
+            return super().preprocess(nb, resources, km=km)
+        path = (resources or {}).get('metadata', {}).get('path')
+        self.server = get_server([nb.cells[index].source for index in self.setup], cwd=path)
+        km = self.server.fork(self.kernel_name)
+        try:
+            return super().preprocess(nb, resources, km=km)
+        finally:
+            if self.kc is not None:
+                self.kc.stop_channels()
+            km.shutdown_kernel(now=True)
+
+    def preprocess_cell(self, cell, resources, index):
+        if index not in self.setup:
+            return super().preprocess_cell(cell, resources, index)
+        cell.outputs = [nbformat.from_dict(output) for output in self.server.outputs[self.setup.index(index)]]
+        cell.execution_count = None
+        return cell, resources
+
+
+def _run_setup(sources, shell):
+    from .inprocess import running
+    outputs = []
+    for index, source in enumerate(sources):
+        shell.outputs, shell.displays, shell.error = [], {}, None
+        with running(shell):
+            shell.run_cell(source, store_history=False)
+        if shell.error is not None:
+            return dict(status='error', index=index, ename=shell.error.ename, evalue=shell.error.evalue)
+        outputs.append(shell.outputs)
+    return dict(status='ok', outputs=outputs)
+
+
+def _start_kernel(connection_file, namespace, channel):
+    """body of a forked child, never returns"""
+    try:
+        os.setsid()
+        channel.close()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 0)
+        os.dup2(devnull, 1)
+        from ipykernel.kernelapp import IPKernelApp
+        app = IPKernelApp.instance(connection_file=connection_file, user_ns=namespace)
+        app.initialize([])
+        app.start()
+    finally:
+        os._exit(0)
+
+
+def main():
+    from ipykernel import kernelapp  # noqa: F401 imported once in the template, shared by the forks
+    # the forked kernels are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    # replies go to a private copy of stdout, whatever the setup cells write to fd 1 ends up on stderr
+    channel = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    from .inprocess import new_shell, route_outputs
+    route_outputs()
+    shell = new_shell()
+    for line in sys.stdin:
+        message = json.loads(line)
+        if 'cells' in message:
+            reply = _run_setup(message['cells'], shell)
+            # the kernel binds its own get_ipython, In, Out ...
+            hidden = shell.user_ns_hidden
+            namespace = {name: value for name, value in shell.user_ns.items()
+                         if name not in hidden or hidden[name] is not value}
+        else:
+            pid = os.fork()
+            if pid == 0:
+                _start_kernel(message['fork'], namespace, channel)
+            reply = dict(pid=pid)
+        channel.write(json.dumps(reply) + '\n')
+        channel.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,443 @@
+import collections
+import concurrent.futures
+import fnmatch
+import importlib
+import importlib.machinery
+import importlib.util
+import os
+import sys
+import threading
+import time
+
+from . import exceptions
+from .analysis import imported_modules
+from .cache import NotebookCodeCache
+from .conf import get_setting
+from .lazy import LazyNotebookModule
+from .listing import DirectoryListingCache
+from .registry import registry
+from .selection import CellPolicy
+from .state import NotebookState
+
+
+# the notebook run as the body of a notebook package, like the __init__.py of a package
+PACKAGE_INIT = '__init__.ipynb'
+
+
+def _notebook_filenames(name):
+    yield name + ".ipynb"
+    # let import Notebook_Name find "Notebook Name.ipynb"
+    yield name.replace("_", " ") + ".ipynb"
+
+
+def find_notebook(fullname, path=None):
+    """find a notebook, given its fully qualified name and an optional path
+
+    This turns "foo.bar" into "foo/bar.ipynb", or "foo/bar/__init__.ipynb"
+    if bar is a notebook package, and tries turning "Foo_Bar" into "Foo Bar"
+    if Foo_Bar does not exist. The path is the __path__ of the parent
+    package, the directories of "foo" for "foo.bar".
+    """
+    name = fullname.rsplit('.', 1)[-1]
+    if not path:
+        path = ['']
+    for d in path:
+        nb_path = os.path.join(d, name, PACKAGE_INIT)
+        if os.path.isfile(nb_path):
+            return nb_path
+        for filename in _notebook_filenames(name):
+            nb_path = os.path.join(d, filename)
+            if os.path.isfile(nb_path):
+                return nb_path
+
+
+def is_package_init(nb_path):
+    return os.path.basename(nb_path) == PACKAGE_INIT
+
+
+# magics work on the user_ns of the process-wide shell, cells which need it run one at a time
+_shell_lock = threading.RLock()
+
+# per-import options of the notebooks being imported by import_notebook in this thread
+_import_options = threading.local()
+
+
+def get_ipython():
+    """IPython.get_ipython, without importing IPython until a notebook really calls it"""
+    from IPython import get_ipython
+    return get_ipython()
+
+
+class NotebookLoader(object):
+    """Module Loader for Jupyter Notebooks
+
+    Pure python cells are compiled and run without IPython, the
+    InteractiveShell is created only when a cell uses magics, shell
+    escapes or get_ipython().
+    """
+
+    def __init__(self, path=None, cache=None, lazy=None, policy=None):
+        self._shell = None
+        self.path = path
+        self.cache = NotebookCodeCache() if cache is None else cache
+        self.lazy = get_setting('NOTEBOOKS_LAZY_IMPORT', False) if lazy is None else lazy
+        self.policy = CellPolicy.create(policy)
+
+    def is_lazy(self, fullname):
+        """lazy import is enabled by a flag or by a list of module name patterns"""
+        if isinstance(self.lazy, (list, tuple, set)):
+            return any(fnmatch.fnmatchcase(fullname, pattern) for pattern in self.lazy)
+        return bool(self.lazy)
+
+    @property
+    def shell(self):
+        if self._shell is None:
+            with _shell_lock:
+                from IPython.core.interactiveshell import InteractiveShell
+                self._shell = InteractiveShell.instance()
+        return self._shell
+
+    def create_module(self, spec):
+        # use the default module creation
+        return None
+
+    def exec_module(self, mod, lazy=None, policy=None):
+        """run the cells of a notebook selected by the policy in the module namespace
+
+        Lazy modules run their cells on first attribute access instead.
+        """
+        path = mod.__spec__.origin
+        if path is None:
+            # a directory of notebooks without __init__.ipynb, an empty package
+            return
+        options = getattr(_import_options, 'modules', {}).get(mod.__name__, {})
+        lazy = options.get('lazy') if lazy is None else lazy
+        policy = options.get('policy') if policy is None else policy
+        policy = self.policy if policy is None else CellPolicy.create(policy)
+
+        print("importing Jupyter notebook from %s" % path)
+
+        # stat first, a notebook changed while loading is picked up by the next reload
+        mtime = os.stat(path).st_mtime_ns
+        # load the compiled cells, the notebook is parsed only if the cache is stale
+        cells = self.cache.get(path, policy=policy)
+
+        mod.__dict__['get_ipython'] = get_ipython
+
+        state = NotebookState(self, cells, policy, mtime)
+        mod.__spec__.loader_state = state
+        if self.is_lazy(mod.__name__) if lazy is None else lazy:
+            mod.__class__ = LazyNotebookModule
+        else:
+            state.run(mod)
+        registry.register(mod)
+
+    def run_cells(self, mod, cells):
+        """run compiled cells in the module namespace"""
+        for cell in cells:
+            if cell.needs_shell:
+                self.run_shell_cell(mod, cell)
+            else:
+                # run the code in the module
+                exec(cell.code, mod.__dict__)
+
+    def run_shell_cell(self, mod, cell):
+        # extra work to ensure that magics that would affect the user_ns
+        # actually affect the notebook module's ns, other threads
+        # must not see the swapped namespace
+        with _shell_lock:
+            save_user_ns = self.shell.user_ns
+            self.shell.user_ns = mod.__dict__
+
+            try:
+                exec(cell.code, mod.__dict__)
+            finally:
+                self.shell.user_ns = save_user_ns
+
+    def load_module(self, fullname):
+        """import a notebook as a module"""
+        path = find_notebook(fullname, self.path)
+        spec = importlib.util.spec_from_file_location(
+            fullname, path, loader=self,
+            submodule_search_locations=[os.path.dirname(path)] if is_package_init(path) else None)
+        mod = importlib.util.module_from_spec(spec)
+        sys.modules[fullname] = mod
+        self.exec_module(mod)
+        return mod
+
+
+def import_notebook(fullname, lazy=None, policy=None):
+    """import a notebook module with per-import options
+
+    Works like importlib.import_module, but ``lazy`` and ``policy`` override
+    the NOTEBOOKS_LAZY_IMPORT and NOTEBOOKS_IMPORT_POLICY settings for this import.
+    The import goes through the import system, so it holds the same per-module
+    lock as an import statement of the notebook in another thread.
+    """
+    if fullname in sys.modules:
+        registry.touch(fullname)
+        return sys.modules[fullname]
+    spec = importlib.util.find_spec(fullname)
+    if spec is None or not isinstance(spec.loader, NotebookLoader):
+        raise ModuleNotFoundError('No notebook named %r' % fullname, name=fullname)
+    modules = _import_options.__dict__.setdefault('modules', {})
+    modules[fullname] = dict(lazy=lazy, policy=policy)
+    try:
+        return importlib.import_module(fullname)
+    finally:
+        modules.pop(fullname, None)
+
+
+def _notebook_spec(fullname, finder):
+    """spec of a notebook module without importing anything"""
+    parent = fullname.rpartition('.')[0]
+    path = None
+    if parent:
+        path = getattr(sys.modules.get(parent), '__path__', None)
+        if path is None:
+            return None
+    return finder.find_spec(fullname, path)
+
+
+def _find_cycle(dependencies):
+    visiting, visited = [], set()
+
+    def visit(name):
+        if name in visiting:
+            return visiting[visiting.index(name):] + [name]
+        if name in visited:
+            return None
+        visiting.append(name)
+        for dependency in sorted(dependencies[name]):
+            cycle = visit(dependency)
+            if cycle:
+                return cycle
+        visiting.pop()
+        visited.add(name)
+
+    for name in dependencies:
+        cycle = visit(name)
+        if cycle:
+            return cycle
+
+
+def notebook_dependencies(fullnames, policy=None):
+    """map the notebooks to the notebooks they import, transitively
+
+    The imports are read from the compiled cells, nothing is executed.
+    """
+    finder = NotebookFinder(negative_ttl=0)
+    dependencies = {}
+    pending = list(fullnames)
+    while pending:
+        fullname = pending.pop()
+        if fullname in dependencies:
+            continue
+        spec = importlib.util.find_spec(fullname) if fullname in fullnames else _notebook_spec(fullname, finder)
+        if spec is None or not isinstance(spec.loader, NotebookLoader):
+            raise ModuleNotFoundError('No notebook named %r' % fullname, name=fullname)
+        if spec.origin is None:
+            # a package without __init__.ipynb imports nothing
+            dependencies[fullname] = set()
+            continue
+        cells = spec.loader.cache.get(spec.origin, policy=spec.loader.policy if policy is None else policy)
+        # the relative imports of a package __init__ are relative to the package itself
+        package = fullname if spec.submodule_search_locations is not None else fullname.rpartition('.')[0]
+        imported = set()
+        for cell in cells:
+            imported.update(imported_modules(cell.code, package))
+        dependencies[fullname] = set()
+        for name in imported - {fullname}:
+            if name in fullnames or (name not in sys.modules and _notebook_spec(name, finder) is not None):
+                dependencies[fullname].add(name)
+                pending.append(name)
+    return dependencies
+
+
+def import_many(fullnames, max_workers=None, lazy=None, policy=None):
+    """import notebooks in parallel on a thread pool
+
+    A notebook is imported after the notebooks it imports, so independent
+    notebooks load at the same time while the worker threads never wait for
+    each other's import locks. Cells release the GIL only while they do I/O
+    or run native code, that is where the parallelism pays off.
+
+    Raises NotebookImportCycleError if the notebooks import each other in a cycle.
+    Returns a dict of the imported modules.
+    """
+    fullnames = list(dict.fromkeys(fullnames))
+    dependencies = notebook_dependencies([name for name in fullnames if name not in sys.modules], policy)
+    cycle = _find_cycle(dependencies)
+    if cycle:
+        raise exceptions.NotebookImportCycleError(cycle)
+
+    waiting = {name: set(deps) for name, deps in dependencies.items()}
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+
+        def submit_ready():
+            for name in [name for name, deps in waiting.items() if not deps]:
+                del waiting[name]
+                running[pool.submit(import_notebook, name, lazy, policy)] = name
+
+        submit_ready()
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    errors[name] = future.exception()
+                    continue
+                for deps in waiting.values():
+                    deps.discard(name)
+            submit_ready()
+
+    if errors:
+        # the notebooks depending on a failed one were not imported at all
+        raise next(iter(errors.values()))
+    return {name: sys.modules[name] for name in fullnames}
+
+
+class NotebookFinder(object):
+    """Module finder that locates Jupyter Notebooks
+
+    The listings of the searched directories are cached and revalidated
+    by the directory mtime, names that are not notebooks are remembered
+    for ``negative_ttl`` seconds or until ``importlib.invalidate_caches()``.
+    """
+
+    def __init__(self, negative_ttl=None):
+        self.loaders = {}
+        self.listing = DirectoryListingCache()
+        self.negative_ttl = get_setting('NOTEBOOKS_FINDER_NEGATIVE_TTL', 5.0) if negative_ttl is None else negative_ttl
+        self.counters = collections.Counter()
+        self._misses = {}
+
+    def _find_package(self, name, d, dirs):
+        """the __init__.ipynb of the notebook package name in d"""
+        if name in dirs:
+            package = os.path.join(d, name)
+            if PACKAGE_INIT in self.listing.files(package):
+                return os.path.join(package, PACKAGE_INIT)
+
+    def _find(self, fullname, path):
+        name = fullname.rsplit('.', 1)[-1]
+        directories = []
+        for d in path or ['']:
+            files, dirs = self.listing.entries(d)
+            # find_notebook would stat every candidate
+            self.counters['legacy_stats'] += 1
+            nb_path = self._find_package(name, d, dirs)
+            if nb_path:
+                return nb_path
+            for filename in _notebook_filenames(name):
+                self.counters['legacy_stats'] += 1
+                if filename in files:
+                    return os.path.join(d, filename)
+            if name in dirs:
+                directories.append(os.path.join(d, name))
+        for package in directories:
+            # a directory of notebooks without __init__.ipynb, the path finder imports it as a namespace package
+            # only if it is on sys.path
+            if any(filename.endswith('.ipynb') for filename in self.listing.files(package)):
+                return package
+
+    def find_spec(self, fullname, path=None, target=None):
+        self.counters['lookups'] += 1
+        key = None
+        if path:
+            # lists aren't hashable
+            key = os.path.sep.join(path)
+
+        if self.negative_ttl:
+            expires = self._misses.get((fullname, key))
+            if expires is not None and expires > time.monotonic():
+                self.counters['negative_hits'] += 1
+                self.counters['legacy_stats'] += 3 * len(path or [''])
+                return None
+
+        nb_path = self._find(fullname, path)
+        if not nb_path:
+            if self.negative_ttl:
+                self._misses[(fullname, key)] = time.monotonic() + self.negative_ttl
+            return None
+
+        return self._spec(fullname, path, key, nb_path)
+
+    def _spec(self, fullname, path, key, nb_path):
+        loader = self.loaders.get(key)
+        if loader is None:
+            loader = self.loaders.setdefault(key, NotebookLoader(path))
+        if os.path.isdir(nb_path):
+            spec = importlib.machinery.ModuleSpec(fullname, loader, is_package=True)
+            spec.submodule_search_locations = [nb_path]
+            return spec
+        return importlib.util.spec_from_file_location(
+            fullname, nb_path, loader=loader,
+            submodule_search_locations=[os.path.dirname(nb_path)] if is_package_init(nb_path) else None)
+
+    def find_package_spec(self, fullname, path):
+        """spec of a notebook package, a directory with an __init__.ipynb, for NotebookPackageFinder"""
+        name = fullname.rsplit('.', 1)[-1]
+        for d in path:
+            self.counters['legacy_stats'] += 1
+            nb_path = self._find_package(name, d, self.listing.dirs(d))
+            if nb_path:
+                self.counters['packages'] += 1
+                return self._spec(fullname, path, os.path.sep.join(path), nb_path)
+        return None
+
+    def find_module(self, fullname, path=None):
+        """legacy finder api, the import system uses find_spec"""
+        spec = self.find_spec(fullname, path)
+        if spec is not None:
+            return spec.loader
+
+    def invalidate_caches(self):
+        """called by importlib.invalidate_caches()"""
+        self.listing.invalidate()
+        self._misses.clear()
+
+    def statistics(self):
+        """lookup counters and the number of stat calls saved by the caches"""
+        stats = dict(self.counters)
+        stats.update(('directory_%s' % name, value) for name, value in self.listing.counters.items())
+        stats['stats_avoided'] = self.counters['legacy_stats'] - self.listing.counters['stats'] \
+            - self.listing.counters['scans']
+        return stats
+
+
+class NotebookPackageFinder(object):
+    """Module finder of the notebook packages, directories with an __init__.ipynb
+
+    Goes before importlib's PathFinder in sys.meta_path, which would import
+    such a directory on sys.path as a namespace package without running its
+    __init__.ipynb. Every import of the process passes here, so only the
+    packages below NOTEBOOKS_ROOT are looked up, the other imports cost no
+    stat. Notebooks and packages without __init__.ipynb are left to the
+    NotebookFinder at the end of sys.meta_path.
+    """
+
+    def __init__(self, finder):
+        self.finder = finder
+
+    def find_spec(self, fullname, path=None, target=None):
+        root = get_setting('NOTEBOOKS_ROOT')
+        if not path or not root:
+            return None
+        root = os.path.abspath(root)
+        path = [d for d in path if os.path.abspath(d) == root or os.path.abspath(d).startswith(root + os.sep)]
+        if not path:
+            return None
+        return self.finder.find_package_spec(fullname, path)
+
+    @classmethod
+    def install(cls, finder, meta_path=None):
+        """insert a package finder for finder before the PathFinder of sys.meta_path"""
+        meta_path = sys.meta_path if meta_path is None else meta_path
+        package_finder = cls(finder)
+        position = meta_path.index(importlib.machinery.PathFinder) \
+            if importlib.machinery.PathFinder in meta_path else len(meta_path)
+        meta_path.insert(position, package_finder)
+        return package_finder
@@ -0,0 +1,411 @@
+"""In-process notebook execution
+
+Runs the cells of trusted notebooks in an InteractiveShell of the current
+process instead of a kernel, which saves the kernel start, the messaging
+and the shutdown. The outputs are recorded as the nbformat outputs a kernel
+would produce. Several notebooks run at the same time on different threads:
+sys.stdout, sys.stderr, sys.displayhook and InteractiveShell.instance() are
+routed to the shell running in the current thread, the builtins, __main__
+and the working directory of the process are left alone. Outputs of threads
+started by the cells are lost. An interrupted run raises CellInterrupted
+in the threads running its cells, a cell blocked in a call which does not
+return to Python (a sleep, a read) stops once the call returned. Idle
+shells are reset and reused, up to NOTEBOOKS_INPROCESS_SHELLS.
+"""
+import atexit
+import collections
+import contextlib
+import ctypes
+import datetime
+import functools
+import sys
+import threading
+
+from IPython.core.builtin_trap import BuiltinTrap
+from IPython.core.display_functions import display
+from IPython.core.display_trap import DisplayTrap
+from IPython.core.displayhook import DisplayHook
+from IPython.core.displaypub import DisplayPublisher
+from IPython.core.interactiveshell import InteractiveShell
+from nbclient.exceptions import CellExecutionError
+from nbclient.util import run_hook, run_sync
+from nbconvert.preprocessors import ExecutePreprocessor
+from nbformat.v4 import new_output
+from traitlets import Type
+from traitlets.config import Config
+
+from .conf import get_setting
+
+LANGUAGE_INFO = {
+    'name': 'python',
+    'version': sys.version.split()[0],
+    'mimetype': 'text/x-python',
+    'codemirror_mode': {'name': 'ipython', 'version': sys.version_info[0]},
+    'pygments_lexer': 'ipython%d' % sys.version_info[0],
+    'nbconvert_exporter': 'python',
+    'file_extension': '.py',
+}
+
+
+def timestamp():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+# the shell running a cell in the current thread
+_running = threading.local()
+
+
+class CellInterrupted(Exception):
+    """raised in the threads running the cells of an interrupted run"""
+
+
+def _async_raise(ident, exception):
+    """raise the exception in the thread at its next Python instruction, None drops a pending one"""
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), None if exception is None
+                                               else ctypes.py_object(exception))
+
+
+def running_shell():
+    return getattr(_running, 'shell', None)
+
+
+@contextlib.contextmanager
+def running(shell):
+    """route the outputs of the current thread to the shell"""
+    previous = running_shell()
+    _running.shell = shell
+    try:
+        yield shell
+    finally:
+        _running.shell = previous
+
+
+class OutputStream(object):
+    """sys.stdout or sys.stderr, writes of a thread running a cell go to the outputs of its shell"""
+
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        shell = running_shell()
+        if shell is None:
+            return self.stream.write(text)
+        if text:
+            shell.add_output(new_output('stream', name=self.name, text=text))
+        return len(text)
+
+    def flush(self):
+        if running_shell() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        # fileno, encoding, isatty ... of the process stream
+        return getattr(self.stream, name)
+
+
+class RunningDisplayHook(object):
+    """sys.displayhook, the values of a thread running a cell go to the displayhook of its shell"""
+
+    def __init__(self, hook):
+        self.hook = hook
+
+    def __call__(self, value):
+        shell = running_shell()
+        return self.hook(value) if shell is None else shell.displayhook(value)
+
+
+class RunningInstance(object):
+    """InteractiveShell._instance, the shell running in the current thread before the process-wide one"""
+
+    def __init__(self, instance):
+        self.instance = instance
+
+    def __get__(self, obj, owner):
+        shell = running_shell()
+        return self.instance if shell is None else shell
+
+
+_routing_lock = threading.Lock()
+
+
+def route_outputs():
+    """install the routing of sys.stdout, sys.stderr, sys.displayhook and InteractiveShell.instance()
+
+    The process objects are wrapped once, again if someone replaced them.
+    """
+    with _routing_lock:
+        if not isinstance(sys.stdout, OutputStream):
+            sys.stdout = OutputStream(sys.stdout, 'stdout')
+        if not isinstance(sys.stderr, OutputStream):
+            sys.stderr = OutputStream(sys.stderr, 'stderr')
+        if not isinstance(sys.displayhook, RunningDisplayHook):
+            sys.displayhook = RunningDisplayHook(sys.displayhook)
+        instance = InteractiveShell.__dict__.get('_instance')
+        if not isinstance(instance, RunningInstance):
+            InteractiveShell._instance = RunningInstance(instance)
+
+
+@functools.wraps(display)
+def shell_display(*objs, **kwargs):
+    # not the display function itself, %who lists display when a cell imported it
+    return display(*objs, **kwargs)
+
+
+class SharedBuiltinTrap(BuiltinTrap):
+    """leaves the builtins alone, they are shared with the other threads, get_ipython is in the user namespace"""
+
+    def activate(self):
+        pass
+
+    def deactivate(self):
+        pass
+
+
+class SharedDisplayTrap(DisplayTrap):
+    """leaves sys.displayhook alone, route_outputs() routes it to the running shell"""
+
+    def set(self):
+        pass
+
+    def unset(self):
+        pass
+
+
+class OutputDisplayHook(DisplayHook):
+    """records the value of the last expression as an execute_result output"""
+
+    def write_output_prompt(self):
+        pass
+
+    def write_format_data(self, format_dict, md_dict=None):
+        self.shell.add_output(new_output('execute_result', data=format_dict, metadata=md_dict or {},
+                                         execution_count=self.shell.execution_count))
+
+    def finish_displayhook(self):
+        pass
+
+
+class OutputDisplayPublisher(DisplayPublisher):
+    """records display() calls as display_data outputs"""
+
+    def publish(self, data, metadata=None, source=None, *, transient=None, update=False, **kwargs):
+        output = new_output('display_data', data=data, metadata=metadata or {})
+        display_id = (transient or {}).get('display_id')
+        if update:
+            # like nbclient, an update replaces the outputs of the display id
+            for previous in self.shell.displays.get(display_id, ()):
+                previous.data, previous.metadata = output.data, output.metadata
+            return
+        if display_id is not None:
+            self.shell.displays.setdefault(display_id, []).append(output)
+        self.shell.add_output(output)
+
+    def clear_output(self, wait=False):
+        self.shell.clear_output(wait)
+
+
+class InProcessShell(InteractiveShell):
+    """InteractiveShell which records the outputs of the running cell"""
+
+    displayhook_class = Type(OutputDisplayHook)
+    display_pub_class = Type(OutputDisplayPublisher)
+    # an outputs.OutputCapture bounding the outputs kept, and the index of the running cell
+    capture = None
+    cell_index = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # the shell lives for notebook runs only
+        atexit.unregister(self.atexit_operations)
+        self.outputs = []
+        self.displays = {}
+        self.error = None
+        self._clear_on_output = False
+
+    def init_sys_modules(self):
+        # __main__ stays the module of the process, other threads run other notebooks
+        pass
+
+    def init_builtins(self):
+        self.builtin_trap = SharedBuiltinTrap(shell=self)
+
+    def init_displayhook(self):
+        super().init_displayhook()
+        self.display_trap = SharedDisplayTrap(hook=self.displayhook)
+
+    def init_user_ns(self):
+        super().init_user_ns()
+        # a builtin of the process-wide shell
+        self.user_ns['display'] = self.user_ns_hidden['display'] = shell_display
+
+    def add_output(self, output):
+        if self._clear_on_output:
+            self._clear_on_output = False
+            self._clear()
+        if self.capture is not None:
+            self.capture.add(self.outputs, output, self.cell_index)
+            return
+        if output.output_type == 'stream':
+            # a kernel buffers each stream, the text goes to the stream output after the last non-stream output
+            for previous in reversed(self.outputs):
+                if previous.output_type != 'stream':
+                    break
+                if previous.name == output.name:
+                    previous.text += output.text
+                    return
+        self.outputs.append(output)
+
+    def clear_output(self, wait=False):
+        if wait:
+            self._clear_on_output = True
+        else:
+            self._clear()
+
+    def _clear(self):
+        del self.outputs[:]
+        if self.capture is not None:
+            self.capture.cleared(self.cell_index)
+
+    def _showtraceback(self, etype, evalue, stb):
+        self.error = new_output('error', ename=etype.__name__, evalue=str(evalue), traceback=stb)
+        self.add_output(self.error)
+
+
+_idle_shells = collections.defaultdict(list)
+_idle_lock = threading.Lock()
+
+
+def new_shell(shell_class=InProcessShell):
+    config = Config()
+    config.HistoryManager.enabled = False
+    return shell_class(config=config, user_ns={'__name__': '__main__'})
+
+
+@contextlib.contextmanager
+def isolated_shell(shell_class=InProcessShell):
+    """an idle or new shell with an empty namespace, reset and kept for another run on exit"""
+    route_outputs()
+    with _idle_lock:
+        idle = _idle_shells[shell_class]
+        shell = idle.pop() if idle else None
+    if shell is None:
+        shell = new_shell(shell_class)
+    try:
+        yield shell
+    finally:
+        shell.capture = shell.cell_index = None
+        shell.reset(new_session=True)
+        with _idle_lock:
+            idle = _idle_shells[shell_class]
+            if len(idle) < get_setting('NOTEBOOKS_INPROCESS_SHELLS', 2):
+                idle.append(shell)
+
+
+class InProcessExecutePreprocessor(ExecutePreprocessor):
+    """ExecutePreprocessor which runs the cells in-process instead of a kernel
+
+    The allow_errors, raises-exception, skip_cells_with_tag, record_timing
+    and the cell hook options behave like with a kernel, timeout and the
+    kernel options are ignored. interrupt() stops the run.
+    """
+
+    shell = None
+    shell_class = InProcessShell
+    output_capture = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.interrupted = False
+        self._interrupt_lock = threading.Lock()
+        self._cell_threads = set()
+
+    def interrupt(self):
+        """raise CellInterrupted in the running cells, no further cell is started"""
+        with self._interrupt_lock:
+            self.interrupted = True
+            for ident in self._cell_threads:
+                _async_raise(ident, CellInterrupted)
+
+    @contextlib.contextmanager
+    def interruptible(self):
+        """the current thread runs a cell until interrupt()"""
+        ident = threading.get_ident()
+        with self._interrupt_lock:
+            if self.interrupted:
+                raise CellInterrupted('The execution was interrupted')
+            self._cell_threads.add(ident)
+        try:
+            yield
+        finally:
+            with self._interrupt_lock:
+                self._cell_threads.discard(ident)
+                _async_raise(ident, None)
+
+    def preprocess(self, nb, resources=None, km=None):
+        self.nb = nb
+        self.reset_execution_trackers()
+        self._check_assign_resources(resources)
+        with isolated_shell(self.shell_class) as shell:
+            self.shell = shell
+            shell.capture = self.output_capture
+            nb.metadata['language_info'] = dict(LANGUAGE_INFO)
+            try:
+                self.preprocess_cells(nb, resources)
+            finally:
+                self.shell = None
+        return nb, self.resources
+
+    def preprocess_cells(self, nb, resources):
+        for index, cell in enumerate(nb.cells):
+            self.preprocess_cell(cell, resources, index)
+
+    def _hook(self, hook, **kwargs):
+        if hook is not None:
+            run_sync(run_hook)(hook, **kwargs)
+
+    def run_cell(self, cell, cell_index, store_history=True):
+        """run the source of the cell in the shell, return its execution count"""
+        count = self.shell.execution_count
+        self.shell.run_cell(cell.source, store_history=store_history)
+        return count
+
+    def execute_cell(self, cell, cell_index, execution_count=None, store_history=True):
+        self._hook(self.on_cell_start, cell=cell, cell_index=cell_index)
+        if cell.cell_type != 'code' or not cell.source.strip():
+            return cell
+        tags = cell.metadata.get('tags', [])
+        if self.skip_cells_with_tag in tags:
+            return cell
+        allows_errors = not self.force_raise_errors and (self.allow_errors or 'raises-exception' in tags)
+        if self.record_timing:
+            cell.metadata['execution'] = {'iopub.status.busy': timestamp(), 'iopub.execute_input': timestamp()}
+        self._hook(self.on_cell_execute, cell=cell, cell_index=cell_index)
+        self._hook(self.on_cell_complete, cell=cell, cell_index=cell_index)
+        self.code_cells_executed += 1
+
+        shell = self.shell
+        shell.outputs, shell.displays, shell.error = [], {}, None
+        shell._clear_on_output = False
+        shell.cell_index = cell_index
+        with running(shell), self.interruptible():
+            count = self.run_cell(cell, cell_index, store_history)
+        cell.outputs = shell.outputs
+        cell.execution_count = execution_count or count
+        if self.record_timing:
+            cell.metadata['execution']['shell.execute_reply'] = timestamp()
+            cell.metadata['execution']['iopub.status.idle'] = timestamp()
+
+        content = dict(status='ok' if shell.error is None else 'error', execution_count=count)
+        if shell.error is not None:
+            content.update(ename=shell.error.ename, evalue=shell.error.evalue, traceback=shell.error.traceback)
+        reply = dict(content=content)
+        self._hook(self.on_cell_executed, cell=cell, cell_index=cell_index, execute_reply=reply)
+        if shell.error is not None:
+            self._hook(self.on_cell_error, cell=cell, cell_index=cell_index, execute_reply=reply)
+            if not allows_errors:
+                raise CellExecutionError.from_cell_and_msg(cell, content)
+        return cell
@@ -0,0 +1,451 @@
+import datetime
+import heapq
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import nbformat
+
+from .conf import cache_directory, get_setting
+from .scheduler import PRIORITIES, RunHistory, Scheduler
+from .selection import select_cells
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def new_job_id():
+    """a unique id, the ids sort in creation order"""
+    return '%s-%s' % (datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S%f'), uuid.uuid4().hex[:12])
+
+
+def _write_json(path, data):
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def retention_cutoff(max_age=None):
+    """the epoch seconds before which finished jobs are removed, None to keep them, see NOTEBOOKS_JOB_RETENTION"""
+    max_age = get_setting('NOTEBOOKS_JOB_RETENTION', 7 * 24 * 3600) if max_age is None else max_age
+    return None if max_age is None else time.time() - max_age
+
+
+def clean_streams(directory, cutoff):
+    """remove the streamed runs written before the cutoff, return their number"""
+    removed = 0
+    try:
+        with os.scandir(os.path.join(directory, 'streams')) as entries:
+            old = [entry.path for entry in entries if entry.stat().st_mtime < cutoff]
+    except FileNotFoundError:
+        return 0
+    for path in old:
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+    return removed
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue(object):
+    """Queue of notebook execution jobs in a directory
+
+    Every job is a json file which moves from ``queued/`` to ``running/``
+    and ``done/``, a worker claims a job by renaming it, which is atomic
+    even with many worker processes. The executed notebook of a job is
+    written below ``results/<job id>/``.
+    """
+
+    # a worker owns its running jobs as long as its process lives
+    heartbeat_interval = None
+    # reads of a job record which is not valid json
+    read_attempts = 3
+
+    def __init__(self, directory=None):
+        self._directory = directory
+        self.submitted = threading.Condition()
+        self._histories = {}
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            return get_setting('NOTEBOOKS_JOBS_DIR') or cache_directory('jobs')
+        return self._directory
+
+    def _path(self, state, job_id):
+        return os.path.join(self.directory, state, job_id + '.json')
+
+    @property
+    def history(self):
+        """past run durations of the notebooks, shared by the workers of the directory"""
+        path = os.path.join(self.directory, 'history.json')
+        if path not in self._histories:
+            self._histories[path] = RunHistory(path)
+        return self._histories[path]
+
+    @property
+    def scheduler(self):
+        return Scheduler(self.history)
+
+    def result_dir(self, job_id):
+        return os.path.join(self.directory, 'results', job_id)
+
+    def result_path(self, job):
+        return os.path.join(self.result_dir(job['id']), job['notebook'] + '.ipynb')
+
+    def _makedirs(self):
+        for state in ('queued', 'running', 'done', 'results'):
+            os.makedirs(os.path.join(self.directory, state), exist_ok=True)
+
+    def submit(self, notebook, priority='default', tenant=None, **options):
+        """queue an execution of a notebook under NOTEBOOKS_ROOT, return the job
+
+        ``priority`` is one of the PRIORITIES, jobs of the same ``tenant`` share
+        the workers fairly with the jobs of other tenants.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError('Unknown job priority %r' % priority)
+        self._makedirs()
+        job_id = new_job_id()
+        job = dict(id=job_id, notebook=notebook, options=options, priority=priority, tenant=tenant, status=QUEUED,
+                   created=now(), started=None, finished=None, worker=None, progress=dict(cells=None, done=0),
+                   error=None)
+        _write_json(self._path('queued', job_id), job)
+        with self.submitted:
+            self.submitted.notify_all()
+        return job
+
+    def get(self, job_id):
+        """the job record, None for an unknown job"""
+        if os.sep in job_id or job_id.startswith('.'):
+            return None
+        for attempt in range(self.read_attempts):
+            for state in ('done', 'running', 'queued'):
+                try:
+                    with open(self._path(state, job_id), encoding='utf-8') as f:
+                        return json.load(f)
+                except FileNotFoundError:
+                    continue
+                except ValueError:
+                    # a concurrent os.replace, read again
+                    break
+            else:
+                return None
+        logger.error('The record of job %s is not valid json', job_id)
+        return None
+
+    def jobs(self, state):
+        try:
+            names = sorted(os.listdir(os.path.join(self.directory, state)))
+        except FileNotFoundError:
+            return []
+        return [name[:-len('.json')] for name in names if name.endswith('.json')]
+
+    def _read(self, state, job_ids=None):
+        records = []
+        for job_id in self.jobs(state) if job_ids is None else job_ids:
+            try:
+                with open(self._path(state, job_id), encoding='utf-8') as f:
+                    records.append(json.load(f))
+            except (OSError, ValueError):
+                # claimed or finished meanwhile
+                continue
+        return records
+
+    def recent(self, limit=1000):
+        """the last finished jobs, by the modification time of their files"""
+        try:
+            with os.scandir(os.path.join(self.directory, 'done')) as entries:
+                done = [(entry.stat().st_mtime, entry.name) for entry in entries if entry.name.endswith('.json')]
+        except FileNotFoundError:
+            return []
+        # only the last ``limit`` files are read
+        return self._read('done', [name[:-len('.json')] for _, name in sorted(heapq.nlargest(limit, done))])
+
+    def claim(self):
+        """move the first queued job of the scheduler to running and return it, None if the queue is empty
+
+        The scheduler sees the oldest NOTEBOOKS_SCHEDULER_WINDOW queued jobs.
+        """
+        window = get_setting('NOTEBOOKS_SCHEDULER_WINDOW', 1000)
+        while True:
+            queued = self._read('queued', self.jobs('queued')[:window])
+            if not queued:
+                return None
+            for job in self.scheduler.order(queued, self._read('running')):
+                job_id = job['id']
+                running = self._path('running', job_id)
+                try:
+                    os.rename(self._path('queued', job_id), running)
+                except FileNotFoundError:
+                    # another worker was faster
+                    continue
+                with open(running, encoding='utf-8') as f:
+                    job = json.load(f)
+                job.update(status=RUNNING, started=now(), worker=os.getpid())
+                _write_json(running, job)
+                return job
+            # other workers were faster for all of them
+
+    def update(self, job):
+        _write_json(self._path('running', job['id']), job)
+
+    def finish(self, job, error=None):
+        job.update(status=FAILED if error else FINISHED, finished=now(), error=error)
+        _write_json(self._path('done', job['id']), job)
+        os.remove(self._path('running', job['id']))
+        return job
+
+    def recover(self):
+        """queue the running jobs of dead worker processes again, return their ids"""
+        recovered = []
+        for job_id in self.jobs('running'):
+            job = self.get(job_id)
+            if job is None or job['status'] != RUNNING or _pid_alive(job['worker']):
+                continue
+            job.update(status=QUEUED, started=None, worker=None, progress=dict(cells=None, done=0))
+            _write_json(self._path('queued', job_id), job)
+            os.remove(self._path('running', job_id))
+            recovered.append(job_id)
+        return recovered
+
+    def statistics(self):
+        return {state: len(self.jobs(state)) for state in ('queued', 'running', 'done')}
+
+    def close_old_connections(self):
+        """called by the worker threads before every claim and heartbeat, the files need no connection"""
+
+    def close_connection(self):
+        """called by a worker thread when it exits"""
+
+    def clean(self, max_age=None, keep=None):
+        """remove the finished jobs older than max_age seconds or beyond the last ``keep``, with their notebooks
+
+        max_age defaults to NOTEBOOKS_JOB_RETENTION, the streamed runs older
+        than it are removed too. Returns the number of removed jobs.
+        """
+        cutoff = retention_cutoff(max_age)
+        try:
+            with os.scandir(os.path.join(self.directory, 'done')) as entries:
+                done = sorted((entry.stat().st_mtime, entry.name) for entry in entries if entry.name.endswith('.json'))
+        except FileNotFoundError:
+            done = []
+        if keep is not None:
+            # the oldest beyond the last keep
+            old, done = done[:max(len(done) - keep, 0)], done[max(len(done) - keep, 0):]
+        else:
+            old = []
+        if cutoff is not None:
+            old += [(mtime, name) for mtime, name in done if mtime < cutoff]
+            clean_streams(self.directory, cutoff)
+        for _, name in old:
+            job_id = name[:-len('.json')]
+            try:
+                os.remove(self._path('done', job_id))
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(self.result_dir(job_id), ignore_errors=True)
+        return len(old)
+
+
+class JobWorker(object):
+    """Runs the jobs of a queue on a bounded number of background threads
+
+    The threads are daemons of the current process, e.g. of a web server,
+    every job executes its notebook in its own kernel.
+    """
+
+    # seconds between the removals of the old finished jobs
+    clean_interval = 3600
+
+    def __init__(self, queue=None, max_workers=None, interval=1.0):
+        self.queue = default_queue if queue is None else queue
+        self.max_workers = get_setting('NOTEBOOKS_JOB_WORKERS', 2) if max_workers is None else max_workers
+        self.interval = interval
+        self._cleaned = None
+        self._clean_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def execute(self, job):
+        """run one claimed job and record its result"""
+        from .batch import execute_notebook
+        options = dict(job['options'])
+        options.setdefault('engine', get_setting('NOTEBOOKS_EXECUTION_ENGINE', 'kernel'))
+        if options.get('checkpoint'):
+            # a job run again after its worker was lost continues from its last checkpoint
+            options.setdefault('resume', True)
+
+        def on_cell(index, cell, duration):
+            job['progress']['done'] += 1
+            try:
+                self.queue.update(job)
+            except Exception:
+                # e.g. a locked database, the progress is only reported, the notebook keeps running
+                logger.warning('Updating the progress of notebook job %s failed', job['id'], exc_info=True)
+
+        nb_path = os.path.join(get_setting('NOTEBOOKS_ROOT'), job['notebook'] + '.ipynb')
+        try:
+            nb = nbformat.read(nb_path, 4)
+            selected = select_cells(nb, options.get('cells'), options.get('tags'), options.get('target'))
+        except (OSError, IndexError, ValueError) as e:
+            return self.queue.finish(job, error='%s: %s' % (type(e).__name__, e))
+        job['progress']['cells'] = (sum(1 for cell in nb.cells if cell.cell_type == 'code') if selected is None
+                                    else len(selected)) + (options.get('parameters') is not None)
+        self.queue.update(job)
+        done = threading.Event()
+        if self.queue.heartbeat_interval:
+            threading.Thread(target=self._heartbeat, args=(job, done), daemon=True).start()
+        try:
+            run = execute_notebook(job['notebook'], output_dir=self.queue.result_dir(job['id']), on_cell=on_cell,
+                                   **options)
+        finally:
+            done.set()
+        if (run.ok or run.timed_out) and not run.cached:
+            # failed and memoised runs may take no time, they would make the notebook look short
+            self.queue.history.record(job['notebook'], run.duration)
+        return self.queue.finish(job, error=run.error)
+
+    def _heartbeat(self, job, done):
+        try:
+            while not done.wait(self.queue.heartbeat_interval):
+                try:
+                    self.queue.close_old_connections()
+                    if not self.queue.heartbeat(job):
+                        logger.warning('Notebook job %s lost its lease', job['id'])
+                        return
+                except Exception:
+                    logger.exception('Heartbeat of notebook job %s failed', job['id'])
+        finally:
+            self.queue.close_connection()
+
+    def run_once(self):
+        """execute the next queued job, False if there was none"""
+        self.queue.close_old_connections()
+        job = self.queue.claim()
+        if job is None:
+            return False
+        try:
+            self.execute(job)
+        except Exception as e:
+            logger.exception('Notebook job %s failed', job['id'])
+            self.queue.finish(job, error='%s: %s' % (type(e).__name__, e))
+        return True
+
+    def clean(self):
+        """remove the finished jobs beyond the retention, at most once every clean_interval"""
+        with self._clean_lock:
+            if self._cleaned is not None and time.monotonic() - self._cleaned < self.clean_interval:
+                return 0
+            self._cleaned = time.monotonic()
+        try:
+            return self.queue.clean()
+        except Exception:
+            logger.exception('Removing the old notebook jobs failed')
+            return 0
+
+    def run(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    ran = self.run_once()
+                except Exception:
+                    # e.g. a locked or unreachable database, try again later
+                    logger.exception('Claiming a notebook job failed')
+                    ran = False
+                if not ran:
+                    self.clean()
+                    with self.queue.submitted:
+                        self.queue.submitted.wait(self.interval)
+        finally:
+            self.queue.close_connection()
+
+    def start(self):
+        """start the worker threads, the running jobs of dead workers are queued again first"""
+        if not self._threads:
+            self._stop.clear()
+            self.queue.recover()
+            for index in range(self.max_workers):
+                thread = threading.Thread(target=self.run, name='notebook-job-%d' % index, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def drain(self):
+        """run the queued jobs on max_workers threads until the queue is empty, return the number of jobs"""
+        counts = []
+
+        def run():
+            count = 0
+            try:
+                while not self._stop.is_set() and self.run_once():
+                    count += 1
+            finally:
+                counts.append(count)
+                self.queue.close_connection()
+
+        self.queue.recover()
+        threads = [threading.Thread(target=run, name='notebook-job-%d' % index) for index in range(self.max_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(counts)
+
+    def stop(self):
+        self._stop.set()
+        with self.queue.submitted:
+            self.queue.submitted.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+default_queue = JobQueue()
+_database_queue = None
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_queue():
+    """the queue of submit() and the REST API, NOTEBOOKS_JOB_QUEUE is 'filesystem' (default) or 'database'"""
+    global _database_queue
+    if get_setting('NOTEBOOKS_JOB_QUEUE', 'filesystem') != 'database':
+        return default_queue
+    with _worker_lock:
+        if _database_queue is None:
+            from .dbjobs import DatabaseJobQueue
+            _database_queue = DatabaseJobQueue()
+        return _database_queue
+
+
+def submit(notebook, **options):
+    """queue a notebook execution and make sure the background workers of this process run"""
+    global _worker
+    queue = get_queue()
+    job = queue.submit(notebook, **options)
+    with _worker_lock:
+        if _worker is None and get_setting('NOTEBOOKS_JOB_WORKERS', 2) > 0:
+            _worker = JobWorker(queue).start()
+    return job
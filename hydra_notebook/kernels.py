@@ -0,0 +1,197 @@
+import atexit
+import collections
+import contextlib
+import logging
+import os
+import threading
+
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+# clears the user namespace and restarts the execution count, the imported modules stay warm
+PYTHON_RESET = 'get_ipython().reset(new_session=True)'
+
+
+class KernelPoolTimeout(RuntimeError):
+    """no kernel of the pool was released in time"""
+
+
+def run_silently(km, code, timeout=30):
+    """execute code in a started kernel without output or history, False if it failed"""
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=timeout)
+        reply = kc.execute_interactive(code, silent=True, store_history=False, timeout=timeout)
+        return reply['content']['status'] == 'ok'
+    except (RuntimeError, TimeoutError):
+        return False
+    finally:
+        kc.stop_channels()
+
+
+class KernelPool(object):
+    """Pool of started Jupyter kernels, keyed by kernel name
+
+    Up to ``max_size`` kernels of every kernel name are started, at least
+    ``min_size`` of them are kept idle by a background thread. Released
+    python kernels are reset (namespace, execution count and working
+    directory) and reused up to ``max_uses`` times, other kernels are shut
+    down and replaced. Dead kernels are replaced when they are acquired.
+    """
+
+    def __init__(self, min_size=None, max_size=None, max_uses=None, startup_timeout=60):
+        self._min_size = min_size
+        self._max_size = max_size
+        self._max_uses = max_uses
+        self.startup_timeout = startup_timeout
+        self._idle = collections.defaultdict(collections.deque)
+        self._started = collections.Counter()
+        self._uses = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self.counters = collections.Counter()
+
+    @property
+    def min_size(self):
+        return get_setting('NOTEBOOKS_KERNEL_POOL_MIN', 1) if self._min_size is None else self._min_size
+
+    @property
+    def max_size(self):
+        return get_setting('NOTEBOOKS_KERNEL_POOL_MAX', 4) if self._max_size is None else self._max_size
+
+    @property
+    def max_uses(self):
+        return get_setting('NOTEBOOKS_KERNEL_POOL_MAX_USES', 20) if self._max_uses is None else self._max_uses
+
+    def _start(self, kernel_name):
+        from jupyter_client.manager import KernelManager
+        km = KernelManager(kernel_name=kernel_name)
+        km.start_kernel(cwd=get_setting('NOTEBOOKS_ROOT', os.getcwd()))
+        self.counters['started'] += 1
+        self._uses[km] = 0
+        return km
+
+    def _discard(self, km):
+        """shut a kernel down, the caller holds a slot of its kernel name"""
+        self._uses.pop(km, None)
+        try:
+            km.shutdown_kernel(now=True)
+        except Exception:
+            logger.exception('Shutting down kernel %s failed', km.kernel_name)
+        with self._cond:
+            self._started[km.kernel_name] -= 1
+            self._cond.notify_all()
+
+    def _replenish(self, kernel_name):
+        while True:
+            with self._cond:
+                if self._closed or len(self._idle[kernel_name]) >= self.min_size \
+                        or self._started[kernel_name] >= self.max_size:
+                    return
+                self._started[kernel_name] += 1
+            try:
+                km = self._start(kernel_name)
+            except Exception:
+                logger.exception('Starting a %s kernel for the pool failed', kernel_name)
+                with self._cond:
+                    self._started[kernel_name] -= 1
+                return
+            with self._cond:
+                self._idle[kernel_name].append(km)
+                self._cond.notify_all()
+
+    def fill(self, kernel_name='python3', wait=False):
+        """start idle kernels up to min_size in the background"""
+        thread = threading.Thread(target=self._replenish, args=(kernel_name,),
+                                  name='kernel-pool-%s' % kernel_name, daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+        return thread
+
+    def acquire(self, kernel_name='python3', cwd=None, timeout=None):
+        """return a started KernelManager, start a new kernel if no kernel is idle"""
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError('The kernel pool is shut down')
+                idle = self._idle[kernel_name]
+                if not idle and self._started[kernel_name] >= self.max_size:
+                    if not self._cond.wait_for(lambda: idle or self._started[kernel_name] < self.max_size,
+                                               timeout=timeout):
+                        raise KernelPoolTimeout('No %s kernel was released within %s seconds'
+                                                % (kernel_name, timeout))
+                    continue
+                if idle:
+                    km = idle.popleft()
+                    hit = True
+                else:
+                    self._started[kernel_name] += 1
+                    km, hit = None, False
+            if km is None:
+                try:
+                    km = self._start(kernel_name)
+                except Exception:
+                    with self._cond:
+                        self._started[kernel_name] -= 1
+                        self._cond.notify_all()
+                    raise
+            elif not km.is_alive():
+                self.counters['replaced'] += 1
+                self._discard(km)
+                continue
+            if cwd is not None and km.kernel_spec.language == 'python' \
+                    and not run_silently(km, 'import os as _os; _os.chdir(%r); del _os' % os.path.abspath(cwd),
+                                         self.startup_timeout):
+                self.counters['replaced'] += 1
+                self._discard(km)
+                continue
+            self.counters['hits' if hit else 'misses'] += 1
+            self._uses[km] += 1
+            self.fill(kernel_name)
+            return km
+
+    def release(self, km):
+        """return a kernel to the pool, it is reset or shut down"""
+        reusable = not self._closed and km.kernel_spec.language == 'python' \
+            and self._uses.get(km, 0) < self.max_uses and km.is_alive()
+        if reusable and run_silently(km, PYTHON_RESET, self.startup_timeout):
+            self.counters['resets'] += 1
+            with self._cond:
+                self._idle[km.kernel_name].append(km)
+                self._cond.notify_all()
+            return
+        self.counters['recycled'] += 1
+        self._discard(km)
+        self.fill(km.kernel_name)
+
+    @contextlib.contextmanager
+    def kernel(self, kernel_name='python3', cwd=None, timeout=None):
+        km = self.acquire(kernel_name, cwd=cwd, timeout=timeout)
+        try:
+            yield km
+        finally:
+            self.release(km)
+
+    def shutdown(self):
+        """shut down the idle kernels, kernels in use are shut down when released"""
+        with self._cond:
+            self._closed = True
+            idle = [km for kms in self._idle.values() for km in kms]
+            self._idle.clear()
+        for km in idle:
+            self._discard(km)
+
+    def statistics(self):
+        stats = dict(self.counters)
+        requests = self.counters['hits'] + self.counters['misses']
+        stats.update(idle={name: len(kms) for name, kms in self._idle.items()},
+                     kernels=dict(+self._started),
+                     hit_rate=self.counters['hits'] / requests if requests else None)
+        return stats
+
+
+pool = KernelPool()
+atexit.register(pool.shutdown)
@@ -0,0 +1,37 @@
+import types
+
+from .state import NotebookState
+
+
+class LazyNotebookModule(types.ModuleType):
+    """Notebook module which runs its cells on first attribute access
+
+    Only notebook modules with pending cells have this class, so ordinary
+    attribute access is not slowed down after the notebook is fully loaded.
+    """
+
+    def __getattribute__(self, name):
+        # the import system probes for dunder names like __path__, they never trigger cells
+        if not (name.startswith('__') and name.endswith('__')):
+            state = types.ModuleType.__getattribute__(self, '__spec__').loader_state
+            if isinstance(state, NotebookState) and state.pending:
+                state.resolve(self, name)
+        return types.ModuleType.__getattribute__(self, name)
+
+    def __dir__(self):
+        # the class is switched back to ModuleType once every cell ran
+        return types.ModuleType.__dir__(load(self))
+
+
+def is_loaded(mod):
+    """False if a lazy notebook module has pending cells"""
+    state = mod.__spec__.loader_state if mod.__spec__ is not None else None
+    return not (isinstance(state, NotebookState) and state.pending)
+
+
+def load(mod):
+    """run all pending cells of a lazy notebook module"""
+    state = mod.__spec__.loader_state if mod.__spec__ is not None else None
+    if isinstance(state, NotebookState):
+        state.run(mod)
+    return mod
@@ -0,0 +1,150 @@
+"""CPU and memory limits of kernel processes
+
+Limits are applied to the kernel process once it started, with prlimit()
+on Linux, and with a cgroup v2 below NOTEBOOKS_KERNEL_CGROUP if the web or
+worker process may create cgroups there (a delegated subtree).
+"""
+import logging
+import os
+
+from .conf import get_setting
+
+try:
+    import resource
+except ImportError:
+    # not a unix
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+CGROUP_PERIOD = 100000
+
+
+def cpu_time(pid):
+    """seconds of CPU time used by a process, None if unknown"""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            # the command may contain spaces, the fields after it are fixed
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def kernel_pid(km):
+    process = getattr(getattr(km, 'provisioner', None), 'process', None)
+    if process is not None:
+        return process.pid
+    # forked kernels
+    return getattr(km, 'pid', None)
+
+
+class KernelLimits(object):
+    """Limits of one kernel run
+
+    ``cpu_time`` is the CPU seconds a run may use (the kernel gets SIGXCPU
+    beyond it), ``memory`` the bytes of address space, or of memory in the
+    cgroup, and ``cpus`` the CPU bandwidth in the cgroup, e.g. 0.5.
+    """
+
+    def __init__(self, cpu_time=None, memory=None, cpus=None, cgroup=None):
+        self.cpu_time = cpu_time
+        self.memory = memory
+        self.cpus = cpus
+        self.cgroup = cgroup
+
+    @classmethod
+    def from_settings(cls):
+        return cls(cpu_time=get_setting('NOTEBOOKS_KERNEL_CPU_TIME_LIMIT'),
+                   memory=get_setting('NOTEBOOKS_KERNEL_MEMORY_LIMIT'),
+                   cpus=get_setting('NOTEBOOKS_KERNEL_CPUS'),
+                   cgroup=get_setting('NOTEBOOKS_KERNEL_CGROUP'))
+
+    def __bool__(self):
+        return any(limit is not None for limit in (self.cpu_time, self.memory, self.cpus))
+
+    def apply(self, pid):
+        """limit a running kernel process, return an AppliedLimits to restore it"""
+        applied = AppliedLimits(pid)
+        if self.cgroup and self._apply_cgroup(pid, applied):
+            if self.cpu_time is not None:
+                self._apply_rlimits(pid, applied, memory=False)
+            return applied
+        self._apply_rlimits(pid, applied, memory=True)
+        return applied
+
+    def _apply_rlimits(self, pid, applied, memory):
+        if resource is None or not hasattr(resource, 'prlimit'):
+            logger.warning('Kernel limits need prlimit(), kernel %d runs without them', pid)
+            return
+        limits = []
+        if self.cpu_time is not None:
+            # RLIMIT_CPU counts the lifetime of the process, a kernel of the pool was used before
+            limits.append((resource.RLIMIT_CPU, int((cpu_time(pid) or 0) + self.cpu_time + 1)))
+        if memory and self.memory is not None:
+            limits.append((resource.RLIMIT_AS, int(self.memory)))
+        for kind, soft in limits:
+            try:
+                previous = resource.prlimit(pid, kind)
+                hard = previous[1]
+                if hard != resource.RLIM_INFINITY:
+                    soft = min(soft, hard)
+                resource.prlimit(pid, kind, (soft, hard))
+                applied.rlimits.append((kind, previous))
+            except (OSError, ValueError) as e:
+                logger.warning('Could not limit kernel %d: %s', pid, e)
+
+    def _apply_cgroup(self, pid, applied):
+        path = os.path.join(self.cgroup, 'kernel-%d' % pid)
+        try:
+            os.makedirs(path, exist_ok=True)
+            if self.memory is not None:
+                self._write(path, 'memory.max', '%d' % self.memory)
+            if self.cpus is not None:
+                self._write(path, 'cpu.max', '%d %d' % (self.cpus * CGROUP_PERIOD, CGROUP_PERIOD))
+            self._write(path, 'cgroup.procs', '%d' % pid)
+        except OSError as e:
+            logger.warning('Could not create the cgroup %s, limiting kernel %d with rlimits: %s', path, pid, e)
+            _rmdir(path)
+            return False
+        applied.cgroup = path
+        return True
+
+    @staticmethod
+    def _write(path, name, value):
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(value)
+
+
+def _rmdir(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+class AppliedLimits(object):
+    """Limits applied to a kernel
+
+    restore() lifts the rlimits of a kernel going back to the pool, close()
+    removes the cgroup of an exited kernel, pooled kernels get no cgroup.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.rlimits = []
+        self.cgroup = None
+
+    def restore(self):
+        for kind, previous in self.rlimits:
+            try:
+                resource.prlimit(self.pid, kind, previous)
+            except (OSError, ValueError):
+                pass
+        self.rlimits = []
+
+    def close(self):
+        """remove the cgroup of an exited kernel"""
+        if self.cgroup is not None:
+            _rmdir(self.cgroup)
+            self.cgroup = None
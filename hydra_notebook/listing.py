@@ -0,0 +1,69 @@
+import collections
+import os
+import threading
+
+
+class DirectoryListingCache(object):
+    """Cache of directory listings, invalidated by the mtime of the directory
+
+    Works like the path cache of importlib's FileFinder: a lookup costs a
+    single stat of the directory and the directory is rescanned only when
+    its modification time changed.
+    """
+
+    def __init__(self):
+        self._listings = {}
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def _scan(self, directory):
+        self.counters['scans'] += 1
+        files, dirs = set(), set()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            dirs.add(entry.name)
+                        else:
+                            files.add(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        return frozenset(files), frozenset(dirs)
+
+    def _listing(self, directory):
+        directory = directory or '.'
+        self.counters['stats'] += 1
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtime = -1
+        cached = self._listings.get(directory)
+        if cached is not None and cached[0] == mtime:
+            self.counters['hits'] += 1
+            return cached[1], cached[2]
+        files, dirs = self._scan(directory) if mtime != -1 else (frozenset(), frozenset())
+        with self._lock:
+            self._listings[directory] = (mtime, files, dirs)
+        return files, dirs
+
+    def entries(self, directory):
+        """names of the files and of the subdirectories of a directory"""
+        return self._listing(directory)
+
+    def files(self, directory):
+        """names of the files in a directory"""
+        return self._listing(directory)[0]
+
+    def dirs(self, directory):
+        """names of the subdirectories of a directory"""
+        return self._listing(directory)[1]
+
+    def invalidate(self, directory=None):
+        with self._lock:
+            if directory is None:
+                self._listings.clear()
+            else:
+                self._listings.pop(directory or '.', None)
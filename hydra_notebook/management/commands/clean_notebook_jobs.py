@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from hydra_notebook.jobs import get_queue
+
+
+class Command(BaseCommand):
+    help = 'Remove the finished notebook jobs and their executed notebooks beyond the retention.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=float, default=None,
+                            help='Seconds a finished job is kept, default is NOTEBOOKS_JOB_RETENTION or 7 days.')
+        parser.add_argument('--keep', type=int, default=None, help='Keep at most the last KEEP finished jobs.')
+
+    def handle(self, *args, **options):
+        removed = get_queue().clean(max_age=options['max_age'], keep=options['keep'])
+        self.stdout.write('Removed %d notebook jobs.' % removed)
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hydra_notebook.cache import NotebookCodeCache, compile_root, clear_root, CHECKED_HASH, TIMESTAMP
+
+
+class Command(BaseCommand):
+    help = 'Byte-compile the notebooks under NOTEBOOKS_ROOT, so importing them skips parsing and compiling.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('root', nargs='?', default=None, help='Directory to compile, default is NOTEBOOKS_ROOT.')
+        parser.add_argument('-f', '--force', action='store_true', help='Compile even if the cache is up to date.')
+        parser.add_argument('-l', '--no-recursion', dest='recursive', action='store_false',
+                            help="Don't recurse into subdirectories.")
+        parser.add_argument('--invalidation-mode', choices=[TIMESTAMP, CHECKED_HASH], default=None,
+                            help='How the cache is validated against the notebook.')
+        parser.add_argument('--policy', default=None,
+                            help='Import policy of the compiled cells (all or export), default is NOTEBOOKS_IMPORT_POLICY.')
+        parser.add_argument('--clear', action='store_true', help='Remove the cache files instead of compiling.')
+
+    def handle(self, *args, **options):
+        root = options['root'] or settings.NOTEBOOKS_ROOT
+        quiet = 0 if options['verbosity'] > 1 else 1
+        if options['clear']:
+            removed = clear_root(root, recursive=options['recursive'])
+            self.stdout.write('Removed %d notebook cache files.' % removed)
+            return
+        cache = NotebookCodeCache(enabled=True, invalidation_mode=options['invalidation_mode'], write=True)
+        if not compile_root(root, force=options['force'], quiet=quiet, recursive=options['recursive'], cache=cache,
+                            policy=options['policy']):
+            raise CommandError('Some notebooks could not be compiled.')
+        self.stdout.write('Compiled %d notebooks.' % cache.misses)
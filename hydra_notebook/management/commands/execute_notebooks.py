@@ -0,0 +1,84 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hydra_notebook.batch import find_notebooks, execute_batch, execute_parameterized
+from hydra_notebook.core import NotebookExecutor
+from hydra_notebook.exceptions import NotebookNotFindException
+
+
+class Command(BaseCommand):
+    help = 'Execute notebooks under NOTEBOOKS_ROOT concurrently and write them with their outputs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('notebooks', nargs='*',
+                            help='Notebook names, glob patterns or directories under the root, default is every notebook.')
+        parser.add_argument('--root', default=None, help='Notebook directory, default is NOTEBOOKS_ROOT.')
+        parser.add_argument('-j', '--jobs', type=int, default=None,
+                            help='Notebooks executed at the same time, default is NOTEBOOKS_BATCH_WORKERS or the CPUs.')
+        parser.add_argument('--timeout', type=float, default=None, help='Seconds a notebook may run.')
+        parser.add_argument('--cell-timeout', type=int, default=600, help='Seconds a cell may run.')
+        parser.add_argument('--kernel', dest='kernel_name', default='python3', help='Kernel name.')
+        parser.add_argument('--pool', action='store_true', help='Reuse the kernels of the kernel pool.')
+        parser.add_argument('--cell-cache', action='store_true',
+                            help='Reuse the cached outputs of unchanged cells, see NOTEBOOKS_CELL_CACHE_DIR.')
+        parser.add_argument('--engine', choices=NotebookExecutor.engines, default='kernel',
+                            help='forkserver runs the setup cells once and forks a kernel for every notebook.')
+        parser.add_argument('--output-dir', default=None,
+                            help='Write the executed notebooks below this directory instead of in place.')
+        parser.add_argument('--parameters', default=None,
+                            help='A json object of parameters, or a list of them to execute every notebook once for '
+                                 'each, written to the output directory as <name>-<index>.')
+        parser.add_argument('--cells', default=None,
+                            help="Execute only these cells, e.g. '12:' or '3,5', the others keep their outputs.")
+        parser.add_argument('--tags', default=None, help='Execute only the cells with one of these comma separated tags.')
+        parser.add_argument('--target', type=int, default=None,
+                            help='Execute this cell and the earlier cells binding the names it reads.')
+        parser.add_argument('--memoize', action='store_true',
+                            help='Take unchanged executions from the result store, see NOTEBOOKS_RESULT_CACHE_DIR.')
+        parser.add_argument('--checkpoint', action='store_true',
+                            help='Save the namespace and the notebook after the cells, see NOTEBOOKS_CHECKPOINT_DIR.')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue after the last checkpoint of unchanged cells, implies --checkpoint.')
+
+    def handle(self, *args, **options):
+        root = options['root'] or settings.NOTEBOOKS_ROOT
+        try:
+            names = find_notebooks(options['notebooks'], root)
+        except NotebookNotFindException as e:
+            raise CommandError(e)
+        execute_options = dict(root=root, max_workers=options['jobs'], output_dir=options['output_dir'],
+                               kernel_name=options['kernel_name'], timeout=options['timeout'],
+                               cell_timeout=options['cell_timeout'], pool=options['pool'],
+                               cell_cache=options['cell_cache'], engine=options['engine'], memoize=options['memoize'],
+                               cells=options['cells'], tags=options['tags'] and options['tags'].split(','),
+                               target=options['target'], checkpoint=options['checkpoint'], resume=options['resume'])
+        start = time.perf_counter()
+        if options['parameters'] is None:
+            runs = execute_batch(names, **execute_options)
+        else:
+            try:
+                parameter_sets = json.loads(options['parameters'])
+            except ValueError as e:
+                raise CommandError('--parameters is not json: %s' % e)
+            if isinstance(parameter_sets, dict):
+                parameter_sets = [parameter_sets]
+            if not options['output_dir']:
+                raise CommandError('Notebooks executed with parameters are written to the --output-dir only.')
+            # one bounded pool for every notebook and parameter set
+            runs = execute_parameterized(names, parameter_sets, **execute_options)
+        wall_time = time.perf_counter() - start
+
+        failed = [run for run in runs if not run.ok]
+        for run in runs:
+            status = 'cached' if run.cached else 'ok' if run.ok else 'TIMEOUT' if run.timed_out else 'FAILED'
+            line = '%-8s %8.1fs  %s' % (status, run.duration, run.name)
+            if run.parameters is not None:
+                line = '%s  %s' % (line, json.dumps(run.parameters, sort_keys=True))
+            self.stdout.write(line if run.ok else '%s  %s' % (line, run.error))
+        self.stdout.write('Executed %d notebooks in %.1fs wall time (%.1fs total), %d failed.' % (
+            len(runs), wall_time, sum(run.duration for run in runs), len(failed)))
+        if failed:
+            raise CommandError('%d notebooks failed.' % len(failed))
@@ -0,0 +1,52 @@
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from hydra_notebook.conf import get_setting
+from hydra_notebook.dbjobs import DatabaseJobQueue
+from hydra_notebook.jobs import JobWorker
+
+
+class Command(BaseCommand):
+    help = 'Execute the notebook jobs queued in the database, any number of workers can run on any number of hosts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--concurrency', type=int, default=None,
+                            help='Jobs executed at the same time, default is NOTEBOOKS_JOB_WORKERS or 2.')
+        parser.add_argument('--lease', type=float, default=None,
+                            help='Seconds a running job stays owned without a heartbeat, default is '
+                                 'NOTEBOOKS_JOB_LEASE or 60. Jobs of dead workers are retried after it.')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls of an empty queue.')
+        parser.add_argument('--burst', action='store_true', help='Exit when the queue is empty.')
+
+    def handle(self, *args, **options):
+        queue = DatabaseJobQueue(lease=options['lease'])
+        concurrency = options['concurrency'] or get_setting('NOTEBOOKS_JOB_WORKERS', 2)
+        worker = JobWorker(queue, max_workers=concurrency, interval=options['interval'])
+        start = time.perf_counter()
+        if options['burst']:
+            count = worker.drain()
+            self.stdout.write('Worker %s executed %d jobs in %.1fs.' % (queue.worker, count,
+                                                                      time.perf_counter() - start))
+            return
+
+        stopping = threading.Event()
+
+        def stop(signum, frame):
+            self.stdout.write('Stopping worker %s after the running jobs ...' % queue.worker)
+            stopping.set()
+
+        previous = signal.signal(signal.SIGTERM, stop)
+        self.stdout.write('Worker %s executes %d jobs at a time (lease %ss).' % (queue.worker, concurrency,
+                                                                               queue.lease))
+        worker.start()
+        try:
+            while not stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping worker %s after the running jobs ...' % queue.worker)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            worker.stop()
@@ -0,0 +1,45 @@
+# Generated by Django 2.1 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotebookJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('notebook', models.CharField(help_text='notebook name under NOTEBOOKS_ROOT', max_length=255)),
+                ('options_json', models.TextField(blank=True, default='{}', help_text='json of the execution options')),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('finished', 'finished'), ('failed', 'failed')], default='queued', max_length=16)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('worker', models.CharField(blank=True, default='', max_length=255)),
+                ('heartbeat', models.DateTimeField(blank=True, null=True)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=3)),
+                ('cells', models.PositiveIntegerField(blank=True, null=True)),
+                ('cells_done', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='notebookjob',
+            index=models.Index(fields=['status', 'id'], name='hydra_noteb_status_9dfadf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notebookjob',
+            index=models.Index(fields=['status', 'lease_expires'], name='hydra_noteb_status_3b0b9e_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1 on 2026-10-18 16:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hydra_notebook', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notebookjob',
+            name='priority',
+            field=models.CharField(choices=[('interactive', 'interactive'), ('default', 'default'), ('batch', 'batch')], default='default', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='notebookjob',
+            name='tenant',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
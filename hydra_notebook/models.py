@@ -1,8 +1,54 @@
+import json
+
 from django.db import models
 
-# Create your models here.
-# class ManagedNotebookModel(models.Model):
-#     name = models.CharField(max_length=100)
-#     path = models.FilePathField(allow_files=True, allow_folders=False)
-#
-#
+from .scheduler import PRIORITIES
+
+
+class NotebookJob(models.Model):
+    """A notebook execution in the database job queue
+
+    A worker owns a running job as long as its lease has not expired, it
+    extends the lease with heartbeats. See hydra_notebook.dbjobs.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'queued'), (RUNNING, 'running'), (FINISHED, 'finished'), (FAILED, 'failed')]
+
+    notebook = models.CharField(max_length=255, help_text='notebook name under NOTEBOOKS_ROOT')
+    # json, models.JSONField needs Django 3.1
+    options_json = models.TextField(default='{}', blank=True, help_text='json of the execution options')
+    priority = models.CharField(max_length=16, choices=[(p, p) for p in PRIORITIES], default='default')
+    tenant = models.CharField(max_length=255, null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUSES, default=QUEUED)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=255, blank=True, default='')
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    cells = models.PositiveIntegerField(null=True, blank=True)
+    cells_done = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'id']),
+            models.Index(fields=['status', 'lease_expires']),
+        ]
+
+    @property
+    def options(self):
+        return json.loads(self.options_json or '{}')
+
+    @options.setter
+    def options(self, options):
+        self.options_json = json.dumps(options)
+
+    def __str__(self):
+        return '%s %s (%s)' % (self.pk, self.notebook, self.status)
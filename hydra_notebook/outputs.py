@@ -0,0 +1,251 @@
+"""Bounded outputs of notebook executions
+
+The outputs of a running notebook arrive message by message. An
+OutputCapture keeps at most ``cell_limit`` characters of them per cell and
+``total_limit`` per notebook in memory. A longer stream keeps its
+first and last characters around a marker, other outputs beyond the limits are
+replaced by a short placeholder. With ``spill_size``, outputs larger than
+it and the cut parts are written whole to side files, the marker, the
+placeholder metadata and the ``spilled_outputs`` cell metadata refer to
+them relative to the notebook. Errors are always kept.
+"""
+import collections
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+
+from nbformat.v4 import new_output
+
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+# the text/plain of a placeholder keeps this many characters at most
+PLACEHOLDER_TEXT = 1024
+
+
+def output_size(output):
+    """characters of an output, non-text data counts with the length of its json"""
+    if output.output_type == 'stream':
+        return len(output.text)
+    if output.output_type == 'error':
+        return len(output.evalue) + sum(len(line) for line in output.traceback)
+    return sum(len(value) if isinstance(value, str) else len(json.dumps(value))
+               for value in output.get('data', {}).values())
+
+
+class OutputPolicy(object):
+    """Limits in characters of the outputs of an execution kept in memory, None for no limit"""
+
+    def __init__(self, cell_limit=None, total_limit=None, spill_size=None):
+        self.cell_limit = cell_limit
+        self.total_limit = total_limit
+        self.spill_size = spill_size
+
+    @classmethod
+    def from_settings(cls):
+        return cls(cell_limit=get_setting('NOTEBOOKS_OUTPUT_CELL_LIMIT'),
+                   total_limit=get_setting('NOTEBOOKS_OUTPUT_TOTAL_LIMIT'),
+                   spill_size=get_setting('NOTEBOOKS_OUTPUT_SPILL_SIZE'))
+
+    def __bool__(self):
+        return any(limit is not None for limit in (self.cell_limit, self.total_limit, self.spill_size))
+
+
+class StreamBuffer(object):
+    """A stream output of a cell, the head and the tail of its text within ``capacity`` characters"""
+
+    def __init__(self, output, capacity, spill_path=None):
+        self.output = output
+        self.capacity = capacity
+        self.spill_path = spill_path
+        self.head = []
+        self.head_size = 0
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.truncated = 0
+        self.file = None
+
+    @property
+    def size(self):
+        return self.head_size + self.tail_size
+
+    def write(self, text):
+        if self.file is not None:
+            self.file.write(text)
+        if self.head_size < self.capacity // 2:
+            part = text[:self.capacity // 2 - self.head_size]
+            self.head.append(part)
+            self.head_size += len(part)
+            text = text[len(part):]
+        if not text:
+            return
+        self.tail.append(text)
+        self.tail_size += len(text)
+        excess = self.tail_size - (self.capacity - self.head_size)
+        if excess <= 0:
+            return
+        if self.truncated == 0 and self.spill_path is not None:
+            # the whole text is kept so far, the side file gets all of it
+            os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+            self.file = open(self.spill_path, 'a', encoding='utf-8')
+            self.file.write(''.join(self.head) + ''.join(self.tail))
+        self.truncated += excess
+        self.tail_size -= excess
+        while excess:
+            if len(self.tail[0]) <= excess:
+                excess -= len(self.tail.popleft())
+            else:
+                self.tail[0] = self.tail[0][excess:]
+                excess = 0
+
+    def finish(self, reference=None):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        text = ''.join(self.head)
+        if self.truncated:
+            text += '\n... %d characters truncated%s ...\n' % (
+                self.truncated, ', the whole %s is in %s' % (self.output.name, reference) if reference else '')
+        self.output.text = text + ''.join(self.tail)
+
+
+class OutputCapture(object):
+    """Applies an OutputPolicy to the outputs of one execution
+
+    ``add`` appends an output of a cell, merging the streams like a kernel
+    client does, ``cleared`` forgets the cleared outputs of a cell and
+    ``finish`` completes the outputs of a cell once it ran. The side files
+    go below ``spill_dir``, referred to relative to ``notebook_dir``.
+    """
+
+    def __init__(self, policy, spill_dir=None, notebook_dir=None):
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.notebook_dir = notebook_dir
+        self.total = 0
+        self.cells = collections.defaultdict(int)
+        # the stream outputs of the cells, and the last one of every stream
+        self.buffers = collections.defaultdict(list)
+        self.streams = {}
+        self.spilled = collections.defaultdict(list)
+        # the cells whose outputs were cut
+        self.bounded = set()
+        self._lock = threading.Lock()
+
+    @property
+    def spills(self):
+        return self.policy.spill_size is not None and self.spill_dir is not None
+
+    def clean(self):
+        """remove the side files of an earlier run"""
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def reference(self, path):
+        return os.path.relpath(path, self.notebook_dir) if self.notebook_dir else path
+
+    def remaining(self, cell_index):
+        limits = []
+        if self.policy.cell_limit is not None:
+            limits.append(self.policy.cell_limit - self.cells[cell_index])
+        if self.policy.total_limit is not None:
+            limits.append(self.policy.total_limit - self.total)
+        if self.spills:
+            limits.append(self.policy.spill_size)
+        return max(min(limits), 0) if limits else None
+
+    def _charge(self, cell_index, size):
+        self.cells[cell_index] += size
+        self.total += size
+
+    def _spill_path(self, cell_index, name):
+        return os.path.join(self.spill_dir, 'cell-%d-%s' % (cell_index, name))
+
+    def add(self, outs, output, cell_index):
+        with self._lock:
+            if output.output_type == 'stream':
+                self._add_stream(outs, output, cell_index)
+                return
+            size = output_size(output)
+            remaining = self.remaining(cell_index)
+            if output.output_type == 'error' or remaining is None or size <= remaining:
+                self._charge(cell_index, size)
+            else:
+                output = self._placeholder(output, size, cell_index, len(outs))
+                self.bounded.add(cell_index)
+                self._charge(cell_index, output_size(output))
+            outs.append(output)
+
+    def _add_stream(self, outs, output, cell_index):
+        buffer = self.streams.get((cell_index, output.name))
+        if buffer is None or not outs or outs[-1] is not buffer.output:
+            # the first text of the stream, or the first after another output
+            capacity = self.remaining(cell_index)
+            if capacity is None:
+                capacity = sys.maxsize
+            spill_path = None
+            if self.spills:
+                spill_path = self._spill_path(cell_index, '%d-%s.txt' % (len(outs), output.name))
+            buffer = StreamBuffer(new_output('stream', name=output.name, text=''), capacity, spill_path)
+            self.streams[(cell_index, output.name)] = buffer
+            self.buffers[cell_index].append(buffer)
+            outs.append(buffer.output)
+        size = buffer.size
+        buffer.write(output.text)
+        # the text of the output is set when the cell finished
+        self._charge(cell_index, buffer.size - size)
+
+    def _placeholder(self, output, size, cell_index, position):
+        metadata = dict(output.get('metadata', {}), truncated=size)
+        where = ''
+        if self.spills:
+            path = self._spill_path(cell_index, '%d.json' % position)
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(output, f)
+            metadata['spilled'] = self.reference(path)
+            self.spilled[cell_index].append(metadata['spilled'])
+            where = ', in %s' % metadata['spilled']
+        text = output.get('data', {}).get('text/plain', '')
+        if isinstance(text, list):
+            text = ''.join(text)
+        notice = '<%s output of %d characters%s>' % (output.output_type, size, where)
+        text = '%s\n%s' % (text[:PLACEHOLDER_TEXT], notice) if text else notice
+        placeholder = dict(data={'text/plain': text}, metadata=metadata)
+        if output.output_type == 'execute_result':
+            placeholder['execution_count'] = output.get('execution_count')
+        return new_output(output.output_type, **placeholder)
+
+    def cleared(self, cell_index):
+        with self._lock:
+            self.total -= self.cells.pop(cell_index, 0)
+            self.spilled.pop(cell_index, None)
+            self.bounded.discard(cell_index)
+            for buffer in self.buffers.pop(cell_index, ()):
+                self.streams.pop((cell_index, buffer.output.name), None)
+                if buffer.file is not None:
+                    buffer.file.close()
+
+    def finish(self, cell, cell_index):
+        """complete the outputs of a cell, return True if some were cut"""
+        with self._lock:
+            bounded = cell_index in self.bounded
+            self.bounded.discard(cell_index)
+            for buffer in self.buffers.pop(cell_index, ()):
+                self.streams.pop((cell_index, buffer.output.name), None)
+                reference = None
+                bounded = bounded or bool(buffer.truncated)
+                if buffer.spill_path is not None and buffer.truncated:
+                    reference = self.reference(buffer.spill_path)
+                    self.spilled[cell_index].append(reference)
+                buffer.finish(reference)
+            spilled = self.spilled.pop(cell_index, None)
+            if spilled:
+                cell.metadata['spilled_outputs'] = spilled
+            elif 'spilled_outputs' in cell.metadata:
+                del cell.metadata['spilled_outputs']
+            return bounded
@@ -0,0 +1,153 @@
+"""Parallel in-process notebook execution
+
+Runs the code cells of trusted notebooks like the in-process engine, but
+a code cell starts as soon as the cells it depends on finished, see
+hydra_notebook.dag. The cells run on threads sharing the namespace of one
+InteractiveShell, so the names bound by independent cells are merged as
+they are bound. Cells waiting on I/O, sleeping or in code releasing the
+GIL (numpy, pandas, compression, database drivers) overlap, pure Python
+cells do not run faster.
+
+The outputs and execution counts are those of a run in notebook order.
+Outputs of threads started by the cells are lost, and the cell hooks are
+called from the threads running the cells.
+"""
+import ast
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from nbformat.v4 import new_output
+
+from .conf import get_setting
+from .dag import cell_graph
+from .inprocess import InProcessExecutePreprocessor, InProcessShell
+
+logger = logging.getLogger(__name__)
+
+
+class CellState(threading.local):
+    """outputs of the cell running in the current thread"""
+
+    def __init__(self):
+        self.outputs = []
+        self.displays = {}
+        self.error = None
+        self.clear_on_output = False
+        self.cell_index = None
+
+
+def _cell_state(name):
+    return property(lambda self: getattr(self._cell, name), lambda self, value: setattr(self._cell, name, value))
+
+
+class ParallelShell(InProcessShell):
+    """InProcessShell recording the outputs of the cells running in several threads"""
+
+    outputs = _cell_state('outputs')
+    displays = _cell_state('displays')
+    error = _cell_state('error')
+    _clear_on_output = _cell_state('clear_on_output')
+    cell_index = _cell_state('cell_index')
+
+    def __init__(self, **kwargs):
+        self._cell = CellState()
+        # the traceback formatter and the compiler cache are shared
+        self._traceback_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def run_source(self, source, execution_count):
+        """run a cell like run_cell, in any thread while other cells run
+
+        The history, the output caching (``_``, ``Out``) and the post
+        execution hooks are left out, cells needing them run with run_cell.
+        """
+        try:
+            with self._traceback_lock:
+                transformed = self.transform_cell(source)
+                filename = self.compile.cache(transformed, execution_count, raw_code=source)
+            tree = ast.parse(transformed, filename)
+            expression = None
+            if tree.body and isinstance(tree.body[-1], ast.Expr) and not transformed.rstrip().endswith(';'):
+                expression = compile(ast.Expression(tree.body.pop().value), filename, 'eval')
+            code = compile(tree, filename, 'exec')
+        except SyntaxError:
+            with self._traceback_lock:
+                self.showsyntaxerror()
+            return
+        try:
+            exec(code, self.user_global_ns, self.user_ns)
+            result = None if expression is None else eval(expression, self.user_global_ns, self.user_ns)
+        except Exception:
+            with self._traceback_lock:
+                self.showtraceback()
+            return
+        if result is not None:
+            data, metadata = self.display_formatter.format(result)
+            self.add_output(new_output('execute_result', data=data, metadata=metadata,
+                                       execution_count=execution_count))
+
+
+class ParallelExecutePreprocessor(InProcessExecutePreprocessor):
+    """InProcessExecutePreprocessor running independent code cells at the same time
+
+    ``max_workers`` is the number of cells running at the same time, by
+    default NOTEBOOKS_PARALLEL_WORKERS. When a cell fails, no further cell
+    is started and the error of the first failed cell is raised once the
+    running cells finished.
+    """
+
+    shell_class = ParallelShell
+
+    def __init__(self, max_workers=None, **kwargs):
+        super().__init__(**kwargs)
+        self.max_workers = get_setting('NOTEBOOKS_PARALLEL_WORKERS', 4) if max_workers is None else max_workers
+        self.graph = {}
+        self.counts = {}
+        self.sequential = set()
+
+    def preprocess(self, nb, resources=None, km=None):
+        nodes = {}
+        self.graph = cell_graph(nb, nodes)
+        self.sequential = {index for index, node in nodes.items() if node.sequential}
+        # the execution counts of a run in notebook order
+        runnable = [index for index in sorted(self.graph) if nb.cells[index].source.strip()
+                    and self.skip_cells_with_tag not in nb.cells[index].metadata.get('tags', [])]
+        self.counts = {index: count for count, index in enumerate(runnable, 1)}
+        return super().preprocess(nb, resources, km)
+
+    def preprocess_cells(self, nb, resources):
+        for index, cell in enumerate(nb.cells):
+            if index not in self.graph:
+                self.preprocess_cell(cell, resources, index)
+        pending, done, failed, running = dict(self.graph), set(), {}, {}
+        with ThreadPoolExecutor(self.max_workers, thread_name_prefix='notebook-cell') as executor:
+            while True:
+                if not failed:
+                    for index in [index for index in sorted(pending) if pending[index] <= done]:
+                        del pending[index]
+                        running[executor.submit(self.preprocess_cell, nb.cells[index], resources, index)] = index
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(index)
+                    except Exception as e:
+                        failed[index] = e
+        if failed:
+            if pending:
+                logger.info('Cells %s were not executed after cell %d failed', sorted(pending), min(failed))
+            raise failed[min(failed)]
+
+    def run_cell(self, cell, cell_index, store_history=True):
+        count = self.counts.get(cell_index, 0)
+        if cell_index in self.sequential:
+            # no other cell runs, the shell runs it with magics, top level await and the output caching
+            self.shell.execution_count = count
+            self.shell.run_cell(cell.source, store_history=store_history)
+        else:
+            self.shell.run_source(cell.source, count)
+        return count
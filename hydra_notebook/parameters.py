@@ -0,0 +1,81 @@
+"""Parameterised notebook execution
+
+The parameters of a run are assigned in a code cell tagged
+``injected-parameters``, inserted after the cell tagged ``parameters``
+(which holds the defaults) or at the top of the notebook, never inside
+the leading setup cells shared by the fork server. The executed
+notebooks are memoised by the hash of the notebook sources, the kernel
+name and the canonical json of the parameters.
+"""
+import json
+
+from nbformat.v4 import new_code_cell
+
+from .cache import source_hash
+from .cellcache import CellOutputStore
+from .conf import cache_directory, get_setting
+from .forkserver import SETUP_TAG, setup_cells
+
+PARAMETERS_TAG = 'parameters'
+INJECTED_TAG = 'injected-parameters'
+
+
+def canonical_parameters(parameters):
+    """json of the parameters with sorted keys, equal for equal parameters"""
+    return json.dumps(parameters or {}, sort_keys=True, separators=(',', ':'), default=repr)
+
+
+def parameters_source(parameters):
+    for name in parameters:
+        if not isinstance(name, str) or not name.isidentifier():
+            raise ValueError('Notebook parameter names must be identifiers, not %r' % (name,))
+    return '\n'.join(['# Parameters'] + ['%s = %r' % (name, value) for name, value in sorted(parameters.items())])
+
+
+def remove_parameters(nb):
+    """remove the injected parameters cells"""
+    nb.cells = [cell for cell in nb.cells if INJECTED_TAG not in cell.metadata.get('tags', [])]
+
+
+def inject_parameters(nb, parameters, tag=PARAMETERS_TAG, setup_tag=SETUP_TAG):
+    """insert the cell assigning the parameters, replaces a previously injected one"""
+    remove_parameters(nb)
+    cell = new_code_cell(parameters_source(parameters), metadata={'tags': [INJECTED_TAG]})
+    index = next((index + 1 for index, c in enumerate(nb.cells) if tag in c.metadata.get('tags', [])), 0)
+    # after the setup prefix, the setup cells stay shared by the executions with other parameters
+    setup = setup_cells(nb, setup_tag)
+    index = max(index, setup[-1] + 1 if setup else 0)
+    nb.cells.insert(index, cell)
+    return cell
+
+
+def notebook_hash(nb):
+    """hash of the cells of a notebook without their outputs"""
+    return source_hash(json.dumps([(cell.cell_type, cell.source, cell.metadata.get('tags', []))
+                                   for cell in nb.cells]))
+
+
+def result_key(nb, parameters, kernel_name):
+    return source_hash('%s\n%s\n%s' % (notebook_hash(nb), kernel_name, canonical_parameters(parameters)))
+
+
+class NotebookResultStore(CellOutputStore):
+    """On-disk store of executed notebooks by result_key(), least recently used ones are evicted"""
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            return get_setting('NOTEBOOKS_RESULT_CACHE_DIR') or cache_directory('results')
+        return self._directory
+
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            return get_setting('NOTEBOOKS_RESULT_CACHE_SIZE', 1024 ** 3)
+        return self._max_size
+
+    def put(self, key, nb):
+        self._write(key, nb)
+
+
+result_store = NotebookResultStore()
@@ -0,0 +1,231 @@
+import collections
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import types
+import weakref
+
+from .conf import get_setting
+from .lazy import is_loaded
+
+logger = logging.getLogger(__name__)
+
+
+def module_size(mod, limit=1000000):
+    """estimate the memory held by the objects of a notebook module namespace
+
+    Follows the references of the module namespace, but not into other
+    modules, their classes and functions, so shared library objects are not
+    counted. At most ``limit`` objects are visited.
+    """
+    namespace = mod.__dict__
+    seen = {id(namespace)}
+    total = sys.getsizeof(namespace)
+    stack = [value for name, value in namespace.items() if name != '__builtins__']
+    while stack and len(seen) < limit:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, types.ModuleType):
+            continue
+        if isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType)) \
+                and getattr(obj, '__module__', None) != mod.__name__:
+            continue
+        try:
+            total += sys.getsizeof(obj)
+        except TypeError:
+            continue
+        stack.extend(gc.get_referents(obj))
+    return total
+
+
+def current_rss():
+    """resident set size of the process in bytes, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class EvictionReport(object):
+    """Notebook modules evicted by the registry and the memory reclaimed"""
+
+    def __init__(self, modules=None, estimated_bytes=0, rss_before=None, rss_after=None, collected=None):
+        self.modules = modules or []
+        self.estimated_bytes = estimated_bytes
+        self.rss_before = rss_before
+        self.rss_after = rss_after
+        # the modules still referenced from somewhere else could not be garbage collected
+        self.collected = collected or []
+
+    @property
+    def rss_reclaimed(self):
+        if self.rss_before is None or self.rss_after is None:
+            return None
+        return self.rss_before - self.rss_after
+
+    def __bool__(self):
+        return bool(self.modules)
+
+    def __repr__(self):
+        return 'EvictionReport(modules=%r, estimated_bytes=%d, rss_reclaimed=%r)' % (
+            self.modules, self.estimated_bytes, self.rss_reclaimed)
+
+
+class NotebookModuleRegistry(object):
+    """LRU registry of the imported notebook modules
+
+    Idle notebook modules are removed from sys.modules when there are more
+    than ``max_modules`` of them, when their estimated size exceeds the
+    ``memory_budget`` (bytes) or when they were not used for ``idle_timeout``
+    seconds. An evicted notebook is imported again by the next import.
+    Use is recorded when a notebook is imported and by import_notebook()
+    and get(), plain attribute access is not tracked.
+    """
+
+    def __init__(self, max_modules=None, memory_budget=None, idle_timeout=None):
+        self._max_modules = max_modules
+        self._memory_budget = memory_budget
+        self._idle_timeout = idle_timeout
+        self._entries = collections.OrderedDict()
+        self._evicted = set()
+        self._lock = threading.RLock()
+        self.counters = collections.Counter()
+
+    @property
+    def max_modules(self):
+        return get_setting('NOTEBOOKS_MODULE_LIMIT') if self._max_modules is None else self._max_modules
+
+    @property
+    def memory_budget(self):
+        return get_setting('NOTEBOOKS_MODULE_MEMORY_BUDGET') if self._memory_budget is None else self._memory_budget
+
+    @property
+    def idle_timeout(self):
+        return get_setting('NOTEBOOKS_MODULE_IDLE_TIMEOUT') if self._idle_timeout is None else self._idle_timeout
+
+    @property
+    def enabled(self):
+        return any(limit is not None for limit in (self.max_modules, self.memory_budget, self.idle_timeout))
+
+    def __contains__(self, fullname):
+        return fullname in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def register(self, mod):
+        """track a freshly imported notebook module and enforce the limits"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if mod.__name__ in self._evicted:
+                self._evicted.discard(mod.__name__)
+                self.counters['reimports'] += 1
+            self.counters['imports'] += 1
+            self._entries[mod.__name__] = dict(ref=weakref.ref(mod), used=time.monotonic(), size=module_size(mod))
+            self._entries.move_to_end(mod.__name__)
+            return self.enforce(keep=mod.__name__)
+
+    def touch(self, fullname):
+        with self._lock:
+            entry = self._entries.get(fullname)
+            if entry is not None:
+                entry['used'] = time.monotonic()
+                self._entries.move_to_end(fullname)
+
+    def get(self, fullname, **options):
+        """return a notebook module, import it again if it was evicted"""
+        from .importer import import_notebook
+        mod = import_notebook(fullname, **options)
+        self.touch(fullname)
+        return mod
+
+    def measure(self):
+        """estimate the size of the tracked modules again, e.g. after lazy modules loaded"""
+        with self._lock:
+            for entry in self._entries.values():
+                mod = entry['ref']()
+                if mod is not None:
+                    entry['size'] = module_size(mod)
+
+    @property
+    def size(self):
+        return sum(entry['size'] for entry in self._entries.values())
+
+    def _victims(self, keep=None):
+        now = time.monotonic()
+        victims = []
+        count, size = len(self._entries), self.size
+        # the least recently used modules come first
+        for name, entry in self._entries.items():
+            if name == keep or not self._evictable(entry):
+                continue
+            idle = self.idle_timeout is not None and now - entry['used'] > self.idle_timeout
+            over_count = self.max_modules is not None and count > self.max_modules
+            over_budget = self.memory_budget is not None and size > self.memory_budget
+            if idle or over_count or over_budget:
+                victims.append(name)
+                count -= 1
+                size -= entry['size']
+        return victims
+
+    def enforce(self, keep=None):
+        """evict the modules over the limits, ``keep`` is never evicted"""
+        with self._lock:
+            victims = self._victims(keep)
+        return self.evict(*victims) if victims else EvictionReport()
+
+    @staticmethod
+    def _evictable(entry):
+        # the pending cells of a lazy module run from its loader state, it is evicted once loaded
+        mod = entry['ref']()
+        return mod is None or is_loaded(mod)
+
+    def evict(self, *fullnames):
+        """remove notebook modules from sys.modules and let their objects be garbage collected
+
+        Lazy modules with pending cells are skipped.
+        """
+        report = EvictionReport(rss_before=current_rss())
+        refs = []
+        with self._lock:
+            for fullname in fullnames:
+                entry = self._entries.get(fullname)
+                if entry is None or not self._evictable(entry):
+                    continue
+                del self._entries[fullname]
+                mod = entry['ref']()
+                if mod is not None and sys.modules.get(fullname) is mod:
+                    del sys.modules[fullname]
+                    parent, _, child = fullname.rpartition('.')
+                    if parent in sys.modules and getattr(sys.modules[parent], child, None) is mod:
+                        delattr(sys.modules[parent], child)
+                    # the compiled cells are loaded from the bytecode cache on the next import
+                    mod.__spec__.loader_state = None
+                del mod
+                refs.append((fullname, entry['ref']))
+                report.modules.append(fullname)
+                report.estimated_bytes += entry['size']
+                self._evicted.add(fullname)
+            self.counters['evictions'] += len(report.modules)
+            self.counters['reclaimed_bytes'] += report.estimated_bytes
+        gc.collect()
+        report.collected = [fullname for fullname, ref in refs if ref() is None]
+        report.rss_after = current_rss()
+        if report:
+            logger.info('Evicted notebook modules %s', report)
+        return report
+
+    def statistics(self):
+        stats = dict(self.counters)
+        stats.update(modules=len(self._entries), estimated_bytes=self.size)
+        return stats
+
+
+registry = NotebookModuleRegistry()
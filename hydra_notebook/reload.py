@@ -0,0 +1,133 @@
+import difflib
+import logging
+import os
+import sys
+import threading
+
+from .analysis import loaded_names
+from .conf import get_setting
+from .lazy import load
+from .state import NotebookState
+
+logger = logging.getLogger(__name__)
+
+
+def _state(mod):
+    spec = getattr(mod, '__spec__', None)
+    state = getattr(spec, 'loader_state', None)
+    return state if isinstance(state, NotebookState) else None
+
+
+def dirty_cells(old_cells, new_cells):
+    """indexes (in new_cells) of the cells a reload has to run again
+
+    The changed and inserted cells are dirty, and so are the cells after
+    them which read a name bound by a dirty or by a removed cell.
+    """
+    state, old_state = NotebookState(None, new_cells), NotebookState(None, old_cells)
+    matcher = difflib.SequenceMatcher(a=[cell.source_hash for cell in old_cells],
+                                      b=[cell.source_hash for cell in new_cells], autojunk=False)
+    unchanged = set()
+    removed = set()
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            unchanged.update(range(j1, j2))
+        else:
+            for i in range(i1, i2):
+                removed.update(old_state.names(i)[0])
+
+    dirty, invalidated, anything = [], set(removed), False
+    for index, cell in enumerate(new_cells):
+        stored, star = state.names(index)
+        if index not in unchanged or anything or loaded_names(cell.code) & invalidated:
+            dirty.append(index)
+            invalidated.update(stored)
+            # star imports and magics may bind any name, everything after them runs again
+            anything = anything or star or cell.needs_shell
+    return dirty, removed
+
+
+def reload_notebook(mod):
+    """rerun the changed cells of an imported notebook in its module namespace
+
+    Names bound only by removed cells are deleted from the module. Lazy
+    modules are loaded completely first. Returns the notebook indexes of the
+    cells which ran again.
+    """
+    state = _state(mod)
+    if state is None:
+        raise ValueError('%r is not an imported notebook' % mod.__name__)
+    load(mod)
+    path = mod.__spec__.origin
+    with state.lock:
+        mtime = os.stat(path).st_mtime_ns
+        new_cells = state.loader.cache.get(path, policy=state.policy)
+        dirty, removed = dirty_cells(state.cells, new_cells)
+        # the new cells are kept even if one of them fails, the next change is reloaded again
+        state.replace(new_cells, len(new_cells), mtime)
+
+        bound = set()
+        for index in range(len(new_cells)):
+            bound.update(state.names(index)[0])
+        for name in removed - bound:
+            mod.__dict__.pop(name, None)
+
+        for index in dirty:
+            state.loader.run_cells(mod, [new_cells[index]])
+    ran = [new_cells[index].index for index in dirty]
+    logger.info('Reloaded notebook %s, cells run again: %s', mod.__name__, ran)
+    return ran
+
+
+class NotebookWatcher(object):
+    """Reloads the imported notebooks under a root directory when they change
+
+    The watcher polls the modification time of the notebooks imported so
+    far, it never walks the directory tree.
+    """
+
+    def __init__(self, root=None, interval=None):
+        self.root = os.path.abspath(get_setting('NOTEBOOKS_ROOT') if root is None else root)
+        self.interval = get_setting('NOTEBOOKS_AUTORELOAD_INTERVAL', 1.0) if interval is None else interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def modules(self):
+        for mod in list(sys.modules.values()):
+            state = _state(mod)
+            if state is not None and state.mtime is not None \
+                    and os.path.abspath(mod.__spec__.origin).startswith(self.root + os.sep):
+                yield mod, state
+
+    def check(self):
+        """reload the changed notebooks once, return their module names"""
+        reloaded = []
+        for mod, state in self.modules():
+            try:
+                mtime = os.stat(mod.__spec__.origin).st_mtime_ns
+            except OSError:
+                continue
+            if mtime == state.mtime:
+                continue
+            try:
+                reload_notebook(mod)
+            except Exception:
+                logger.exception('Reloading notebook %s failed', mod.__name__)
+            reloaded.append(mod.__name__)
+        return reloaded
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='notebook-watcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
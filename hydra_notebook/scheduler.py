@@ -0,0 +1,151 @@
+"""Order of the queued notebook jobs
+
+The queues claim the first job of Scheduler.order(): jobs of a higher
+priority class first, then jobs of the tenants with the fewest running
+jobs, then the jobs expected to finish first by the past run durations of
+their notebook. A job waiting NOTEBOOKS_SCHEDULER_AGING seconds moves up
+one priority class, so batch jobs are not starved.
+"""
+import collections
+import datetime
+import json
+import logging
+import os
+import threading
+
+from .conf import get_setting
+
+try:
+    import fcntl
+except ImportError:
+    # not a unix, concurrent updates of the history may be lost
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = ('interactive', 'default', 'batch')
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600, float('inf'))
+
+
+def parse_time(value):
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
+class RunHistory(object):
+    """Expected run durations of the notebooks
+
+    A moving average of the durations of the runs of every notebook, kept
+    in a json file shared by the workers of a queue.
+    """
+
+    def __init__(self, path, weight=0.3):
+        self.path = path
+        self.weight = weight
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._durations = {}
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def durations(self):
+        """mean duration and number of runs by notebook"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return {}
+        with self._lock:
+            if self._loaded != mtime:
+                self._durations, self._loaded = self._read(), mtime
+            return self._durations
+
+    def expected(self, notebook):
+        """expected duration of a run of the notebook in seconds, None without a past run"""
+        entry = self.durations().get(notebook)
+        return entry['mean'] if entry else None
+
+    def record(self, notebook, duration):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock, open(self.path + '.lock', 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            durations = self._read()
+            entry = durations.get(notebook)
+            if entry is None:
+                entry = durations[notebook] = dict(mean=duration, runs=0)
+            entry['mean'] += self.weight * (duration - entry['mean'])
+            entry['runs'] += 1
+            tmp_path = '%s.%d.%d.tmp' % (self.path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(durations, f)
+            os.replace(tmp_path, self.path)
+
+
+class Scheduler(object):
+    """Orders queued jobs by priority class, fair share of the tenants and expected duration"""
+
+    def __init__(self, history, aging=None, default_duration=None):
+        self.history = history
+        self.aging = get_setting('NOTEBOOKS_SCHEDULER_AGING', 600) if aging is None else aging
+        self.default_duration = (get_setting('NOTEBOOKS_SCHEDULER_DEFAULT_DURATION', 60)
+                                 if default_duration is None else default_duration)
+
+    def priority(self, job, now):
+        rank = PRIORITIES.index(job.get('priority') or 'default')
+        created = parse_time(job.get('created'))
+        if self.aging and created is not None:
+            rank -= int((now - created).total_seconds() // self.aging)
+        return max(rank, 0)
+
+    def expected(self, job):
+        expected = self.history.expected(job['notebook'])
+        return self.default_duration if expected is None else expected
+
+    def order(self, queued, running=()):
+        """the queued jobs in the order to run them, running are the jobs running now"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        shares = collections.Counter(job.get('tenant') for job in running)
+        return sorted(queued, key=lambda job: (self.priority(job, now), shares[job.get('tenant')],
+                                               self.expected(job), job['created'], job['id']))
+
+
+class Histogram(object):
+    """Counts of observed seconds in the BUCKETS, cumulative like Prometheus histograms"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        return dict(buckets=[['+Inf' if bound == float('inf') else bound, count]
+                             for bound, count in zip(self.buckets, self.counts)],
+                    count=self.count, sum=self.sum)
+
+
+def histograms(jobs):
+    """queue wait and run time histograms of jobs by priority class"""
+    waits, runs = collections.defaultdict(Histogram), collections.defaultdict(Histogram)
+    for job in jobs:
+        created, started, finished = (parse_time(job.get(name)) for name in ('created', 'started', 'finished'))
+        priority = job.get('priority') or 'default'
+        if created is not None and started is not None:
+            waits[priority].observe((started - created).total_seconds())
+        if started is not None and finished is not None:
+            runs[priority].observe((finished - started).total_seconds())
+    return dict(queue_wait={priority: histogram.as_dict() for priority, histogram in sorted(waits.items())},
+                run_time={priority: histogram.as_dict() for priority, histogram in sorted(runs.items())})
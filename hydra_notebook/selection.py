@@ -0,0 +1,112 @@
+import hashlib
+
+from .conf import get_setting
+
+EXPORT_TAG = 'export'
+SKIP_IMPORT_TAG = 'skip-import'
+
+
+def cell_tags(cell):
+    return cell.get('metadata', {}).get('tags', ())
+
+
+class CellPolicy(object):
+    """Selects the code cells of a notebook run on import by their tags
+
+    A cell is selected if it has one of the ``include`` tags (every cell
+    if ``include`` is None) and none of the ``exclude`` tags.
+    """
+
+    named = {
+        'all': dict(include=None, exclude=(SKIP_IMPORT_TAG,)),
+        'export': dict(include=(EXPORT_TAG,), exclude=(SKIP_IMPORT_TAG,)),
+    }
+
+    def __init__(self, include=None, exclude=(SKIP_IMPORT_TAG,)):
+        self.include = None if include is None else frozenset(include)
+        self.exclude = frozenset(exclude or ())
+
+    @classmethod
+    def create(cls, policy=None):
+        """create a policy from a name, a dict of arguments or the NOTEBOOKS_IMPORT_POLICY setting"""
+        if policy is None:
+            policy = get_setting('NOTEBOOKS_IMPORT_POLICY', 'all')
+        if isinstance(policy, cls):
+            return policy
+        if isinstance(policy, str):
+            try:
+                policy = cls.named[policy]
+            except KeyError:
+                raise ValueError('Unknown notebook import policy %r' % policy)
+        return cls(**policy)
+
+    def selects(self, cell):
+        tags = cell_tags(cell)
+        if self.include is not None and not self.include.intersection(tags):
+            return False
+        return not self.exclude.intersection(tags)
+
+    @property
+    def key(self):
+        include = '*' if self.include is None else ','.join(sorted(self.include))
+        return 'include=%s;exclude=%s' % (include, ','.join(sorted(self.exclude)))
+
+    @property
+    def variant(self):
+        """short suffix of the cache files compiled with this policy, None for the default policy"""
+        if self.key == CellPolicy().key:
+            return None
+        return hashlib.sha1(self.key.encode('utf-8')).hexdigest()[:8]
+
+    def __eq__(self, other):
+        return isinstance(other, CellPolicy) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return 'CellPolicy(%s)' % self.key
+
+
+def parse_cells(spec):
+    """cell indexes from a command line or query string: '3', '3,5,8', '10:' or '10:12'"""
+    if ':' in spec:
+        start, stop = spec.split(':', 1)
+        return slice(int(start) if start else None, int(stop) if stop else None)
+    return [int(index) for index in spec.split(',') if index.strip()]
+
+
+def select_cells(nb, cells=None, tags=None, target=None):
+    """indexes of the code cells of a partial execution, None to execute every cell
+
+    ``cells`` are indexes, a slice or a parse_cells() spec of the notebook cells, ``tags`` select
+    the cells with any of them, ``target`` are indexes of cells which run
+    with the earlier cells binding the names they read (see
+    cellcache.rebuild_cells). The selections add up.
+    """
+    if cells is None and not tags and target is None:
+        return None
+    code = [index for index, cell in enumerate(nb.cells) if cell.cell_type == 'code']
+    selected = set()
+    if isinstance(cells, str):
+        cells = parse_cells(cells)
+    if isinstance(cells, slice):
+        cells = range(*cells.indices(len(nb.cells)))
+    for index in cells or ():
+        if not -len(nb.cells) <= index < len(nb.cells):
+            raise IndexError('The notebook has no cell %d' % index)
+        selected.add(index % len(nb.cells))
+    if tags:
+        selected.update(index for index in code if set(tags).intersection(cell_tags(nb.cells[index])))
+    if target is not None:
+        from .cellcache import rebuild_cells
+        targets = [target] if isinstance(target, int) else list(target)
+        for index in targets:
+            if not 0 <= index < len(nb.cells):
+                raise IndexError('The notebook has no cell %d' % index)
+            if nb.cells[index].cell_type != 'code':
+                raise ValueError('Cell %d is not a code cell' % index)
+        selected.update(targets)
+        selected.update(rebuild_cells(nb, [index for index in code if index < max(targets)
+                                           and index not in targets], targets))
+    return sorted(index for index in selected if nb.cells[index].cell_type == 'code')
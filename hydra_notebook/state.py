@@ -0,0 +1,90 @@
+import threading
+import types
+
+from .analysis import stored_names, has_star_import
+from .dag import deferred_names
+
+
+class NotebookState(object):
+    """Compiled cells of an imported notebook and how many of them ran
+
+    Stored as the ``loader_state`` of the module spec, lazy modules run
+    the pending cells on demand, reloads compare the cells by their hash.
+    """
+
+    def __init__(self, loader, cells, policy=None, mtime=None):
+        self.loader = loader
+        self.cells = list(cells)
+        self.policy = policy
+        self.mtime = mtime
+        self.position = 0
+        self.lock = threading.RLock()
+        self._names = None
+        self._deferred = None
+
+    @property
+    def pending(self):
+        return self.position < len(self.cells)
+
+    def names(self, index):
+        """names bound by a cell and whether it may bind any name"""
+        if self._names is None:
+            self._names = [(stored_names(cell.code), has_star_import(cell.code)) for cell in self.cells]
+        return self._names[index]
+
+    def deferred(self, index):
+        """names read by the functions and classes of a cell"""
+        if self._deferred is None:
+            self._deferred = [deferred_names(cell.code) for cell in self.cells]
+        return self._deferred[index]
+
+    def replace(self, cells, position, mtime=None):
+        """swap in the cells of a changed notebook"""
+        self.cells = list(cells)
+        self.position = position
+        self.mtime = mtime
+        self._names = None
+        self._deferred = None
+
+    def _definers(self, name):
+        return [index for index in range(self.position, len(self.cells))
+                if name in self.names(index)[0] or self.names(index)[1]]
+
+    def run(self, mod, stop=None):
+        """run the pending cells up to (but not including) the stop index"""
+        stop = len(self.cells) if stop is None else stop
+        with self.lock:
+            while self.position < stop:
+                # a failing cell is not skipped, the next access runs it again
+                self.loader.run_cells(mod, [self.cells[self.position]])
+                self.position += 1
+            if not self.pending:
+                # fully loaded, a lazy module is an ordinary module from now on
+                mod.__class__ = types.ModuleType
+
+    def resolve(self, mod, name):
+        """run the shortest prefix of the pending cells which defines a name
+
+        The prefix also defines the globals read by the functions and classes
+        of its cells, transitively, they are looked up when they are called.
+        """
+        with self.lock:
+            definers = self._definers(name)
+            if not definers:
+                if name not in mod.__dict__:
+                    # the name may still be defined dynamically, e.g. by a magic or by globals()
+                    self.run(mod)
+                return
+            # a later cell may redefine the name, the last definition wins like in an eager import
+            stop, checked, start = definers[-1] + 1, set(), self.position
+            while start < stop:
+                deferred = set()
+                for index in range(start, stop):
+                    deferred.update(self.deferred(index))
+                start = stop
+                for deferred_name in deferred - checked:
+                    checked.add(deferred_name)
+                    definers = self._definers(deferred_name)
+                    if definers:
+                        stop = max(stop, definers[-1] + 1)
+            self.run(mod, stop)
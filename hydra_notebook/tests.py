@@ -1,9 +1,66 @@
-from django.test import TestCase
+import ast
+import builtins
+import datetime
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+import nbformat
+import hydra_notebook
+from jupyter_client.kernelspec import NoSuchKernel
+from nbclient.exceptions import CellExecutionError
+from django.core.management import call_command, CommandError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
 
 # Create your tests here.
-from .core import NotebookBuilder, NotebookFileHandler, NotebookFileModel, NotebookFileManager
+from .batch import find_notebooks, execute_batch, execute_notebook, execute_parameterized
+from .cellcache import CellOutputStore, cell_keys, rebuild_cells
+from .checkpoint import CheckpointStore
+from .dbjobs import DatabaseJobQueue
+from .catalog import NotebookCatalog
+from .importer import find_notebook
+from .cache import NotebookCodeCache, cache_path, compile_root, clear_root
+from .dag import cell_graph, critical_path
+from .core import NotebookBuilder, NotebookExecutor, NotebookFileHandler, NotebookFileModel, NotebookFileManager, \
+    NotebookFinder, import_notebook, import_many
+from .jobs import JobQueue, JobWorker, FINISHED, FAILED, QUEUED
+from .kernels import KernelPool
+from .forkserver import ForkServerError, close_servers, setup_cells
+from .lazy import is_loaded
+from .parameters import INJECTED_TAG, inject_parameters, result_key
+from .limits import KernelLimits
+from .models import NotebookJob
+from .outputs import OutputPolicy
+from . import jobs
+from .registry import NotebookModuleRegistry, module_size
+from .reload import reload_notebook, NotebookWatcher
+from .scheduler import RunHistory, Scheduler, histograms
+from .selection import CellPolicy, select_cells
+from .tree import NotebookTree
 from . import exceptions
 
+# notebooks written by the tests record their runs here
+NOTEBOOK_RUNS = []
+
+
+def write_notebook(nb_path, *sources):
+    b = NotebookBuilder().notebook()
+    for source in sources:
+        b.code(source)
+    with open(nb_path, 'wt') as f:
+        nbformat.write(b.build(), f)
+
 
 class NotebookBuilderTestCase(TestCase):
 
@@ -66,3 +123,1620 @@ class NotebookFileModelTestCase(TestCase):
 
     def test_scriptt(self):
         self.assertGreater(len(self.notebook.script), 0)
+
+
+class NotebookCodeCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.nb_path = os.path.join(self.root, 'cached_notebook.ipynb')
+        write_notebook(self.nb_path, "a = 1", "b = a + 1")
+        self.cache = NotebookCodeCache(enabled=True, write=True)
+
+    def test_get(self):
+        cells = self.cache.get(self.nb_path)
+        self.assertEqual([cell.index for cell in cells], [0, 1])
+        self.assertTrue(os.path.isfile(cache_path(self.nb_path)))
+
+        cells = self.cache.get(self.nb_path)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        ns = {}
+        for cell in cells:
+            exec(cell.code, ns)
+        self.assertEqual(ns['b'], 2)
+
+    def test_invalidation(self):
+        self.cache.get(self.nb_path)
+        write_notebook(self.nb_path, "a = 1", "b = a + 2", "c = b")
+        self.assertIsNone(self.cache.load(self.nb_path))
+        self.assertEqual(len(self.cache.get(self.nb_path)), 3)
+
+        self.assertTrue(self.cache.invalidate(self.nb_path))
+        self.assertIsNone(self.cache.load(self.nb_path))
+
+    def test_compile_root(self):
+        self.assertTrue(compile_root(self.root, quiet=1))
+        self.assertIsNotNone(self.cache.load(self.nb_path))
+        self.assertEqual(clear_root(self.root), 1)
+
+
+class NotebookFinderTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        write_notebook(os.path.join(self.root, 'finder_notebook.ipynb'), "value = 42")
+        write_notebook(os.path.join(self.root, 'Spaced Notebook.ipynb'), "value = 'spaced'")
+        self.finder = NotebookFinder(negative_ttl=60)
+
+    def test_find_spec(self):
+        spec = self.finder.find_spec('notebooks.finder_notebook', [self.root])
+        self.assertEqual(spec.origin, os.path.join(self.root, 'finder_notebook.ipynb'))
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        self.assertEqual(mod.value, 42)
+
+        spec = self.finder.find_spec('notebooks.Spaced_Notebook', [self.root])
+        self.assertEqual(spec.origin, os.path.join(self.root, 'Spaced Notebook.ipynb'))
+
+    def test_negative_cache(self):
+        self.assertIsNone(self.finder.find_spec('notebooks.late_notebook', [self.root]))
+        write_notebook(os.path.join(self.root, 'late_notebook.ipynb'), "value = 1")
+        self.assertIsNone(self.finder.find_spec('notebooks.late_notebook', [self.root]))
+        self.assertEqual(self.finder.statistics()['negative_hits'], 1)
+
+        self.finder.invalidate_caches()
+        self.assertIsNotNone(self.finder.find_spec('notebooks.late_notebook', [self.root]))
+
+    def test_statistics(self):
+        for name in ('missing_a', 'missing_b', 'missing_c', 'finder_notebook'):
+            self.finder.find_spec('notebooks.%s' % name, [self.root])
+        stats = self.finder.statistics()
+        self.assertEqual(stats['lookups'], 4)
+        self.assertEqual(stats['directory_scans'], 1)
+        self.assertGreater(stats['stats_avoided'], 0)
+
+
+class LazyNotebookModuleTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        write_notebook(
+            os.path.join(self.root, 'lazy_notebook.ipynb'),
+            "first = 1",
+            "second = first + 1",
+            "raise RuntimeError('heavy cell')",
+            "first = 10",
+        )
+
+    def import_lazy(self):
+        spec = NotebookFinder().find_spec('notebooks.lazy_notebook', [self.root])
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod, lazy=True)
+        return mod
+
+    def test_shortest_prefix(self):
+        mod = self.import_lazy()
+        self.assertFalse(is_loaded(mod))
+        self.assertEqual(mod.second, 2)
+        self.assertFalse(is_loaded(mod))
+        # the last cell redefines the name, so the heavy cell has to run
+        with self.assertRaises(RuntimeError):
+            mod.first
+
+    def test_function_globals(self):
+        write_notebook(os.path.join(self.root, 'greeting.ipynb'), "def greet():\n    return GREETING + NAME",
+                       "GREETING = 'hello '", "class Name:\n    value = 'world'", "NAME = Name.value",
+                       "raise RuntimeError('heavy cell')")
+        spec = NotebookFinder().find_spec('notebooks.greeting', [self.root])
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod, lazy=True)
+        # greet reads GREETING and NAME when called, NAME needs the class Name
+        self.assertEqual(mod.greet(), 'hello world')
+        self.assertFalse(is_loaded(mod))
+
+    def test_missing_dunder(self):
+        mod = self.import_lazy()
+        self.assertFalse(hasattr(mod, '__path__'))
+        self.assertNotIn('first', mod.__dict__)
+
+    def test_import_notebook(self):
+        self.addCleanup(sys.modules.pop, 'notebooks.test_notebook', None)
+        mod = import_notebook('notebooks.test_notebook', lazy=True)
+        self.assertFalse(is_loaded(mod))
+        self.assertIs(importlib.import_module('notebooks.test_notebook'), mod)
+        self.assertEqual(mod.SampleClass().sample_method_with_output(), 'output')
+        self.assertIn('sample_instance', dir(mod))
+        self.assertTrue(is_loaded(mod))
+
+
+class CellPolicyTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.nb_path = os.path.join(self.root, 'tagged_notebook.ipynb')
+        nb = NotebookBuilder().notebook().code(
+            "library = 'library'"
+        ).code(
+            "plot = 'plot'"
+        ).code(
+            "raise RuntimeError('data loading')"
+        ).build()
+        nb.cells[0].metadata['tags'] = ['export']
+        nb.cells[2].metadata['tags'] = ['skip-import']
+        with open(self.nb_path, 'wt') as f:
+            nbformat.write(nb, f)
+        self.cache = NotebookCodeCache(enabled=True, write=True)
+
+    def test_policies(self):
+        self.assertEqual([cell.index for cell in self.cache.get(self.nb_path)], [0, 1])
+        self.assertEqual([cell.index for cell in self.cache.get(self.nb_path, policy='export')], [0])
+        self.assertEqual(len(self.cache.get(self.nb_path, policy=dict(exclude=()))), 3)
+        self.assertEqual(self.cache.misses, 3)
+
+        self.assertEqual([cell.index for cell in self.cache.get(self.nb_path, policy='export')], [0])
+        self.assertEqual(self.cache.hits, 1)
+        self.assertTrue(os.path.isfile(cache_path(self.nb_path, CellPolicy.create('export').variant)))
+
+        with self.assertRaises(ValueError):
+            CellPolicy.create('unknown')
+
+    def test_import(self):
+        spec = NotebookFinder().find_spec('notebooks.tagged_notebook', [self.root])
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod, policy='export')
+        self.assertEqual(mod.library, 'library')
+        self.assertFalse(hasattr(mod, 'plot'))
+
+
+class NotebookLoaderTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        write_notebook(os.path.join(self.root, 'pure_notebook.ipynb'), "value = 10 % 3")
+        write_notebook(os.path.join(self.root, 'magic_notebook.ipynb'), "value = 1", "names = %who_ls")
+
+    def import_notebook(self, name):
+        spec = NotebookFinder().find_spec('notebooks.%s' % name, [self.root])
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        return spec.loader, mod
+
+    def test_pure_python(self):
+        cells = NotebookCodeCache(enabled=False).get(os.path.join(self.root, 'pure_notebook.ipynb'))
+        self.assertFalse(cells[0].needs_shell)
+        loader, mod = self.import_notebook('pure_notebook')
+        self.assertEqual(mod.value, 1)
+        self.assertIsNone(loader._shell)
+
+    def test_magics(self):
+        cells = NotebookCodeCache(enabled=False).get(os.path.join(self.root, 'magic_notebook.ipynb'))
+        self.assertEqual([cell.needs_shell for cell in cells], [False, True])
+        loader, mod = self.import_notebook('magic_notebook')
+        # the magic sees the namespace of the notebook module
+        self.assertIn('value', mod.names)
+        self.assertIsNotNone(loader._shell)
+
+
+class NotebookPackageMixin(object):
+    """writes notebooks into a temporary importable package"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.package = os.path.basename(self.root)
+        sys.path.insert(0, os.path.dirname(self.root))
+        self.addCleanup(sys.path.remove, os.path.dirname(self.root))
+        self.addCleanup(self.unload)
+        del NOTEBOOK_RUNS[:]
+
+    def unload(self):
+        for name in [name for name in sys.modules if name.split('.')[0] == self.package]:
+            del sys.modules[name]
+
+    def write(self, name, *sources):
+        write_notebook(os.path.join(self.root, '%s.ipynb' % name),
+                       "from hydra_notebook.tests import NOTEBOOK_RUNS", "NOTEBOOK_RUNS.append(__name__)", *sources)
+        return '%s.%s' % (self.package, name)
+
+
+class ImportManyTestCase(NotebookPackageMixin, TestCase):
+
+    def test_import_many(self):
+        first = self.write('first', "value = 1")
+        second = self.write('second', "value = 2")
+        third = self.write('third', "from . import first, second", "value = first.value + second.value")
+        modules = import_many([third, first, second], max_workers=3)
+        self.assertEqual(list(modules), [third, first, second])
+        self.assertEqual(modules[third].value, 3)
+        # the dependencies are imported before the notebook that needs them
+        self.assertEqual(NOTEBOOK_RUNS[-1], third)
+        self.assertEqual(len(NOTEBOOK_RUNS), 3)
+
+    def test_cycle(self):
+        first = self.write('first', "from . import second")
+        second = self.write('second', "import %s.first" % self.package)
+        with self.assertRaises(exceptions.NotebookImportCycleError) as context:
+            import_many([first, second])
+        self.assertEqual(set(context.exception.cycle), {first, second})
+        self.assertEqual(NOTEBOOK_RUNS, [])
+
+    def test_concurrent_import(self):
+        name = self.write('slow', "import time", "time.sleep(0.1)", "value = 1")
+        modules = []
+        threads = [threading.Thread(target=lambda: modules.append(import_notebook(name))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, modules))), 1)
+        self.assertEqual(NOTEBOOK_RUNS, [name])
+
+
+class NotebookReloadTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.nb_path = os.path.join(self.root, 'reloaded_notebook.ipynb')
+        self.write("a = 1", "b = a + 1", "c = 5")
+        spec = NotebookFinder().find_spec('notebooks.reloaded_notebook', [self.root])
+        self.mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.mod)
+        del NOTEBOOK_RUNS[:]
+
+    def write(self, *sources):
+        write_notebook(self.nb_path, "from hydra_notebook.tests import NOTEBOOK_RUNS",
+                       *["NOTEBOOK_RUNS.append(%r)\n%s" % (source[0], source) for source in sources])
+        # make sure the change is visible even on file systems with coarse timestamps
+        st = os.stat(self.nb_path)
+        os.utime(self.nb_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+    def test_changed_cell(self):
+        self.write("a = 1", "b = a + 2", "c = 5")
+        reload_notebook(self.mod)
+        self.assertEqual(NOTEBOOK_RUNS, ['b'])
+        self.assertEqual(self.mod.b, 3)
+
+    def test_dependent_cells(self):
+        self.write("a = 10", "b = a + 1", "c = 5")
+        reload_notebook(self.mod)
+        self.assertEqual(NOTEBOOK_RUNS, ['a', 'b'])
+        self.assertEqual(self.mod.b, 11)
+
+    def test_removed_cell(self):
+        self.write("a = 1", "c = 5")
+        reload_notebook(self.mod)
+        self.assertEqual(NOTEBOOK_RUNS, [])
+        self.assertFalse(hasattr(self.mod, 'b'))
+
+    def test_watcher(self):
+        sys.modules['notebooks.reloaded_notebook'] = self.mod
+        self.addCleanup(sys.modules.pop, 'notebooks.reloaded_notebook')
+        watcher = NotebookWatcher(root=self.root)
+        self.assertEqual(watcher.check(), [])
+        self.write("a = 1", "b = a + 1", "c = 6")
+        self.assertEqual(watcher.check(), ['notebooks.reloaded_notebook'])
+        self.assertEqual(self.mod.c, 6)
+        self.assertEqual(watcher.check(), [])
+
+
+class NotebookModuleRegistryTestCase(NotebookPackageMixin, TestCase):
+
+    def test_lru(self):
+        registry = NotebookModuleRegistry(max_modules=2)
+        names = [self.write('module_%d' % index, "data = list(range(1000))") for index in range(3)]
+        for name in names:
+            registry.register(import_notebook(name))
+        self.assertNotIn(names[0], sys.modules)
+        self.assertNotIn(names[0], registry)
+        self.assertEqual(registry.statistics()['evictions'], 1)
+
+        # evicted modules are imported again transparently
+        mod = registry.get(names[0])
+        registry.register(mod)
+        self.assertIn(names[0], sys.modules)
+        self.assertNotIn(names[1], sys.modules)
+        self.assertEqual(registry.statistics()['reimports'], 1)
+
+    def test_memory_budget(self):
+        registry = NotebookModuleRegistry(memory_budget=15 * 10 ** 6)
+        big = self.write('big', "data = bytearray(10 ** 7)")
+        mod = import_notebook(big)
+        self.assertGreaterEqual(module_size(mod), 10 ** 7)
+        registry.register(mod)
+        ref = weakref.ref(mod)
+        del mod
+
+        other = self.write('other', "data = bytearray(10 ** 7)")
+        report = registry.register(import_notebook(other))
+        self.assertEqual(report.modules, [big])
+        self.assertGreaterEqual(report.estimated_bytes, 10 ** 7)
+        self.assertEqual(report.collected, [big])
+        self.assertIsNone(ref())
+
+    def test_lazy_module(self):
+        registry = NotebookModuleRegistry(max_modules=1)
+        lazy = self.write('lazy_module', "value = 1", "other = value + 1")
+        mod = import_notebook(lazy, lazy=True)
+        registry.register(mod)
+        # the pending cells of a lazy module still run after an eviction
+        self.assertFalse(registry.evict(lazy))
+        registry.register(import_notebook(self.write('eager_module', "data = 1")))
+        self.assertIs(sys.modules[lazy], mod)
+        self.assertEqual(mod.other, 2)
+        self.assertTrue(is_loaded(mod))
+        # once loaded, it is evicted like the other modules
+        self.assertEqual(registry.enforce().modules, [lazy])
+        self.assertNotIn(lazy, sys.modules)
+
+
+class KernelPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.pool = KernelPool(min_size=0, max_size=1, max_uses=3)
+        self.addCleanup(self.pool.shutdown)
+
+    def execute(self, *sources):
+        write_notebook(os.path.join(self.root, 'pooled.ipynb'), *sources)
+        with NotebookExecutor('pooled', path=self.root, pool=self.pool) as e:
+            e()
+        return e.nb.cells
+
+    def test_reuse(self):
+        first = self.execute("import os", "print(os.getpid(), os.getcwd())", "value = 1")
+        pid, cwd = first[1].outputs[0].text.split()
+        self.assertEqual(cwd, os.path.realpath(self.root))
+        # the kernel is reused with a fresh namespace and execution count
+        second = self.execute("import os", "print(os.getpid(), 'value' in globals())")
+        self.assertEqual(second[1].outputs[0].text.split(), [pid, 'False'])
+        self.assertEqual(second[0].execution_count, 1)
+        stats = self.pool.statistics()
+        self.assertEqual((stats['hits'], stats['misses'], stats['started']), (1, 1, 1))
+
+    def test_recycle(self):
+        pids = [self.execute("import os", "print(os.getpid())")[1].outputs[0].text for _ in range(4)]
+        # kernels are replaced after max_uses runs
+        self.assertEqual(len(set(pids[:3])), 1)
+        self.assertNotEqual(pids[3], pids[0])
+        self.assertEqual(self.pool.statistics()['recycled'], 1)
+
+    def test_dead_kernel(self):
+        km = self.pool.acquire()
+        self.pool.release(km)
+        km.signal_kernel(signal.SIGKILL)
+        while km.is_alive():
+            time.sleep(0.01)
+        other = self.pool.acquire()
+        self.assertIsNot(other, km)
+        self.assertTrue(other.is_alive())
+        self.pool.release(other)
+        self.assertEqual(self.pool.statistics()['replaced'], 1)
+
+
+class BatchExecutionTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'reports'))
+        write_notebook(os.path.join(self.root, 'first.ipynb'), "value = 1")
+        write_notebook(os.path.join(self.root, 'reports', 'daily.ipynb'), "print('daily')")
+        write_notebook(os.path.join(self.root, 'reports', 'broken.ipynb'), "1 / 0")
+
+    def test_find_notebooks(self):
+        self.assertEqual(find_notebooks(root=self.root), ['first', 'reports/broken', 'reports/daily'])
+        self.assertEqual(find_notebooks(['reports/d*', 'first.ipynb', 'reports'], root=self.root),
+                         ['reports/daily', 'first', 'reports/broken'])
+        with self.assertRaises(exceptions.NotebookNotFindException):
+            find_notebooks(['missing'], root=self.root)
+
+    def test_execute_batch(self):
+        write_notebook(os.path.join(self.root, 'slow.ipynb'), "import time", "time.sleep(60)")
+        output_dir = os.path.join(self.root, 'out')
+        start = time.perf_counter()
+        runs = execute_batch(find_notebooks(root=self.root), root=self.root, max_workers=4, timeout=20,
+                             output_dir=output_dir)
+        self.assertLess(time.perf_counter() - start, 50)
+        self.assertEqual([(run.name, run.ok) for run in runs],
+                         [('first', True), ('reports/broken', False), ('reports/daily', True), ('slow', False)])
+        self.assertEqual(runs[1].error, 'ZeroDivisionError: division by zero')
+        self.assertTrue(runs[3].timed_out)
+        nb = nbformat.read(os.path.join(output_dir, 'reports', 'daily.ipynb'), 4)
+        self.assertEqual(nb.cells[0].outputs[0].text, 'daily\n')
+        # the failed notebook is written with its error
+        nb = nbformat.read(os.path.join(output_dir, 'reports', 'broken.ipynb'), 4)
+        self.assertEqual(nb.cells[0].outputs[0].ename, 'ZeroDivisionError')
+        self.assertEqual(sorted(os.listdir(os.path.join(output_dir, 'reports'))), ['broken.ipynb', 'daily.ipynb'])
+
+    def test_timeout_interrupts_inprocess_run(self):
+        write_notebook(os.path.join(self.root, 'loop.ipynb'), "import time",
+                       "done = False\nwhile not done:\n    time.sleep(0.01)", "after = done")
+        for engine in ('inprocess', 'parallel'):
+            start = time.perf_counter()
+            run = execute_notebook('loop', root=self.root, timeout=0.5, engine=engine,
+                                   output_dir=os.path.join(self.root, engine))
+            self.assertLess(time.perf_counter() - start, 10)
+            self.assertFalse(run.ok)
+            self.assertTrue(run.timed_out)
+            self.assertEqual(run.notebook.cells[1].outputs[-1].ename, 'CellInterrupted')
+            self.assertIsNone(run.notebook.cells[2].execution_count)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('execute_notebooks', 'first', '--root', self.root, stdout=out)
+        self.assertIn('Executed 1 notebooks', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('execute_notebooks', 'reports', '--root', self.root, stdout=out)
+        self.assertIn('FAILED', out.getvalue())
+
+
+class CellOutputCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.store = CellOutputStore(os.path.join(self.root, 'cells'), max_size=10 ** 6)
+
+    def execute(self, *sources):
+        write_notebook(os.path.join(self.root, 'cached.ipynb'), *sources)
+        with NotebookExecutor('cached', path=self.root, cell_cache=self.store) as e:
+            e()
+        return e
+
+    def test_keys(self):
+        nb = NotebookBuilder().notebook().code("a = 1").markdown("text").code("b = a").build()
+        keys = cell_keys(nb, 'python3')
+        self.assertEqual(list(keys), [0, 2])
+        nb.cells[0].source = "a = 2"
+        self.assertNotEqual(cell_keys(nb, 'python3')[2], keys[2])
+        self.assertNotEqual(cell_keys(nb, 'other')[0], keys[0])
+
+    def test_rebuild_cells(self):
+        b = NotebookBuilder().notebook()
+        for source in ["import os", "x = os.getpid()", "y = 2", "print('report')", "z = x + 1", "%matplotlib inline",
+                       "w = 1"]:
+            b.code(source)
+        nb = b.build()
+        # y is never read again, printing binds no name and may have side effects
+        self.assertEqual(rebuild_cells(nb, [0, 1, 2, 3], [4]), {0, 1, 3})
+        # magics may read any name
+        self.assertEqual(rebuild_cells(nb, [0, 1, 2, 3, 4], [5, 6]), {0, 1, 2, 3, 4})
+
+    def test_rerun(self):
+        sources = ["import os", "pid = os.getpid()", "unused = 1", "print(pid)"]
+        first = self.execute(*sources)
+        pid = first.nb.cells[3].outputs[0].text
+        self.assertEqual(self.store.statistics()['stores'], 4)
+
+        # nothing changed, no kernel is started
+        second = self.execute(*sources)
+        self.assertIsNone(second.preprocessor.km)
+        self.assertEqual(second.nb.cells[3].outputs[0].text, pid)
+
+        third = self.execute(*sources[:3], "print(pid == os.getpid(), pid != %s)" % pid.strip())
+        self.assertEqual(third.preprocessor.rebuilt, {0, 1})
+        self.assertEqual(third.nb.cells[3].outputs[0].text, 'True True\n')
+        # the outputs of the prefix come from the cache
+        self.assertEqual(third.nb.cells[0].execution_count, 1)
+        stats = self.store.statistics()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores']), (7, 2, 5))
+
+    def test_stream_cached(self):
+        sources = ["value = 6 * 7", "print(value)"]
+        self.execute(*sources)
+        cells = []
+        with NotebookExecutor('cached', path=self.root, cell_cache=self.store,
+                              on_cell=lambda index, cell, duration: cells.append(index)) as e:
+            events = list(e.stream())
+        self.assertIsNone(e.preprocessor.km)
+        self.assertEqual([event['event'] for event in events], ['start', 'cell', 'cell', 'done'])
+        self.assertEqual(events[2]['outputs'][0]['text'], '42\n')
+        self.assertEqual(cells, [0, 1])
+
+    def test_output_policy(self):
+        sources = ["print('x' * 5000)", "value = 1", "value"]
+        self.execute(*sources)
+        with NotebookExecutor('cached', path=self.root, cell_cache=self.store,
+                              output_policy=OutputPolicy(cell_limit=1000)) as e:
+            e()
+        self.assertIsNone(e.preprocessor.km)
+        self.assertIn('characters truncated', e.nb.cells[0].outputs[0].text)
+        self.assertLess(len(e.nb.cells[0].outputs[0].text), 1100)
+        self.assertEqual(e.nb.cells[2].outputs[0].data['text/plain'], '1')
+        # the store keeps the whole outputs
+        self.assertEqual(self.execute(*sources).nb.cells[0].outputs[0].text, 'x' * 5000 + '\n')
+
+        # outputs cut by the limits are not stored
+        self.store.clear()
+        sources = ["print('y' * 5000)", "value = 2"]
+        write_notebook(os.path.join(self.root, 'cached.ipynb'), *sources)
+        with NotebookExecutor('cached', path=self.root, cell_cache=self.store,
+                              output_policy=OutputPolicy(cell_limit=1000)) as e:
+            e()
+        self.assertIn('characters truncated', e.nb.cells[0].outputs[0].text)
+        self.assertEqual(self.execute(*sources).nb.cells[0].outputs[0].text, 'y' * 5000 + '\n')
+
+    def test_eviction(self):
+        store = CellOutputStore(os.path.join(self.root, 'small'), max_size=2000)
+        for index in range(10):
+            store.put('key%02d' % index, [nbformat.v4.new_output('stream', text='x' * 500)], index)
+        self.assertLessEqual(store.size, 2000)
+        self.assertGreater(store.statistics()['evictions'], 0)
+        self.assertIsNone(store.get('key00'))
+        self.assertEqual(store.get('key09').execution_count, 9)
+
+
+class ForkServerTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.addCleanup(close_servers)
+
+    def execute(self, setup, *sources):
+        b = NotebookBuilder().notebook().markdown("# Report").code(setup)
+        b.cells[-1].metadata['tags'] = ['setup']
+        for source in sources:
+            b.code(source)
+        with open(os.path.join(self.root, 'forked.ipynb'), 'wt') as f:
+            nbformat.write(b.build(), f)
+        with NotebookExecutor('forked', path=self.root, engine='forkserver') as e:
+            e()
+        return e
+
+    def test_setup_cells(self):
+        b = NotebookBuilder().notebook().markdown("text").code("a = 1").code("b = 2").code("c = 3")
+        b.cells[1].metadata['tags'] = b.cells[3].metadata['tags'] = ['setup']
+        self.assertEqual(setup_cells(b.build()), [1])
+
+    def test_fork(self):
+        setup = "import os\nprint('loading')\ntemplate = os.getpid()\ncwd = os.getcwd()"
+        runs = [self.execute(setup, "print(template != os.getpid(), cwd, %d)" % run) for run in range(2)]
+        for run, e in enumerate(runs):
+            self.assertEqual(e.nb.cells[1].outputs[0].text, 'loading\n')
+            self.assertEqual(e.nb.cells[2].outputs[0].text, 'True %s %d\n' % (os.path.realpath(self.root), run))
+        # the setup cells ran once, every run forked the same template
+        self.assertIs(runs[0].preprocessor.server, runs[1].preprocessor.server)
+        self.assertEqual(runs[1].preprocessor.server.forks, 2)
+
+    def test_parameters(self):
+        b = NotebookBuilder().notebook().code("base = 10").code("total = base + rate")
+        b.cells[0].metadata['tags'] = ['setup']
+        with open(os.path.join(self.root, 'forked.ipynb'), 'wt') as f:
+            nbformat.write(b.build(), f)
+        runs = []
+        for rate in (1, 2):
+            with NotebookExecutor('forked', path=self.root, engine='forkserver', parameters={'rate': rate}) as e:
+                e()
+            runs.append(e)
+            self.assertEqual(e.nb.cells[1].metadata['tags'], ['injected-parameters'])
+            self.assertEqual(setup_cells(e.nb), [0])
+        # the injected cell runs in the fork, both runs share the template
+        self.assertIs(runs[0].preprocessor.server, runs[1].preprocessor.server)
+        self.assertEqual(runs[1].preprocessor.server.forks, 2)
+
+    def test_magics_and_displays(self):
+        e = self.execute("%config InlineBackend.figure_format = 'png'\nfiles = !echo shared\n"
+                         "from IPython.display import HTML, display\ndisplay(HTML('<b>setup</b>'))\n'result'",
+                         "print(files, 'HTML' in dir())")
+        self.assertEqual([output.output_type for output in e.nb.cells[1].outputs], ['display_data', 'execute_result'])
+        self.assertEqual(e.nb.cells[1].outputs[0].data['text/html'], '<b>setup</b>')
+        self.assertEqual(e.nb.cells[2].outputs[0].text, "['shared'] True\n")
+        # other kernels are started as usual, without a template
+        with self.assertRaises(NoSuchKernel):
+            with NotebookExecutor('forked', path=self.root, engine='forkserver', kernel_name='missing') as e:
+                e()
+        self.assertIsNone(e.preprocessor.server)
+
+    def test_setup_error(self):
+        with self.assertRaises(ForkServerError):
+            self.execute("1 / 0", "print(1)")
+        with self.assertRaises(ValueError):
+            NotebookExecutor('forked', path=self.root, engine='forkserver', pool=True)
+
+
+class InProcessEngineTestCase(TestCase):
+
+    sources = [
+        "import sys\nprint('a')\nsys.stderr.write('error\\n')\nprint('b')",
+        "from IPython.display import display, HTML\ndisplay(HTML('<b>x</b>'))\n1 + 1",
+        "handle = display('first', display_id='d')\nhandle.update('second')",
+        "import os\nos.sep",
+        "%who_ls",
+    ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def execute(self, engine, *sources):
+        write_notebook(os.path.join(self.root, 'inprocess.ipynb'), *sources)
+        with NotebookExecutor('inprocess', path=self.root, engine=engine) as e:
+            e()
+        return e.nb
+
+    def test_same_outputs(self):
+        kernel = self.execute('kernel', *self.sources)
+        inprocess = self.execute('inprocess', *self.sources)
+        self.assertEqual(inprocess.metadata, kernel.metadata)
+        for expected, cell in zip(kernel.cells, inprocess.cells):
+            self.assertEqual(cell.outputs, expected.outputs)
+            self.assertEqual(cell.execution_count, expected.execution_count)
+            self.assertEqual(set(cell.metadata.execution), set(expected.metadata.execution))
+
+    def test_isolation(self):
+        cwd, main, names = os.getcwd(), sys.modules['__main__'], set(vars(builtins))
+        self.execute('inprocess', "value = 1")
+        with self.assertRaises(CellExecutionError) as context:
+            self.execute('inprocess', "print(value)")
+        self.assertEqual(context.exception.ename, 'NameError')
+        self.assertEqual((os.getcwd(), sys.modules['__main__']), (cwd, main))
+        self.assertEqual(set(vars(builtins)), names)
+
+    def test_concurrent_runs(self):
+        source = ("import time\nstart = time.time()\nfor i in range(3):\n    print(%r, i)\n    time.sleep(0.2)\n"
+                  "display(%r)\nstart, time.time()")
+        for name in ('first', 'second'):
+            write_notebook(os.path.join(self.root, name + '.ipynb'), source % (name, name))
+        runs = {}
+
+        def run(name):
+            with NotebookExecutor(name, path=self.root, engine='inprocess') as e:
+                e()
+            runs[name] = e.nb.cells[0]
+
+        threads = [threading.Thread(target=run, args=(name,)) for name in ('first', 'second')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # every shell recorded the outputs of its own thread
+        for name, cell in runs.items():
+            self.assertEqual([output.output_type for output in cell.outputs],
+                             ['stream', 'display_data', 'execute_result'])
+            self.assertEqual(cell.outputs[0].text, ''.join('%s %d\n' % (name, i) for i in range(3)))
+            self.assertEqual(cell.outputs[1].data['text/plain'], repr(name))
+            self.assertEqual(cell.execution_count, 1)
+        # the cells ran at the same time
+        spans = [ast.literal_eval(cell.outputs[2].data['text/plain']) for cell in runs.values()]
+        self.assertLess(max(start for start, end in spans), min(end for start, end in spans))
+
+
+class ParallelEngineTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def execute(self, engine, *sources):
+        write_notebook(os.path.join(self.root, 'parallel.ipynb'), *sources)
+        with NotebookExecutor('parallel', path=self.root, engine=engine) as e:
+            e()
+        return e.nb
+
+    def test_graph(self):
+        b = NotebookBuilder().notebook()
+        for source in ["import time\ndef load(i):\n    return [i] * scale", "scale = 2", "a = load(1)", "b = load(2)",
+                       "a.append(3)", "total = len(a) + len(b)", "%time a", "scale = 3"]:
+            b.code(source)
+        graph = cell_graph(b.build())
+        # load() reads scale when it is called
+        self.assertEqual(graph[2], {0, 1})
+        self.assertEqual(graph[3], {0, 1})
+        self.assertEqual(graph[4], {2})
+        self.assertEqual(graph[5], {3, 4})
+        # the magic runs after every earlier cell, the later cells after it
+        self.assertEqual(graph[6], {0, 1, 2, 3, 4, 5})
+        self.assertEqual(graph[7], {6})
+        self.assertEqual(critical_path(graph), 7)
+
+    def test_same_outputs(self):
+        inprocess = self.execute('inprocess', *InProcessEngineTestCase.sources)
+        parallel = self.execute('parallel', *InProcessEngineTestCase.sources)
+        for expected, cell in zip(inprocess.cells, parallel.cells):
+            self.assertEqual(cell.outputs, expected.outputs)
+            self.assertEqual(cell.execution_count, expected.execution_count)
+
+    def test_independent_cells_overlap(self):
+        sources = ["import time"] + ["time.sleep(0.5)\nx%d = %d" % (i, i) for i in range(4)] + ["x0 + x1 + x2 + x3"]
+        start = time.perf_counter()
+        nb = self.execute('parallel', *sources)
+        self.assertLess(time.perf_counter() - start, 1.5)
+        self.assertEqual(nb.cells[-1].outputs[0].data['text/plain'], '6')
+        self.assertEqual([cell.execution_count for cell in nb.cells], [1, 2, 3, 4, 5, 6])
+
+    def test_error(self):
+        with self.assertRaises(CellExecutionError) as context:
+            self.execute('parallel', "import time", "1 / 0", "time.sleep(0.3)\nslow = 1", "after = slow")
+        self.assertEqual(context.exception.ename, 'ZeroDivisionError')
+        nb = nbformat.read(os.path.join(self.root, 'parallel.ipynb'), 4)
+        # the running cell finished, the cell depending on it was not started
+        self.assertEqual(nb.cells[1].outputs[0].ename, 'ZeroDivisionError')
+        self.assertEqual([cell.execution_count for cell in nb.cells], [1, 2, 3, None])
+
+
+class StreamingExecutionTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        write_notebook(os.path.join(self.root, 'streamed.ipynb'), "import time\nprint('first')",
+                       "time.sleep(0.5)\nprint('second')", "1 / 0", "print('never')")
+
+    def test_stream(self):
+        received = []
+        with NotebookExecutor('streamed', path=self.root) as e:
+            for event in e.stream():
+                received.append((event, time.perf_counter()))
+        events = [event for event, at in received]
+        self.assertEqual([event['event'] for event in events], ['start', 'cell', 'cell', 'cell', 'done'])
+        self.assertEqual(events[0]['cells'], 4)
+        self.assertEqual([event['index'] for event in events[1:4]], [0, 1, 2])
+        self.assertEqual(events[1]['outputs'][0]['text'], 'first\n')
+        self.assertEqual(events[1]['execution_count'], 1)
+        self.assertIn('shell.execute_reply', events[1]['execution'])
+        self.assertEqual((events[3]['status'], events[4]['status']), ('error', 'error'))
+        self.assertEqual(events[4]['error'], 'ZeroDivisionError: division by zero')
+        # the first cell was reported before the second one finished
+        self.assertGreaterEqual(received[2][1] - received[1][1], 0.5)
+
+    def test_stop_blocked_run(self):
+        finished = []
+        with NotebookExecutor('streamed', path=self.root, engine='inprocess') as e:
+            events = e.stream(finished=lambda: finished.append(threading.current_thread()), stop_timeout=0.1)
+            for event in events:
+                if event['event'] == 'cell':
+                    break
+            # the second cell sleeps, the interruption waits for the sleep to return
+            time.sleep(0.1)
+            events.close()
+            self.assertEqual(finished, [])
+            deadline = time.perf_counter() + 10
+            while not finished and time.perf_counter() < deadline:
+                time.sleep(0.05)
+        # the notebook was handed to the thread once it stopped changing it
+        self.assertEqual(len(finished), 1)
+        self.assertIsNot(finished[0], threading.current_thread())
+        self.assertEqual(e.nb.cells[1].outputs[-1].ename, 'CellInterrupted')
+        self.assertIsNone(e.nb.cells[2].execution_count)
+
+    def test_view(self):
+        with override_settings(NOTEBOOKS_ROOT=self.root, NOTEBOOKS_JOBS_DIR=os.path.join(self.root, 'jobs'),
+                               NOTEBOOKS_EXECUTION_ENGINE='inprocess'):
+            url = reverse('execute_notebook_stream', args=['streamed'])
+            self.assertEqual(self.client.get(url).status_code, 405)
+            response = self.client.post(url)
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            body = b''.join(response.streaming_content).decode('utf-8')
+            self.assertEqual(self.client.post(reverse('execute_notebook_stream', args=['missing'])).status_code, 404)
+        self.assertTrue(body.startswith('event: start\ndata: {'))
+        self.assertEqual(body.count('event: cell\n'), 3)
+        self.assertIn('"text": "second\\n"', body)
+        self.assertEqual(json.loads(body.split('data: ')[-1])['error'], 'ZeroDivisionError: division by zero')
+        # the executed notebook is written to the result path of the run, not to the source
+        run = json.loads(body.split('data: ')[1].split('\n')[0])['run']
+        nb = nbformat.read(os.path.join(self.root, 'jobs', 'streams', run, 'streamed.ipynb'), 4)
+        self.assertEqual(nb.cells[0].outputs[0].text, 'first\n')
+        self.assertEqual(nbformat.read(os.path.join(self.root, 'streamed.ipynb'), 4).cells[0].outputs, [])
+
+
+class JobQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        write_notebook(os.path.join(self.root, 'job.ipynb'), "print('job')", "value = 2")
+        write_notebook(os.path.join(self.root, 'broken.ipynb'), "1 / 0")
+        self.queue = JobQueue(os.path.join(self.root, 'jobs'))
+        settings = override_settings(NOTEBOOKS_ROOT=self.root, NOTEBOOKS_JOBS_DIR=os.path.join(self.root, 'jobs'),
+                                     NOTEBOOKS_JOB_WORKERS=0, NOTEBOOKS_EXECUTION_ENGINE='inprocess')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_run(self):
+        first = self.queue.submit('job')
+        second = self.queue.submit('broken')
+        self.assertEqual(self.queue.jobs('queued'), [first['id'], second['id']])
+        worker = JobWorker(self.queue)
+        self.assertTrue(worker.run_once())
+        job = self.queue.get(first['id'])
+        self.assertEqual((job['status'], job['progress'], job['error']), (FINISHED, dict(cells=2, done=2), None))
+        nb = nbformat.read(self.queue.result_path(job), 4)
+        self.assertEqual(nb.cells[0].outputs[0].text, 'job\n')
+        self.assertTrue(worker.run_once())
+        self.assertFalse(worker.run_once())
+        job = self.queue.get(second['id'])
+        self.assertEqual((job['status'], job['error']), (FAILED, 'ZeroDivisionError: division by zero'))
+        self.assertEqual(self.queue.statistics(), dict(queued=0, running=0, done=2))
+        self.assertIsNone(self.queue.get('missing'))
+        # a record which never becomes valid json is read a few times only
+        with open(self.queue._path('done', first['id']), 'w') as f:
+            f.write('{')
+        with self.assertLogs('hydra_notebook.jobs', 'ERROR'):
+            self.assertIsNone(self.queue.get(first['id']))
+
+    def test_window(self):
+        submitted = [self.queue.submit('job', priority=priority) for priority in ('batch', 'batch', 'interactive')]
+        with override_settings(NOTEBOOKS_SCHEDULER_WINDOW=2):
+            # the interactive job is beyond the window of the oldest queued jobs until the first one is claimed
+            claimed = [self.queue.claim() for _ in range(3)]
+        self.assertEqual([job['id'] for job in claimed], [submitted[index]['id'] for index in (0, 2, 1)])
+        for index, job in enumerate(submitted):
+            self.queue.finish(self.queue.get(job['id']))
+            os.utime(self.queue._path('done', job['id']), (1000 - index, 1000 - index))
+        # the last finished jobs by modification time
+        self.assertEqual([job['id'] for job in self.queue.recent(limit=2)], [submitted[1]['id'], submitted[0]['id']])
+
+    def test_clean(self):
+        submitted = [self.queue.submit('job') for _ in range(3)]
+        worker = JobWorker(self.queue)
+        while worker.run_once():
+            pass
+        stream = os.path.join(self.queue.directory, 'streams', 'old')
+        os.makedirs(stream)
+        for index, job in enumerate(submitted[:2]):
+            os.utime(self.queue._path('done', job['id']), (index, index))
+        os.utime(stream, (0, 0))
+        # the jobs finished before the retention are removed with their notebooks
+        self.assertEqual(worker.clean(), 2)
+        self.assertEqual(self.queue.jobs('done'), [submitted[2]['id']])
+        self.assertFalse(os.path.exists(self.queue.result_dir(submitted[0]['id'])))
+        self.assertTrue(os.path.exists(self.queue.result_path(submitted[2])))
+        self.assertFalse(os.path.exists(stream))
+        # once every clean_interval
+        self.assertEqual(worker.clean(), 0)
+        out = io.StringIO()
+        call_command('clean_notebook_jobs', '--keep', '0', stdout=out)
+        self.assertIn('Removed 1 notebook jobs', out.getvalue())
+        self.assertEqual(self.queue.statistics(), dict(queued=0, running=0, done=0))
+
+    def test_recover(self):
+        submitted = self.queue.submit('job')
+        job = self.queue.claim()
+        self.assertEqual((job['id'], self.queue.claim()), (submitted['id'], None))
+        self.assertEqual(self.queue.recover(), [])
+        # the worker process died while running the job
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        job['worker'] = process.pid
+        self.queue.update(job)
+        self.assertEqual(self.queue.recover(), [job['id']])
+        self.assertEqual(self.queue.get(job['id'])['status'], QUEUED)
+        self.assertEqual(self.queue.claim()['id'], job['id'])
+
+    def test_workers(self):
+        worker = JobWorker(self.queue, max_workers=2, interval=0.1).start()
+        self.addCleanup(worker.stop)
+        submitted = [self.queue.submit('job') for _ in range(3)]
+        deadline = time.monotonic() + 60
+        while self.queue.statistics()['done'] < 3 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.assertEqual([self.queue.get(job['id'])['status'] for job in submitted], [FINISHED] * 3)
+
+    def test_api(self):
+        response = self.client.post(reverse('execute_notebook', args=['job']))
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual((job['status'], job['notebook']), (QUEUED, 'job'))
+        self.assertEqual(response['Location'], job['url'])
+        self.assertEqual(self.client.get(job['url']).json()['status'], QUEUED)
+        self.assertEqual(self.client.get(job['notebook_url']).status_code, 409)
+        JobWorker(jobs.default_queue).run_once()
+        self.assertEqual(self.client.get(job['url']).json()['progress'], dict(cells=2, done=2))
+        nb = nbformat.reads(self.client.get(job['notebook_url']).content.decode('utf-8'), 4)
+        self.assertEqual(nb.cells[0].outputs[0].text, 'job\n')
+        self.assertEqual(self.client.post(reverse('execute_notebook', args=['missing'])).status_code, 404)
+        self.assertEqual(self.client.post(reverse('execute_notebook', args=['job']), {'timeout': 'x'}).status_code,
+                         400)
+        self.assertEqual(self.client.get(reverse('notebook_job', args=['missing'])).status_code, 404)
+
+    def test_tenant(self):
+        from django.contrib.auth.models import User
+        url = reverse('execute_notebook', args=['job'])
+        self.client.force_login(User.objects.create_user('alice'))
+        self.assertEqual(jobs.default_queue.get(self.client.post(url).json()['id'])['tenant'], 'alice')
+        # only staff users submit for another tenant
+        self.assertEqual(self.client.post(url, {'tenant': 'bob'}).status_code, 403)
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        self.assertEqual(jobs.default_queue.get(self.client.post(url, {'tenant': 'bob'}).json()['id'])['tenant'], 'bob')
+
+
+class DatabaseJobQueueTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        write_notebook(os.path.join(self.root, 'job.ipynb'), "print('job')", "value = 2")
+        settings = override_settings(NOTEBOOKS_ROOT=self.root, NOTEBOOKS_JOBS_DIR=os.path.join(self.root, 'jobs'),
+                                     NOTEBOOKS_JOB_WORKERS=0, NOTEBOOKS_EXECUTION_ENGINE='inprocess',
+                                     NOTEBOOKS_JOB_QUEUE='database')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_claim(self):
+        first, second = DatabaseJobQueue(worker='first'), DatabaseJobQueue(worker='second')
+        submitted = [first.submit('job') for _ in range(3)]
+        claimed = [first.claim(), second.claim(), second.claim()]
+        self.assertEqual([job['id'] for job in claimed], [job['id'] for job in submitted])
+        self.assertEqual([job['worker'] for job in claimed], ['first', 'second', 'second'])
+        self.assertIsNone(first.claim())
+        self.assertTrue(first.heartbeat(claimed[0]))
+        self.assertFalse(second.heartbeat(claimed[0]))
+        first.finish(claimed[0])
+        self.assertEqual(first.get(claimed[0]['id'])['status'], NotebookJob.FINISHED)
+        self.assertEqual(first.statistics(), dict(queued=0, running=2, done=1))
+        self.assertIsNone(first.get('missing'))
+
+    def test_lost_worker(self):
+        lost, other = DatabaseJobQueue(worker='lost', lease=0.2), DatabaseJobQueue(worker='other', lease=0.2)
+        job = lost.submit('job')
+        lost.claim()
+        self.assertIsNone(other.claim())
+        time.sleep(0.3)
+        # the lease expired without a heartbeat, the job runs again
+        retried = other.claim()
+        self.assertEqual((retried['id'], retried['attempts']), (job['id'], 2))
+        self.assertFalse(lost.heartbeat(retried))
+        lost.finish(dict(retried))
+        self.assertEqual(other.get(job['id'])['status'], NotebookJob.RUNNING)
+        NotebookJob.objects.filter(pk=job['id']).update(max_attempts=2)
+        time.sleep(0.3)
+        self.assertIsNone(lost.claim())
+        failed = lost.get(job['id'])
+        self.assertEqual(failed['status'], NotebookJob.FAILED)
+        self.assertTrue(failed['error'].startswith('WorkerLost'))
+
+    def test_clean(self):
+        queue = DatabaseJobQueue(worker='first')
+        submitted = [queue.submit('job') for _ in range(3)]
+        for job in submitted:
+            queue.finish(queue.claim())
+            os.makedirs(queue.result_dir(job['id']))
+        NotebookJob.objects.filter(pk=int(submitted[0]['id'])).update(
+            finished=datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=30))
+        self.assertEqual(queue.clean(), 1)
+        self.assertFalse(os.path.exists(queue.result_dir(submitted[0]['id'])))
+        self.assertEqual(queue.clean(keep=1), 1)
+        self.assertEqual(queue.jobs('done'), [submitted[2]['id']])
+        self.assertTrue(os.path.exists(queue.result_dir(submitted[2]['id'])))
+
+    def test_thread_connections(self):
+        queue = DatabaseJobQueue(worker='first')
+        queue.submit('job')
+        closed, close_connection = [], queue.close_connection
+
+        def close():
+            closed.append(threading.current_thread().name)
+            close_connection()
+
+        queue.close_connection = close
+        self.assertEqual(JobWorker(queue, max_workers=2).drain(), 1)
+        # the worker threads closed their database connections when they exited
+        self.assertLessEqual({'notebook-job-0', 'notebook-job-1'}, set(closed))
+
+    def test_command(self):
+        response = self.client.post(reverse('execute_notebook', args=['job']))
+        self.assertEqual(response.status_code, 202)
+        queue = jobs.get_queue()
+        self.assertIsInstance(queue, DatabaseJobQueue)
+        ids = [response.json()['id']] + [queue.submit('job')['id'] for _ in range(3)]
+        out = io.StringIO()
+        call_command('notebook_worker', '--burst', '-c', '2', stdout=out)
+        self.assertIn('executed 4 jobs', out.getvalue())
+        for job_id in ids:
+            job = queue.get(job_id)
+            self.assertEqual((job['status'], job['progress']), (NotebookJob.FINISHED, dict(cells=2, done=2)))
+        nb = nbformat.read(queue.result_path(job), 4)
+        self.assertEqual(nb.cells[0].outputs[0].text, 'job\n')
+        self.assertEqual(self.client.get(response['Location']).json()['status'], NotebookJob.FINISHED)
+
+
+class SchedulerTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.history = RunHistory(os.path.join(self.root, 'history.json'))
+
+    def job(self, job_id, notebook='report', priority='default', tenant=None, waited=0):
+        created = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=waited)
+        return dict(id=job_id, notebook=notebook, priority=priority, tenant=tenant, created=created.isoformat())
+
+    def test_order(self):
+        scheduler = Scheduler(self.history, aging=600, default_duration=60)
+        order = lambda queued, running=(): [job['id'] for job in scheduler.order(queued, running)]
+        self.assertEqual(order([self.job('batch', priority='batch'), self.job('default'),
+                                self.job('interactive', priority='interactive')]), ['interactive', 'default', 'batch'])
+        # a batch job waiting twice the aging time is as urgent as an interactive one
+        self.assertEqual(order([self.job('interactive', priority='interactive', waited=1),
+                                self.job('batch', priority='batch', waited=1300)]), ['batch', 'interactive'])
+        # the tenant with fewer running jobs goes first
+        self.assertEqual(order([self.job('a', tenant='busy', waited=10), self.job('b', tenant='idle')],
+                               running=[dict(tenant='busy')]), ['b', 'a'])
+        # shortest expected job first, unknown notebooks are expected to take the default duration
+        self.history.record('long', 3600)
+        self.history.record('short', 5)
+        self.history.record('short', 15)
+        self.assertEqual(self.history.expected('short'), 8)
+        self.assertEqual(order([self.job('long', 'long', waited=20), self.job('new', 'new', waited=10),
+                                self.job('short', 'short')]), ['short', 'new', 'long'])
+
+    def test_claim(self):
+        queue = JobQueue(os.path.join(self.root, 'jobs'))
+        queue.submit('report', priority='batch')
+        first = queue.submit('report', priority='interactive', tenant='alice')
+        with self.assertRaises(ValueError):
+            queue.submit('report', priority='urgent')
+        self.assertEqual(queue.claim()['id'], first['id'])
+        database = DatabaseJobQueue(directory=os.path.join(self.root, 'jobs'), worker='worker')
+        database.submit('report', priority='batch')
+        first = database.submit('report', tenant='alice')
+        self.assertEqual(database.claim()['id'], first['id'])
+
+    def test_histograms(self):
+        start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        at = lambda seconds: (start + datetime.timedelta(seconds=seconds)).isoformat()
+        result = histograms([dict(priority='batch', created=at(0), started=at(2), finished=at(100)),
+                             dict(priority='batch', created=at(0), started=at(40), finished=at(41)),
+                             dict(priority='interactive', created=at(0), started=None, finished=None)])
+        self.assertEqual(list(result['queue_wait']), ['batch'])
+        wait = result['queue_wait']['batch']
+        self.assertEqual((wait['count'], wait['sum']), (2, 42))
+        self.assertEqual(dict((str(bound), count) for bound, count in wait['buckets'])['5'], 1)
+        self.assertEqual(wait['buckets'][-1], ['+Inf', 2])
+        self.assertEqual(result['run_time']['batch']['sum'], 99)
+
+    def test_statistics_view(self):
+        with override_settings(NOTEBOOKS_JOBS_DIR=os.path.join(self.root, 'jobs'), NOTEBOOKS_JOB_WORKERS=0):
+            jobs.default_queue.submit('report')
+            response = self.client.get(reverse('job_statistics'))
+        self.assertEqual(response.json()['jobs'], dict(queued=1, running=0, done=0))
+        self.assertEqual(response.json()['queue_wait'], {})
+
+
+class KernelLimitsTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def execute(self, limits, *sources):
+        write_notebook(os.path.join(self.root, 'limited.ipynb'), *sources)
+        executor = NotebookExecutor('limited', path=self.root, limits=limits)
+        executor.read()
+        executor()
+        return executor.nb
+
+    def test_cpu_time(self):
+        start = time.perf_counter()
+        with self.assertRaises(Exception) as context:
+            self.execute(KernelLimits(cpu_time=1), "while True:\n    pass")
+        self.assertEqual(type(context.exception).__name__, 'DeadKernelError')
+        self.assertLess(time.perf_counter() - start, 60)
+
+    def test_memory(self):
+        source = "try:\n    bytearray(1024 ** 3)\n    print('allocated')\nexcept MemoryError:\n    print('limited')"
+        self.assertEqual(self.execute(KernelLimits(), source).cells[0].outputs[0].text, 'allocated\n')
+        # the address space of the kernel includes its libraries
+        self.assertEqual(self.execute(KernelLimits(memory=1024 ** 3), source).cells[0].outputs[0].text, 'limited\n')
+
+
+class ParameterizedExecutionTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        b = NotebookBuilder().notebook().code("import math").code("customer = 'nobody'\nrate = 1")
+        b.cells[-1].metadata['tags'] = ['parameters']
+        b.code("print(customer, rate * 2)")
+        self.nb = b.build()
+        with open(os.path.join(self.root, 'invoice.ipynb'), 'wt') as f:
+            nbformat.write(self.nb, f)
+        settings = override_settings(NOTEBOOKS_RESULT_CACHE_DIR=os.path.join(self.root, 'results'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_inject(self):
+        cell = inject_parameters(self.nb, {'rate': 3, 'customer': 'acme'})
+        self.assertIs(self.nb.cells[2], cell)
+        self.assertEqual(cell.source, "# Parameters\ncustomer = 'acme'\nrate = 3")
+        inject_parameters(self.nb, {'rate': 4})
+        self.assertEqual([c.source for c in self.nb.cells if INJECTED_TAG in c.metadata.get('tags', [])],
+                         ["# Parameters\nrate = 4"])
+        with self.assertRaises(ValueError):
+            inject_parameters(self.nb, {'not a name': 1})
+        nb = NotebookBuilder().notebook().code("print(rate)").build()
+        inject_parameters(nb, {'rate': 1})
+        self.assertEqual(nb.cells[0].metadata['tags'], [INJECTED_TAG])
+        self.assertEqual(result_key(nb, {'a': 1, 'b': [1, 2]}, 'python3'),
+                         result_key(nb, {'b': [1, 2], 'a': 1}, 'python3'))
+
+    def test_memoize(self):
+        output_dir = os.path.join(self.root, 'out')
+        run = execute_notebook('invoice', root=self.root, output_dir=output_dir, engine='inprocess',
+                               parameters={'customer': 'acme', 'rate': 21}, memoize=True)
+        self.assertEqual((run.ok, run.cached), (True, False))
+        self.assertEqual(run.notebook.cells[3].outputs[0].text, 'acme 42\n')
+        # the notebook itself is unchanged
+        self.assertEqual(len(nbformat.read(os.path.join(self.root, 'invoice.ipynb'), 4).cells), 3)
+        again = execute_notebook('invoice', root=self.root, output_dir=output_dir, engine='inprocess',
+                                 parameters={'rate': 21, 'customer': 'acme'}, memoize=True)
+        self.assertEqual((again.cached, again.key), (True, run.key))
+        self.assertEqual(nbformat.read(again.output_path, 4).cells[3].outputs[0].text, 'acme 42\n')
+        other = execute_notebook('invoice', root=self.root, output_dir=output_dir, engine='inprocess',
+                                 parameters={'customer': 'acme', 'rate': 1}, memoize=True)
+        self.assertFalse(other.cached)
+        self.assertEqual(other.notebook.cells[3].outputs[0].text, 'acme 2\n')
+
+    def test_fan_out(self):
+        output_dir = os.path.join(self.root, 'out')
+        parameter_sets = [{'customer': 'customer%d' % i, 'rate': i} for i in range(4)]
+        runs = execute_parameterized('invoice', parameter_sets, root=self.root, output_dir=output_dir,
+                                     max_workers=2, engine='inprocess')
+        self.assertEqual([run.ok for run in runs], [True] * 4)
+        for i, run in enumerate(runs):
+            nb = nbformat.read(os.path.join(output_dir, 'invoice-%d.ipynb' % i), 4)
+            self.assertEqual(nb.cells[3].outputs[0].text, 'customer%d %d\n' % (i, 2 * i))
+        out = io.StringIO()
+        call_command('execute_notebooks', 'invoice', '--root', self.root, '--output-dir', output_dir,
+                     '--engine', 'inprocess', '--memoize', '--parameters', json.dumps(parameter_sets[:2]), stdout=out)
+        self.assertEqual(out.getvalue().count('cached'), 2)
+        with self.assertRaises(CommandError):
+            call_command('execute_notebooks', 'invoice', '--root', self.root, '--parameters', '{}', stdout=out)
+
+    def test_fan_out_notebooks(self):
+        for name in ('first', 'second'):
+            write_notebook(os.path.join(self.root, name + '.ipynb'),
+                           "import time\nstart = time.time()\ntime.sleep(0.3)\nstart, time.time(), pause")
+        runs = execute_parameterized(['first', 'second'], [{'pause': 1}, {'pause': 2}], root=self.root,
+                                     output_dir=os.path.join(self.root, 'out'), max_workers=4, engine='inprocess')
+        self.assertEqual([(run.name, run.parameters['pause']) for run in runs],
+                         [('first', 1), ('first', 2), ('second', 1), ('second', 2)])
+        spans = [ast.literal_eval(run.notebook.cells[1].outputs[0].data['text/plain']) for run in runs]
+        # the runs of both notebooks shared the workers, all of them at the same time
+        self.assertLess(max(span[0] for span in spans), min(span[1] for span in spans))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'out', 'second-1.ipynb')))
+
+    def test_api(self):
+        with override_settings(NOTEBOOKS_ROOT=self.root, NOTEBOOKS_JOBS_DIR=os.path.join(self.root, 'jobs'),
+                               NOTEBOOKS_JOB_WORKERS=0, NOTEBOOKS_EXECUTION_ENGINE='inprocess'):
+            url = reverse('execute_notebook', args=['invoice'])
+            response = self.client.post(url, {'parameters': {'customer': 'acme', 'rate': 5}},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(self.client.post(url, {'parameters': [1]}, content_type='application/json').status_code,
+                             400)
+            JobWorker(jobs.default_queue).run_once()
+            nb = nbformat.reads(self.client.get(response.json()['notebook_url']).content.decode('utf-8'), 4)
+        self.assertEqual(nb.cells[3].outputs[0].text, 'acme 10\n')
+
+
+class PartialExecutionTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        b = NotebookBuilder().notebook().code("import time\nstart = time.time()").markdown("# Data")
+        b.code("data = list(range(5))").code("unused = 1").code("total = sum(data)\nprint(total)")
+        b.code("print('footer')")
+        b.cells[2].metadata['tags'] = ['parameters']
+        b.cells[4].metadata['tags'] = ['summary']
+        b.cells[5].metadata['tags'] = ['footer']
+        self.nb = b.build()
+        for cell in self.nb.cells:
+            if cell.cell_type == 'code':
+                cell.outputs = [nbformat.v4.new_output('stream', name='stdout', text='old\n')]
+        with open(os.path.join(self.root, 'dashboard.ipynb'), 'wt') as f:
+            nbformat.write(self.nb, f)
+
+    def test_select_cells(self):
+        self.assertIsNone(select_cells(self.nb))
+        self.assertEqual(select_cells(self.nb, target=4), [2, 4])
+        self.assertEqual(select_cells(self.nb, cells='3:'), [3, 4, 5])
+        self.assertEqual(select_cells(self.nb, cells=slice(None, 2)), [0])
+        self.assertEqual(select_cells(self.nb, cells=[-1], tags=['summary']), [4, 5])
+        with self.assertRaises(IndexError):
+            select_cells(self.nb, cells=[6])
+        with self.assertRaises(ValueError):
+            select_cells(self.nb, target=1)
+
+    def execute(self, **options):
+        executed = []
+        with NotebookExecutor('dashboard', path=self.root, engine='inprocess',
+                              on_cell=lambda index, cell, duration: executed.append(index), **options) as e:
+            e()
+        return e.nb, executed
+
+    def test_target(self):
+        nb, executed = self.execute(target=4)
+        self.assertEqual(executed, [2, 4])
+        self.assertEqual(nb.cells[4].outputs[0].text, '10\n')
+        # the other cells keep their outputs
+        self.assertEqual([nb.cells[index].outputs[0].text for index in (0, 3, 5)], ['old\n'] * 3)
+        self.assertEqual(nbformat.read(os.path.join(self.root, 'dashboard.ipynb'), 4).cells[4].outputs[0].text,
+                         '10\n')
+
+    def test_tags_with_parameters(self):
+        nb, executed = self.execute(tags=['summary'], target=4, parameters={'data': [1, 2]})
+        # the parameters are injected after cell 2, the indexes refer to the notebook without them
+        self.assertEqual(executed, [2, 3, 5])
+        self.assertEqual(nb.cells[5].outputs[0].text, '3\n')
+        with NotebookExecutor('dashboard', path=self.root, engine='inprocess', tags=['footer']) as e:
+            events = list(e.stream())
+        self.assertEqual(events[0]['cells'], 1)
+        self.assertEqual(events[-1]['status'], 'ok')
+        with self.assertRaises(ValueError):
+            NotebookExecutor('dashboard', path=self.root, cell_cache=True, tags=['summary'])
+
+    def test_view(self):
+        with override_settings(NOTEBOOKS_ROOT=self.root, NOTEBOOKS_JOBS_DIR=os.path.join(self.root, 'jobs'),
+                               NOTEBOOKS_EXECUTION_ENGINE='inprocess'):
+            url = reverse('execute_notebook_stream', args=['dashboard'])
+            body = b''.join(self.client.post(url, {'tags': 'footer'}).streaming_content).decode('utf-8')
+            self.assertEqual(self.client.post(url, {'cells': '9'}).status_code, 400)
+        self.assertEqual(body.count('event: cell\n'), 1)
+        self.assertIn('"text": "footer\\n"', body)
+
+    def test_job_view(self):
+        with override_settings(NOTEBOOKS_ROOT=self.root, NOTEBOOKS_JOBS_DIR=os.path.join(self.root, 'jobs'),
+                               NOTEBOOKS_JOB_WORKERS=0):
+            url = reverse('execute_notebook', args=['dashboard'])
+
+            def post(**data):
+                return self.client.post(url, json.dumps(data), content_type='application/json')
+
+            response = post(tags='summary,footer', target='4', cells='0:1')
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.json()['options'], dict(tags=['summary', 'footer'], target=4, cells='0:1'))
+            self.assertEqual(post(tags=['summary'], cells=[0]).json()['options'], dict(tags=['summary'], cells=[0]))
+            for data in (dict(target='x'), dict(target=1), dict(target=[4]), dict(cells='9'), dict(cells='a:'),
+                         dict(cells=['0']), dict(tags=[1]), dict(tags={'summary': 1})):
+                response = post(**data)
+                self.assertEqual(response.status_code, 400, data)
+                self.assertIn('Invalid cells, tags or target', response.json()['detail'])
+
+
+class CheckpointTestCase(TestCase):
+
+    sources = [
+        # the in-process engine runs in the working directory of the process
+        "import os\nwith open(os.path.join(%(root)r, 'runs'), 'a') as f:\n    f.write('x')\n"
+        "def double(x):\n    return 2 * x",
+        "values = [1, 2]\nsecret = 'token'",
+        "assert os.path.exists(os.path.join(%(root)r, 'go')), 'not yet'",
+        "print(double(sum(values)), 'secret' in dir())",
+    ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.store = CheckpointStore(os.path.join(self.root, 'checkpoints'), keep=2, skip=['secret'])
+        self.nb_path = os.path.join(self.root, 'long.ipynb')
+        write_notebook(self.nb_path, *[source % dict(root=self.root) for source in self.sources])
+
+    def execute(self, engine='inprocess', **options):
+        with NotebookExecutor('long', path=self.root, engine=engine, checkpoint=self.store, **options) as e:
+            e()
+        return e.nb
+
+    def assert_resumes(self, engine):
+        with self.assertRaises(CellExecutionError):
+            self.execute(engine)
+        self.assertEqual([checkpoint.index for checkpoint in self.store.checkpoints(self.nb_path)], [1, 0])
+        open(os.path.join(self.root, 'go'), 'w').close()
+        done = []
+        nb = self.execute(engine, resume=True, on_cell=lambda index, cell, duration: done.append(index))
+        # the cells up to the checkpoint did not run again, the namespace came back without the skipped names
+        with open(os.path.join(self.root, 'runs')) as f:
+            self.assertEqual(f.read(), 'x')
+        self.assertEqual(nb.cells[3].outputs[0].text, '6 False\n')
+        self.assertEqual(nb.cells[1].execution_count, 2)
+        self.assertEqual(done, [0, 1, 2, 3])
+        # a complete run removes its checkpoints
+        self.assertEqual(self.store.checkpoints(self.nb_path), [])
+
+    def test_resume_inprocess(self):
+        self.assert_resumes('inprocess')
+
+    def test_resume_kernel(self):
+        self.assert_resumes('kernel')
+
+    def test_retention_and_changed_cells(self):
+        with self.assertRaises(CellExecutionError):
+            self.execute()
+        nb = nbformat.read(self.nb_path, 4)
+        self.assertEqual(self.store.latest(self.nb_path, nb, 'python3').index, 1)
+        nb.cells[1].source = "values = [3]"
+        # the checkpoint of cell 1 does not match, the one of cell 0 does
+        self.assertEqual(self.store.latest(self.nb_path, nb, 'python3').index, 0)
+        nb.cells[0].source += "\n"
+        self.assertIsNone(self.store.latest(self.nb_path, nb, 'python3'))
+        CheckpointStore(self.store.directory, keep=1).evict(self.nb_path)
+        self.assertEqual([checkpoint.index for checkpoint in self.store.checkpoints(self.nb_path)], [1])
+        with self.assertRaises(ValueError):
+            NotebookExecutor('long', path=self.root, engine='parallel', checkpoint=True)
+
+
+class OutputPolicyTestCase(TestCase):
+
+    sources = [
+        "for i in range(5000):\n    print('line %04d' % i)",
+        "from IPython.display import HTML, display\ndisplay(HTML('<p>%s</p>' % ('x' * 5000)))\nprint('after')\n'small'",
+        "print('last')\n1 / 0",
+    ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        write_notebook(os.path.join(self.root, 'noisy.ipynb'), *self.sources)
+
+    def execute(self, engine, policy):
+        with NotebookExecutor('noisy', path=self.root, engine=engine, output_policy=policy) as e:
+            with self.assertRaises(CellExecutionError):
+                e()
+        return e.nb
+
+    def test_spill(self):
+        policy = OutputPolicy(cell_limit=2000, spill_size=1000)
+        for engine in ('kernel', 'inprocess'):
+            nb = self.execute(engine, policy)
+            stream = nb.cells[0].outputs[0].text
+            # the head and the tail of the stream are kept, all of it is in the side file
+            self.assertLess(len(stream), 1200)
+            self.assertTrue(stream.startswith('line 0000\n'))
+            self.assertTrue(stream.endswith('line 4999\n'))
+            self.assertIn('the whole stdout is in noisy.outputs/cell-0-0-stdout.txt', stream)
+            with open(os.path.join(self.root, 'noisy.outputs', 'cell-0-0-stdout.txt')) as f:
+                self.assertEqual(f.read(), ''.join('line %04d\n' % i for i in range(5000)))
+            display, after, result = nb.cells[1].outputs
+            self.assertEqual(display.metadata['spilled'], 'noisy.outputs/cell-1-0.json')
+            self.assertNotIn('text/html', display.data)
+            with open(os.path.join(self.root, display.metadata['spilled'])) as f:
+                self.assertEqual(len(json.load(f)['data']['text/html']), 5007)
+            self.assertEqual((after.text, result.data['text/plain']), ('after\n', "'small'"))
+            self.assertEqual(nb.cells[1].metadata.spilled_outputs, ['noisy.outputs/cell-1-0.json'])
+
+    def test_total_limit(self):
+        nb = self.execute('inprocess', OutputPolicy(total_limit=3000))
+        self.assertIn('characters truncated ...', nb.cells[0].outputs[0].text)
+        self.assertLessEqual(len(nb.cells[0].outputs[0].text), 3100)
+        # nothing is left for the later cells, errors are kept
+        self.assertEqual(nb.cells[1].outputs[0].data['text/plain'],
+                         '<IPython.core.display.HTML object>\n<display_data output of 5041 characters>')
+        self.assertEqual(nb.cells[2].outputs[0].text, '\n... 5 characters truncated ...\n')
+        self.assertEqual(nb.cells[2].outputs[1].ename, 'ZeroDivisionError')
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'noisy.outputs')))
+
+
+class NotebookCatalogTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        write_notebook(os.path.join(self.root, 'report.ipynb'), 'x = 1', 'x')
+        write_notebook(os.path.join(self.root, 'report_daily.ipynb'), 'y = 2')
+        write_notebook(os.path.join(self.root, 'summary.ipynb'), 'z = 3')
+        with open(os.path.join(self.root, 'notes.txt'), 'w') as f:
+            f.write('not a notebook')
+
+    def test_entries(self):
+        catalog = NotebookCatalog(self.root)
+        self.assertEqual([entry.name for entry in catalog.all()], ['report', 'report_daily', 'summary'])
+        entry = catalog.get('report')
+        self.assertIs(catalog.get('report.ipynb'), entry)
+        self.assertEqual((entry.cells, entry.code_cells, entry.markdown_cells), (2, 2, 0))
+        with open(os.path.join(self.root, 'report.ipynb'), 'rb') as f:
+            self.assertEqual(entry.hash, hashlib.sha256(f.read()).hexdigest())
+        self.assertEqual(entry.as_dict()['size'], os.path.getsize(os.path.join(self.root, 'report.ipynb')))
+        self.assertIsNone(catalog.get('notes'))
+        self.assertEqual([entry.name for entry in catalog.prefix('report')], ['report', 'report_daily'])
+        self.assertEqual(catalog.prefix('x'), [])
+
+    def test_refresh(self):
+        catalog = NotebookCatalog(self.root)
+        summary = catalog.get('summary')
+        os.remove(os.path.join(self.root, 'report_daily.ipynb'))
+        write_notebook(os.path.join(self.root, 'added.ipynb'), 'a = 1')
+        write_notebook(os.path.join(self.root, 'report.ipynb'), 'x = 1', 'x', 'x + 1')
+        catalog.refresh()
+        self.assertEqual([entry.name for entry in catalog.all()], ['added', 'report', 'summary'])
+        self.assertEqual(catalog.get('report').cells, 3)
+        # unchanged notebooks are not read again
+        self.assertIs(catalog.get('summary'), summary)
+
+    def test_watch(self):
+        catalog = NotebookCatalog(self.root, interval=0.05).start()
+        self.addCleanup(catalog.stop)
+        self.assertTrue(catalog.watching)
+        write_notebook(os.path.join(self.root, 'added.ipynb'), 'a = 1')
+        os.remove(os.path.join(self.root, 'summary.ipynb'))
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and [entry.name for entry in catalog.prefix('')] != [
+                'added', 'report', 'report_daily']:
+            time.sleep(0.02)
+        self.assertEqual([entry.name for entry in catalog.all()], ['added', 'report', 'report_daily'])
+        catalog.stop()
+        self.assertFalse(catalog.watching)
+
+    def test_manager(self):
+        with self.settings(NOTEBOOKS_CATALOG_WATCH=False):
+            manager = NotebookFileManager(self.root)
+            self.assertEqual([notebook.filename for notebook in manager.all()],
+                             ['report.ipynb', 'report_daily.ipynb', 'summary.ipynb'])
+            self.assertEqual(manager.get('summ').filename, 'summary.ipynb')
+            self.assertEqual(manager.get('report').entry.name, 'report')
+            self.assertFalse(manager.catalog.watching)
+            with self.assertRaises(exceptions.NotebookNotFindException):
+                manager.get('notes')
+
+
+class NotebookListingTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for position, name in enumerate(['alpha', 'beta', 'gamma', 'report_a', 'report_b']):
+            path = os.path.join(self.root, '%s.ipynb' % name)
+            write_notebook(path, *['x = %d' % i for i in range(position + 1)])
+            nb = nbformat.read(path, 4)
+            nb.metadata.kernelspec = {'name': 'python3', 'language': 'python'} if position < 3 else {'name': 'ir'}
+            nbformat.write(nb, path)
+            os.utime(path, (1000000000 + position * 100, 1000000000 + position * 100))
+        self.catalog = NotebookCatalog(self.root)
+
+    def pages(self, **query):
+        names, cursor = [], None
+        while True:
+            entries, cursor = self.catalog.page(cursor=cursor, limit=2, **query)
+            names.append([entry.name for entry in entries])
+            if cursor is None:
+                return names
+
+    def test_page(self):
+        self.assertEqual(self.pages(), [['alpha', 'beta'], ['gamma', 'report_a'], ['report_b']])
+        self.assertEqual(self.pages(ordering='-name'), [['report_b', 'report_a'], ['gamma', 'beta'], ['alpha']])
+        self.assertEqual(self.pages(ordering='-cells'), [['report_b', 'report_a'], ['gamma', 'beta'], ['alpha']])
+        self.assertEqual(self.pages(ordering='mtime', modified_after=1000000150), [['gamma', 'report_a'], ['report_b']])
+        self.assertEqual(self.pages(prefix='report', ordering='-size'), [['report_b', 'report_a']])
+        self.assertEqual(self.pages(modified_before=1000000150, kernel='python3'), [['alpha', 'beta']])
+        self.assertEqual(self.pages(kernel='ir', language='python'), [[]])
+        self.assertEqual(self.pages(extension='txt'), [[]])
+        entries, cursor = self.catalog.page(limit=2)
+        with self.assertRaises(ValueError):
+            self.catalog.page(ordering='mtime', cursor=cursor)
+        with self.assertRaises(ValueError):
+            self.catalog.page(cursor='garbage')
+        with self.assertRaises(ValueError):
+            self.catalog.page(ordering='owner')
+
+    def test_views(self):
+        with self.settings(NOTEBOOKS_ROOT=self.root, NOTEBOOKS_CATALOG_WATCH=False):
+            response = self.client.get(reverse('list_notebooks_json'), {'prefix': 'report', 'limit': 1})
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertEqual([result['filename'] for result in page['results']], ['report_a.ipynb'])
+            self.assertEqual(page['results'][0]['cells'], 4)
+            self.assertEqual(page['results'][0]['modified'], '2001-09-09T01:51:40+00:00')
+            page = self.client.get(page['next']).json()
+            self.assertEqual(([result['name'] for result in page['results']], page['next']), (['report_b'], None))
+            response = self.client.get(reverse('list_notebooks_json'),
+                                       {'modified_after': '2001-09-09T01:48:20+00:00', 'ordering': '-mtime'})
+            self.assertEqual([result['name'] for result in response.json()['results']],
+                             ['report_b', 'report_a', 'gamma'])
+            self.assertEqual(self.client.get(reverse('list_notebooks_json'), {'ordering': 'x'}).status_code, 400)
+            self.assertEqual(self.client.get(reverse('list_notebooks_json'), {'modified_after': 'x'}).status_code, 400)
+
+            response = self.client.get(reverse('list_notebooks'), {'limit': 3})
+            self.assertEqual([notebook.name for notebook in response.context['notebooks']], ['alpha', 'beta', 'gamma'])
+            self.assertIn('cursor=', response.context['next'])
+
+
+class NotebookPackageTestCase(NotebookPackageMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.shop = os.path.join(self.root, 'shop')
+        os.makedirs(os.path.join(self.shop, 'reports'))
+        write_notebook(os.path.join(self.shop, '__init__.ipynb'), "from . import orders", "total = orders.value * 2")
+        write_notebook(os.path.join(self.shop, 'orders.ipynb'), "value = 21")
+        write_notebook(os.path.join(self.shop, 'reports', 'daily.ipynb'), "from .. import orders",
+                       "value = orders.value")
+
+    def test_import(self):
+        with self.settings(NOTEBOOKS_ROOT=self.root):
+            shop = importlib.import_module('%s.shop' % self.package)
+        self.assertEqual(shop.total, 42)
+        self.assertEqual(shop.__path__, [self.shop])
+        self.assertEqual(shop.__package__, '%s.shop' % self.package)
+        self.assertEqual(shop.__file__, os.path.join(self.shop, '__init__.ipynb'))
+        daily = importlib.import_module('%s.shop.reports.daily' % self.package)
+        self.assertEqual(daily.value, 21)
+        self.assertEqual(find_notebook('shop', [self.root]), os.path.join(self.shop, '__init__.ipynb'))
+
+    def test_directory_package(self):
+        # a directory of notebooks which is not on sys.path
+        finder = NotebookFinder(negative_ttl=0)
+        spec = finder.find_spec('elsewhere.reports', [self.shop])
+        self.assertIsNone(spec.origin)
+        self.assertEqual(spec.submodule_search_locations, [os.path.join(self.shop, 'reports')])
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        self.assertEqual(mod.__path__, [os.path.join(self.shop, 'reports')])
+        spec = finder.find_spec('elsewhere.reports.daily', mod.__path__)
+        self.assertEqual(spec.origin, os.path.join(self.shop, 'reports', 'daily.ipynb'))
+        self.assertIsNone(finder.find_spec('elsewhere.missing', [self.shop]))
+
+    def test_outside_root(self):
+        # the __init__.ipynb of packages outside NOTEBOOKS_ROOT is not looked for before the path finder
+        with self.settings(NOTEBOOKS_ROOT=os.path.join(self.root, 'elsewhere')):
+            shop = importlib.import_module('%s.shop' % self.package)
+        self.assertFalse(hasattr(shop, 'total'))
+
+    def test_unrelated_import(self):
+        for name in ('colorsys', 'json.tool'):
+            sys.modules.pop(name, None)
+        hydra_notebook.finder.invalidate_caches()
+        counters = dict(hydra_notebook.finder.listing.counters)
+        importlib.import_module('colorsys')
+        importlib.import_module('json.tool')
+        self.assertEqual(dict(hydra_notebook.finder.listing.counters), counters)
+        self.assertEqual(hydra_notebook.finder.listing._listings, {})
+
+
+class NotebookTreeTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for path in ('a.ipynb', 'My Notes.ipynb', 'reports/daily.ipynb', 'reports/2024/jan.ipynb',
+                     'shop/__init__.ipynb', 'shop/orders.ipynb'):
+            os.makedirs(os.path.dirname(os.path.join(self.root, path)), exist_ok=True)
+            write_notebook(os.path.join(self.root, path), 'x = 1')
+        os.makedirs(os.path.join(self.root, '.ipynb_checkpoints'))
+        os.makedirs(os.path.join(self.root, '__pycache__'))
+        self.tree = NotebookTree(self.root)
+
+    def test_children(self):
+        nodes = self.tree.children()
+        # the sub directories are not listed
+        self.assertEqual(self.tree.listing.counters['scans'], 1)
+        self.assertEqual([(node['path'], node['type']) for node in nodes],
+                         [('reports', 'directory'), ('shop', 'package'), ('My Notes.ipynb', 'notebook'),
+                          ('a.ipynb', 'notebook')])
+        self.assertEqual([node['module'] for node in nodes], ['reports', 'shop', None, 'a'])
+        self.assertEqual([node['path'] for node in self.tree.children('shop')], ['shop/orders.ipynb'])
+        self.assertEqual(self.tree.children('reports')[0]['module'], None)
+
+        scans = self.tree.listing.counters['scans']
+        self.assertEqual(self.tree.children(), nodes)
+        self.assertEqual(self.tree.listing.counters['scans'], scans)
+        # a new package inside reports does not change the root directory
+        write_notebook(os.path.join(self.root, 'reports', '__init__.ipynb'), 'x = 1')
+        self.assertEqual(self.tree.children()[0]['type'], 'package')
+
+        with self.assertRaises(ValueError):
+            self.tree.children('../')
+        with self.assertRaises(FileNotFoundError):
+            self.tree.children('missing')
+
+    def test_expand(self):
+        nodes = self.tree.expand(depth=3)
+        self.assertEqual([node['path'] for node in nodes[0]['children']], ['reports/2024', 'reports/daily.ipynb'])
+        self.assertEqual(nodes[0]['children'][0]['children'][0]['path'], 'reports/2024/jan.ipynb')
+        self.assertNotIn('children', self.tree.expand(depth=1)[0])
+
+    def test_view(self):
+        with self.settings(NOTEBOOKS_ROOT=self.root, NOTEBOOKS_CATALOG_WATCH=False):
+            response = self.client.get(reverse('notebook_tree'), {'path': 'reports', 'depth': 2})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([node['name'] for node in response.json()['children']], ['2024', 'daily.ipynb'])
+            self.assertEqual(response.json()['children'][0]['children'][0]['path'], 'reports/2024/jan.ipynb')
+            self.assertEqual(self.client.get(reverse('notebook_tree'), {'path': 'missing'}).status_code, 404)
+            self.assertEqual(self.client.get(reverse('notebook_tree'), {'path': '../'}).status_code, 400)
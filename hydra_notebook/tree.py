@@ -0,0 +1,92 @@
+"""Tree of the notebooks below a root directory
+
+The tree is expanded lazily: ``children`` lists one directory, and
+``expand`` a directory down to ``depth`` levels, so browsing a deep tree
+only lists the directories that are opened, one scan per expanded level. The nodes of a directory are
+built from the DirectoryListingCache and kept until the modification time
+of the directory changes.
+"""
+import os
+import threading
+
+from .cache import CACHE_DIRNAME
+from .importer import PACKAGE_INIT
+from .listing import DirectoryListingCache
+
+EXTENSION = '.ipynb'
+
+DIRECTORY = 'directory'
+PACKAGE = 'package'
+NOTEBOOK = 'notebook'
+
+
+class NotebookTree(object):
+    """Lazily expanded tree of the notebooks and directories below ``root``"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.listing = DirectoryListingCache()
+        self._nodes = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, path):
+        """the directory of a path relative to the root, ValueError if it is outside the root"""
+        directory = os.path.normpath(os.path.join(self.root, path or ''))
+        if directory != self.root and not directory.startswith(self.root + os.sep):
+            raise ValueError('%r is outside the notebook root' % path)
+        return directory
+
+    def module_name(self, path):
+        """the dotted name importing the notebook or directory, None if a part is not an identifier"""
+        parts = path.split('/')
+        if parts[-1].endswith(EXTENSION):
+            parts[-1] = parts[-1][:-len(EXTENSION)]
+        if all(part.isidentifier() for part in parts):
+            return '.'.join(parts)
+        return None
+
+    def children(self, path=''):
+        """the nodes of a directory: the directories first, then the notebooks, sorted by name
+
+        A node is a dict with the name, the path relative to the root, the
+        type (DIRECTORY, PACKAGE for a directory with an __init__.ipynb or
+        NOTEBOOK) and the module name importing it. Raises
+        FileNotFoundError if the directory does not exist.
+        """
+        directory = self.resolve(path)
+        # the listing is a single stat while the directory is unchanged, the same sets are returned then
+        files, dirs = self.listing.files(directory), self.listing.dirs(directory)
+        cached = self._nodes.get(directory)
+        if cached is None or cached[0] is not files or cached[1] is not dirs:
+            if not files and not dirs and not os.path.isdir(directory):
+                raise FileNotFoundError('No directory %r' % path)
+            prefix = os.path.relpath(directory, self.root).replace(os.sep, '/') + '/'
+            prefix = '' if prefix == './' else prefix
+            subdirs = [self._node(name, prefix + name, DIRECTORY) for name in sorted(dirs)
+                       if not name.startswith('.') and name != CACHE_DIRNAME]
+            notebooks = [self._node(name, prefix + name, NOTEBOOK) for name in sorted(files)
+                         if name.endswith(EXTENSION) and name != PACKAGE_INIT]
+            cached = (files, dirs, subdirs, notebooks)
+            with self._lock:
+                self._nodes[directory] = cached
+        # the sub directories are not listed, a directory turns into a package without a change of its parent,
+        # the __init__.ipynb costs a stat
+        return [dict(node, type=PACKAGE) if os.path.isfile(os.path.join(self.root, node['path'], PACKAGE_INIT))
+                else node for node in cached[2]] + cached[3]
+
+    def _node(self, name, path, type):
+        return dict(name=name, path=path, type=type, module=self.module_name(path))
+
+    def expand(self, path='', depth=1):
+        """the nodes of a directory, the directories with their ``children`` down to depth levels"""
+        nodes = []
+        for node in self.children(path):
+            if node['type'] != NOTEBOOK and depth > 1:
+                node = dict(node, children=self.expand(node['path'], depth - 1))
+            nodes.append(node)
+        return nodes
+
+    def invalidate(self):
+        with self._lock:
+            self._nodes.clear()
+        self.listing.invalidate()
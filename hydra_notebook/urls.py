@@ -27,7 +27,14 @@ urlpatterns = [
     path('script/native/notebook/download/<str:name>/', views.notebook_script_download, name='notebook_script_download'),
 
     url(r'^api/native/notebooks/$', views.list_notebooks_json, name='list_notebooks_json'),
+    path('api/native/tree/', views.notebook_tree, name='notebook_tree'),
     url(r'^api/native/notebook/(?P<name>[^/]+)$', views.show_notebook_json, name='show_notebook_json'),
+    path('api/native/notebook/<str:name>/execute/stream/', views.execute_notebook_stream,
+         name='execute_notebook_stream'),
+    path('api/native/notebook/<str:name>/execute/', views.execute_notebook, name='execute_notebook'),
+    path('api/native/jobs/statistics/', views.job_statistics, name='job_statistics'),
+    path('api/native/jobs/<str:job_id>/', views.notebook_job, name='notebook_job'),
+    path('api/native/jobs/<str:job_id>/notebook/', views.notebook_job_result, name='notebook_job_result'),
     url(r'^api/native/notebook/upload/(?P<filename>[^/]+)$', views.FileUploadView.as_view(), name='upload_notebook_file'),
     # url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework'))
 ]
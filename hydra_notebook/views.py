@@ -1,11 +1,16 @@
+import datetime
 import io
 import json
 import os
 
 import nbformat
 from django.conf import settings
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseBadRequest, Http404, StreamingHttpResponse
 from django.shortcuts import render
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_POST
 from nbconvert import HTMLExporter, ScriptExporter, PythonExporter
 from pygments.formatters.html import HtmlFormatter
 from pygments.lexers.python import PythonLexer
@@ -14,16 +19,59 @@ from rest_framework.decorators import api_view
 from rest_framework.parsers import FileUploadParser
 from rest_framework.response import Response
 
-from hydra_notebook.core import NotebookFileModel, NotebookFileManager
+from hydra_notebook import jobs
+from hydra_notebook.conf import get_setting
+from hydra_notebook.core import NotebookExecutor, NotebookFileModel, NotebookFileManager
+from hydra_notebook.scheduler import PRIORITIES, histograms
+from hydra_notebook.selection import parse_cells, select_cells
 
 formatter = HtmlFormatter()
 lexer = PythonLexer()
 
-notebook_manager = NotebookFileManager.create()
+
+def _timestamp(value):
+    """seconds since the epoch of an ISO 8601 date and time or of a number of seconds"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    moment = parse_datetime(value)
+    if moment is None:
+        raise ValueError('Invalid date and time %r' % value)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment.timestamp()
+
+
+def _notebook_page(request):
+    """the notebooks of a listing page and the url of the next page, the filters are query parameters"""
+    params = request.GET
+    limit = int(params.get('limit') or get_setting('NOTEBOOKS_PAGE_SIZE', 100))
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    entries, cursor = NotebookFileManager.create().catalog.page(
+        prefix=params.get('prefix', ''), extension=params.get('extension'), kernel=params.get('kernel'),
+        language=params.get('language'),
+        modified_after=_timestamp(params['modified_after']) if params.get('modified_after') else None,
+        modified_before=_timestamp(params['modified_before']) if params.get('modified_before') else None,
+        ordering=params.get('ordering') or 'name', cursor=params.get('cursor') or None,
+        limit=min(limit, get_setting('NOTEBOOKS_MAX_PAGE_SIZE', 1000)))
+    next_url = None
+    if cursor is not None:
+        query = params.copy()
+        query['cursor'] = cursor
+        next_url = request.build_absolute_uri('%s?%s' % (request.path, query.urlencode()))
+    return entries, next_url
+
 
 def list_notebooks(request):
+    try:
+        entries, next_url = _notebook_page(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
     return render(request, template_name='hydra_notebook/index.html', context={
-        'notebooks': notebook_manager.all()
+        'notebooks': [NotebookFileModel(filename=entry.filename, entry=entry) for entry in entries],
+        'next': next_url,
     })
 
 
@@ -61,8 +109,31 @@ def notebook_script_download(request, name):
 
 @api_view(['GET'])
 def list_notebooks_json(request):
-    contents = os.listdir(settings.NOTEBOOKS_ROOT)
-    return Response(contents)
+    """a page of the notebooks, filtered by prefix, extension, kernel, language, modified_after and modified_before"""
+    try:
+        entries, next_url = _notebook_page(request)
+    except ValueError as e:
+        return Response({'detail': str(e)}, status=400)
+    results = [dict(entry.as_dict(), modified=datetime.datetime.fromtimestamp(
+        entry.mtime / 1e9, datetime.timezone.utc).isoformat()) for entry in entries]
+    return Response({'next': next_url, 'results': results})
+
+
+@api_view(['GET'])
+def notebook_tree(request):
+    """the notebooks and directories of a directory below the root, expanded down to depth levels"""
+    path = request.GET.get('path', '')
+    try:
+        depth = int(request.GET.get('depth') or 1)
+        if depth < 1:
+            raise ValueError('depth must be positive')
+        nodes = NotebookFileManager.create().tree.expand(
+            path, min(depth, get_setting('NOTEBOOKS_TREE_MAX_DEPTH', 5)))
+    except ValueError as e:
+        return Response({'detail': str(e)}, status=400)
+    except FileNotFoundError:
+        raise Http404('No directory %s' % path)
+    return Response({'path': path, 'children': nodes})
 
 
 @api_view(['GET'])
@@ -75,6 +146,146 @@ def show_notebook_json(request, name):
     return Response(notebook)
 
 
+def server_sent_event(event):
+    return 'event: %s\ndata: %s\n\n' % (event['event'], json.dumps(event))
+
+
+def _selection(data, nb):
+    """the cells, tags and target options of a partial execution, checked against the notebook
+
+    ``cells`` is a parse_cells() spec or a list of indexes, ``tags`` a comma
+    separated string or a list, ``target`` an index. Raises ValueError or
+    IndexError for invalid options.
+    """
+    options = {}
+    cells, tags, target = data.get('cells'), data.get('tags'), data.get('target')
+    if cells not in (None, ''):
+        if isinstance(cells, str):
+            parse_cells(cells)
+        elif not isinstance(cells, list) or not all(type(index) is int for index in cells):
+            raise ValueError('cells must be a string like 3,5 or 10:12 or a list of indexes')
+        # the spec is kept, a slice is not json
+        options['cells'] = cells
+    if tags not in (None, ''):
+        if isinstance(tags, str):
+            tags = [tag.strip() for tag in tags.split(',') if tag.strip()]
+        elif not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+            raise ValueError('tags must be a comma separated string or a list of strings')
+        options['tags'] = tags
+    if target not in (None, ''):
+        if isinstance(target, bool) or not isinstance(target, (int, str)):
+            raise ValueError('target must be a cell index')
+        options['target'] = int(target)
+    # a dry run, the errors are reported now rather than by the execution
+    select_cells(nb, options.get('cells'), options.get('tags'), options.get('target'))
+    return options
+
+
+@require_POST
+def execute_notebook_stream(request, name):
+    """execute a notebook and stream the results of its cells as server-sent events
+
+    Every run writes its executed notebook below ``streams/<run id>/`` in the
+    jobs directory, the source notebook is left unchanged.
+    """
+    if not os.path.isfile(os.path.join(settings.NOTEBOOKS_ROOT, '%s.ipynb' % name)):
+        raise Http404('No notebook %s' % name)
+    run_id = jobs.new_job_id()
+    output_path = os.path.join(jobs.get_queue().directory, 'streams', run_id, name + '.ipynb')
+    executor = NotebookExecutor(fullname=name, engine=get_setting('NOTEBOOKS_EXECUTION_ENGINE', 'kernel'),
+                                spill_dir=output_path[:-len('.ipynb')] + '.outputs')
+    try:
+        options = _selection(request.POST, executor.read())
+    except (IndexError, ValueError) as e:
+        return HttpResponseBadRequest('Invalid cells, tags or target: %s' % e)
+    executor.cells, executor.tags, executor.target = options.get('cells'), options.get('tags'), options.get('target')
+
+    def events():
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        # also if the client went away, once the execution stopped changing the notebook
+        for event in executor.stream(finished=lambda: executor.write(output_path)):
+            yield server_sent_event(dict(event, run=run_id) if event['event'] == 'start' else event)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # proxies must not buffer the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _job_response(request, job, status=200):
+    job = dict(job, url=request.build_absolute_uri(reverse('notebook_job', args=[job['id']])),
+               notebook_url=request.build_absolute_uri(reverse('notebook_job_result', args=[job['id']])))
+    return Response(job, status=status, headers={'Location': job['url']})
+
+
+@api_view(['POST'])
+def execute_notebook(request, name):
+    """queue an execution of a notebook, the job runs in the background"""
+    if not os.path.isfile(os.path.join(settings.NOTEBOOKS_ROOT, '%s.ipynb' % name)):
+        raise Http404('No notebook %s' % name)
+    options = {}
+    try:
+        for option in ('timeout', 'cell_timeout'):
+            if request.data.get(option) is not None:
+                options[option] = float(request.data[option])
+    except (TypeError, ValueError):
+        return Response({'detail': 'timeout and cell_timeout must be numbers'}, status=400)
+    parameters = request.data.get('parameters')
+    if parameters is not None:
+        if not isinstance(parameters, dict):
+            return Response({'detail': 'parameters must be a json object'}, status=400)
+        options.update(parameters=parameters, memoize=True)
+    try:
+        with io.open(os.path.join(settings.NOTEBOOKS_ROOT, '%s.ipynb' % name), encoding='utf-8') as f:
+            options.update(_selection(request.data, nbformat.read(f, 4)))
+    except (IndexError, ValueError) as e:
+        return Response({'detail': 'Invalid cells, tags or target: %s' % e}, status=400)
+    if request.data.get('checkpoint'):
+        options['checkpoint'] = True
+    priority = request.data.get('priority') or 'default'
+    if priority not in PRIORITIES:
+        return Response({'detail': 'priority must be one of %s' % ', '.join(PRIORITIES)}, status=400)
+    # the tenant is the authenticated user, only staff users submit on behalf of another tenant
+    tenant = request.user.get_username() if request.user.is_authenticated else None
+    if request.data.get('tenant'):
+        if not request.user.is_staff:
+            return Response({'detail': 'Only staff users may set the tenant'}, status=403)
+        tenant = str(request.data['tenant'])
+    return _job_response(request, jobs.submit(name, priority=priority, tenant=tenant, **options), status=202)
+
+
+@api_view(['GET'])
+def job_statistics(request):
+    """queued, running and done jobs, queue wait and run time histograms of the last finished jobs"""
+    queue = jobs.get_queue()
+    return Response(dict(jobs=queue.statistics(), **histograms(queue.recent())))
+
+
+@api_view(['GET'])
+def notebook_job(request, job_id):
+    """status and progress of a notebook execution job"""
+    job = jobs.get_queue().get(job_id)
+    if job is None:
+        raise Http404('No job %s' % job_id)
+    return _job_response(request, job)
+
+
+@api_view(['GET'])
+def notebook_job_result(request, job_id):
+    """the executed notebook of a finished job, also if a cell failed"""
+    job = jobs.get_queue().get(job_id)
+    if job is None:
+        raise Http404('No job %s' % job_id)
+    if job['status'] not in (jobs.FINISHED, jobs.FAILED):
+        return Response({'detail': 'The job is %s' % job['status'], 'status': job['status']}, status=409)
+    try:
+        with io.open(jobs.get_queue().result_path(job), encoding='utf-8') as f:
+            return Response(json.load(f))
+    except FileNotFoundError:
+        raise Http404('Job %s has no executed notebook' % job_id)
+
+
 class FileUploadView(rest_views.APIView):
     parser_classes = (FileUploadParser,)
 